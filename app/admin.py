@@ -2,8 +2,12 @@ from django.contrib import admin
 
 # Register your models here.
 from django.contrib import admin
+from django.db import transaction
+from django.utils import timezone
 from django.utils.html import format_html
-from .models import Asset, User, Transfer
+from .models import Asset, AssetPrice, User, Transfer, PriceChange
+from .services import note_transfer_created, note_transfers_changed
+from .caching import bump_price_version
 
 
 # ==========================
@@ -41,6 +45,29 @@ class AssetAdmin(admin.ModelAdmin):
         }),
     )
 
+    # أي تعديل على الكتالوج/الأسعار يبطل الكاش المبني على نسخة الأسعار
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        version = bump_price_version()
+        if "unit_price_usd" in form.changed_data:
+            PriceChange.objects.create(
+                asset=obj, old_price_usd=form.initial.get("unit_price_usd") if change else None,
+                new_price_usd=obj.unit_price_usd, price_version=version, source="admin",
+            )
+            AssetPrice.objects.create(asset=obj, price_usd=obj.unit_price_usd,
+                                      effective_at=timezone.now(), source="admin")
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        bump_price_version()
+
+    def delete_queryset(self, request, queryset):
+        # حذف الأصول مع ما يتبعها (سجل الأسعار AssetPrice/PriceChange وصفوف Holding) في معاملة واحدة؛
+        # أصل عليه مناقلات محمي (PROTECT) فيفشل الحذف كله. ثم نسخة أسعار جديدة تبطل الكاش
+        with transaction.atomic():
+            super().delete_queryset(request, queryset)
+        bump_price_version()
+
 
 # ==========================
 #  User Admin
@@ -132,6 +159,35 @@ class TransferAdmin(admin.ModelAdmin):
         }),
     )
 
+    def save_model(self, request, obj, form, change):
+        old = None
+        if change:
+            old = Transfer.objects.filter(pk=obj.pk).values("user_id", "transfer_date").first()
+        super().save_model(request, obj, form, change)
+        if not old:
+            note_transfer_created(obj)
+            return
+        # تعديل من لوحة الإدارة: أعد بناء حالة الحول من أقدم تاريخ متأثر
+        note_transfers_changed(obj.user_id, min(old["transfer_date"], obj.transfer_date))
+        if old["user_id"] != obj.user_id:
+            note_transfers_changed(old["user_id"], old["transfer_date"])
+
+    def delete_model(self, request, obj):
+        user_id, transfer_date = obj.user_id, obj.transfer_date
+        super().delete_model(request, obj)
+        note_transfers_changed(user_id, transfer_date)
+
+    def delete_queryset(self, request, queryset):
+        affected = {}
+        for user_id, transfer_date in queryset.values_list("user_id", "transfer_date"):
+            if user_id not in affected or transfer_date < affected[user_id]:
+                affected[user_id] = transfer_date
+        # حذف المناقلات وأثرها على جدول الأرصدة في معاملة واحدة
+        with transaction.atomic():
+            super().delete_queryset(request, queryset)
+        for user_id, since_dt in affected.items():
+            note_transfers_changed(user_id, since_dt)
+
     def user_email(self, obj):
         return obj.user.email
     user_email.short_description = "User Email"
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        from . import registry  # noqa: F401  (إشارات إبطال سجل الأصول)
+        from . import holdings  # noqa: F401  (إشارات صيانة جدول الأرصدة)
@@ -0,0 +1,217 @@
+# app/batch.py
+"""
+محرك دفعي (NumPy) لحالة الحول لمجموعة مستخدمين معًا — لإعادة الحساب الليلية.
+
+مناقلات دفعة المستخدمين تُحمَّل باستعلام واحد كأعمدة مرتبة (user_id, transfer_date, id):
+  user | ts (ميكروثانية منذ epoch) | kind | delta (دولار بالوحدات الصغرى، بإشارته)
+ثم لكل فئة حول:
+  - الرصيد الجاري: مجموع تراكمي مقطَّع حسب المستخدم
+  - تجاوز النصاب: مقارنة متجهة
+  - بداية الحول: بداية آخر تسلسل فوق النصاب يمتد حتى آخر مناقلة (مسح مقطَّع)
+  - قيم مواعيد الاستحقاق: دمج المواعيد مع النقاط بترتيب lexsort (كـ bisect_right)
+النتيجة تطابق haul_window_from_timeline وcompute_overdue_zakat_cycles لكل مستخدم.
+المجاميع int64؛ قيم تتجاوز ~9.2e12 دولار لا تُدعم هنا (يبقى المسار العادي).
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from .conf import ZAKAT_HAUL_DAYS
+from .fixed import from_micro, mul_micro, to_micro, zakat_micro
+from .models import HaulCheckpoint, HaulState, Transfer
+from .registry import AssetRegistry, get_asset_registry
+from .services import (
+    ASSET_CLASSES, HAUL_KINDS, HaulReplay, asset_kind,
+    haul_nisab_usd, haul_prices_key, haul_window_from_start,
+)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+HAUL_US = ZAKAT_HAUL_DAYS * 86400 * 10 ** 6
+KIND_CODES = {kind: i for i, kind in enumerate(ASSET_CLASSES)}
+SIGNS = {"ADD": 1, "WITHDRAW": -1, "ZAKAT_OUT": -1}
+
+
+def to_us(dt: datetime) -> int:
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+def from_us(n) -> datetime:
+    return EPOCH + timedelta(microseconds=int(n))
+
+
+class LedgerColumns:
+    """مناقلات دفعة مستخدمين كأعمدة NumPy مرتبة حسب (user_id, transfer_date, id)."""
+
+    def __init__(self, user, tid, ts, kind, delta):
+        self.user = np.asarray(user, dtype=np.int64)
+        self.tid = np.asarray(tid, dtype=np.int64)
+        self.ts = np.asarray(ts, dtype=np.int64)
+        self.kind = np.asarray(kind, dtype=np.int8)
+        self.delta = np.asarray(delta, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.user)
+
+    def select(self, kinds) -> "LedgerColumns":
+        mask = np.isin(self.kind, [KIND_CODES[k] for k in kinds])
+        return LedgerColumns(self.user[mask], self.tid[mask], self.ts[mask], self.kind[mask], self.delta[mask])
+
+
+def load_ledger_columns(user_ids: List[int], registry: Optional[AssetRegistry] = None) -> LedgerColumns:
+    """استعلام واحد لمناقلات الدفعة على الأصول الفعّالة (نفس صفوف load_user_ledger)."""
+    registry = registry or get_asset_registry()
+    kind_code: Dict[int, int] = {}
+    price: Dict[int, int] = {}
+    for a in registry.assets:
+        kind = asset_kind(a)
+        if kind:
+            kind_code[a.id] = KIND_CODES[kind]
+            price[a.id] = to_micro(a.unit_price_usd)
+
+    qs = (Transfer.objects
+          .filter(user_id__in=user_ids, asset_id__in=list(kind_code))
+          .order_by("user_id", "transfer_date", "id")
+          .values_list("user_id", "id", "asset_id", "transfer_type", "quantity", "transfer_date"))
+    user, tid, ts, kind, delta = [], [], [], [], []
+    for user_id, transfer_id, asset_id, ttype, qty, date in qs.iterator():
+        user.append(user_id)
+        tid.append(transfer_id)
+        ts.append(to_us(date))
+        kind.append(kind_code[asset_id])
+        delta.append(SIGNS.get(ttype, 0) * mul_micro(to_micro(qty), price[asset_id]))
+    return LedgerColumns(user, tid, ts, kind, delta)
+
+
+def batch_haul(cols: LedgerColumns, nisab_micro: int, now: Optional[datetime] = None) -> Dict[int, Dict[str, Any]]:
+    """
+    حالة الحول لكل مستخدم في cols (أعمدة فئة واحدة بعد select):
+      running_micro، start، last_id/last_date، count،
+      dues: [(due_at, value_micro)] مواعيد الاستحقاق مع قيمة الرصيد عندها،
+      overdue: عدد المواعيد المكتملة حتى now،
+      settled: عدد المواعيد السابقة لآخر مناقلة (كما تحفظها HaulReplay؛ قد تتجاوز now).
+    """
+    n = len(cols)
+    if n == 0:
+        return {}
+    now_us = to_us(now or timezone.now())
+    user, ts = cols.user, cols.ts
+
+    first = np.empty(n, dtype=bool)
+    first[0] = True
+    np.not_equal(user[1:], user[:-1], out=first[1:])
+    seg_start = np.flatnonzero(first)
+    seg_end = np.append(seg_start[1:], n) - 1
+    seg_id = np.cumsum(first) - 1
+
+    # الرصيد الجاري لكل مستخدم = مجموع تراكمي عام ناقص ما سبق بداية مقطعه
+    cs = np.cumsum(cols.delta)
+    running = cs - (cs - cols.delta)[seg_start][seg_id]
+
+    # بداية الحول: بداية آخر تسلسل فوق النصاب، بشرط أن يمتد حتى آخر نقطة
+    above = running >= nisab_micro
+    run_start = above.copy()
+    run_start[1:] &= ~above[:-1] | first[1:]
+    last_run = np.maximum.accumulate(np.where(run_start, np.arange(n), -1))
+    has_start = above[seg_end]
+    start_idx = last_run[seg_end]
+
+    # مواعيد الاستحقاق لكل مقطع له بداية حول: المكتملة حتى now والسابقة لآخر مناقلة
+    segs = np.flatnonzero(has_start)
+    start_us = ts[start_idx[segs]]
+    k_overdue = np.maximum((now_us - start_us) // HAUL_US, 0)
+    k_settled = np.maximum((ts[seg_end[segs]] - start_us - 1) // HAUL_US, 0)
+    k_max = np.maximum(k_overdue, k_settled)
+    due_seg = np.repeat(segs, k_max)
+    offsets = np.repeat(np.cumsum(k_max) - k_max, k_max)
+    k = np.arange(len(due_seg)) - offsets + 1
+    due_us = np.repeat(start_us, k_max) + k * HAUL_US
+
+    # قيمة الرصيد عند كل موعد = آخر نقطة ts <= الموعد في المقطع نفسه
+    # (النقاط قبل المواعيد عند التعادل، مثل bisect_right)
+    m = len(due_us)
+    order = np.lexsort((
+        np.concatenate([np.zeros(n, dtype=np.int8), np.ones(m, dtype=np.int8)]),
+        np.concatenate([ts, due_us]),
+        np.concatenate([seg_id, due_seg]),
+    ))
+    last_point = np.maximum.accumulate(np.where(order < n, order, -1))
+    is_due = order >= n
+    due_value = np.empty(m, dtype=np.int64)
+    due_value[order[is_due] - n] = running[last_point[is_due]]
+
+    results: Dict[int, Dict[str, Any]] = {}
+    due_pos = 0
+    dues_by_seg = {s: (int(a), int(b), int(c)) for s, a, b, c in zip(segs, k_max, k_overdue, k_settled)}
+    for s, (lo, hi) in enumerate(zip(seg_start.tolist(), seg_end.tolist())):
+        count, overdue, settled = dues_by_seg.get(s, (0, 0, 0))
+        results[int(user[lo])] = {
+            "running_micro": int(running[hi]),
+            "start": from_us(ts[start_idx[s]]) if has_start[s] else None,
+            "last_id": int(cols.tid[hi]),
+            "last_date": from_us(ts[hi]),
+            "count": hi - lo + 1,
+            "dues": [(from_us(d), int(v)) for d, v in
+                     zip(due_us[due_pos:due_pos + count], due_value[due_pos:due_pos + count])],
+            "overdue": overdue,
+            "settled": settled,
+        }
+        due_pos += count
+    return results
+
+
+def batch_window(res: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """نفس haul_window_from_timeline."""
+    return haul_window_from_start(res["start"] if res else None)
+
+def batch_overdue_cycles(res: Optional[Dict[str, Any]], nisab_micro: int) -> List[Dict[str, Any]]:
+    """نفس compute_overdue_zakat_cycles (يتوقف عند أول موعد تحت النصاب)."""
+    cycles: List[Dict[str, Any]] = []
+    for due_at, value in (res["dues"][:res["overdue"]] if res else []):
+        if value < nisab_micro:
+            break
+        required = zakat_micro(value)
+        cycles.append({"due_at": due_at, "required_usd": from_micro(required), "required_micro": required})
+    return cycles
+
+def batch_replay(res: Optional[Dict[str, Any]], nisab_usd) -> HaulReplay:
+    """حالة HaulReplay المكافئة لإعادة تشغيل المناقلات نفسها واحدة واحدة."""
+    if not res:
+        return HaulReplay(nisab_usd)
+    replay = HaulReplay(
+        nisab_usd, from_micro(res["running_micro"]), res["start"],
+        [(d, from_micro(v)) for d, v in res["dues"][:res["settled"]]],
+        res["last_id"], res["last_date"],
+    )
+    replay.since_checkpoint = res["count"]
+    return replay
+
+
+def recompute_haul_states(user_ids: List[int], registry: Optional[AssetRegistry] = None,
+                          now: Optional[datetime] = None) -> int:
+    """
+    يعيد كتابة HaulState لكل فئة حول لمستخدمي الدفعة (مع حذف الـ checkpoints القديمة).
+    حالة تسبقها مناقلة أحدث تُكتشف عند القراءة (last_transfer_id) وتُبنى من جديد.
+    """
+    registry = registry or get_asset_registry()
+    cols = load_ledger_columns(user_ids, registry)
+    states = []
+    for kind, kinds in HAUL_KINDS.items():
+        key = haul_prices_key(kind, registry.assets)
+        nisab = haul_nisab_usd(kind, registry.assets)
+        results = batch_haul(cols.select(kinds), to_micro(nisab), now)
+        for user_id in user_ids:
+            replay = batch_replay(results.get(user_id), nisab)
+            states.append(HaulState(
+                user_id=user_id, kind=kind, prices_key=key,
+                last_transfer_id=replay.last_id, last_transfer_date=replay.last_date,
+                transfers_since_checkpoint=replay.since_checkpoint, next_due_at=replay.next_due_at,
+                **replay.fields(),
+            ))
+
+    with transaction.atomic():
+        HaulCheckpoint.objects.filter(user_id__in=user_ids).delete()
+        HaulState.objects.filter(user_id__in=user_ids).delete()
+        HaulState.objects.bulk_create(states)
+    return len(states)
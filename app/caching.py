@@ -0,0 +1,94 @@
+# app/caching.py
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+from .conditional import content_etag
+from .models import DataVersion, HaulState, User
+
+PRICE_VERSION_KEY = "prices"
+SNAPSHOT_CACHE_PREFIX = "snapshot"
+
+
+# -------- عدّادات النسخ --------
+def get_data_version(key: str) -> int:
+    value = DataVersion.objects.filter(key=key).values_list("value", flat=True).first()
+    return value or 0
+
+def bump_data_version(key: str) -> int:
+    """يزيد العدّاد ويعيد قيمته الجديدة."""
+    if not DataVersion.objects.filter(key=key).update(value=F("value") + 1):
+        obj, _ = DataVersion.objects.get_or_create(key=key)
+        DataVersion.objects.filter(pk=obj.pk).update(value=F("value") + 1)
+    return get_data_version(key)
+
+def get_price_version() -> int:
+    return get_data_version(PRICE_VERSION_KEY)
+
+def bump_price_version() -> int:
+    """أسعار/كتالوج الأصول تغيّر (محدّثات الأسعار، البذر، لوحة الإدارة)."""
+    from .registry import invalidate_asset_registry
+
+    version = bump_data_version(PRICE_VERSION_KEY)
+    invalidate_asset_registry()
+    return version
+
+def bump_ledger_version(user_id: int) -> None:
+    """مناقلات المستخدم أو عملة عرضه تغيّرت."""
+    User.objects.filter(id=user_id).update(ledger_version=F("ledger_version") + 1)
+
+
+# -------- كاش اللقطة --------
+def snapshot_cache_key(user: User, price_version: int, variant: str = "") -> str:
+    # التاريخ المحلي جزء من المفتاح: عدّادات الأيام تتغيّر مع مرور الأيام
+    day = timezone.localdate().isoformat()
+    return f"{SNAPSHOT_CACHE_PREFIX}:{user.id}:{user.ledger_version}:{price_version}:{day}:{variant}"
+
+def snapshot_valid_until(user_id: int, now: Optional[datetime] = None) -> datetime:
+    """
+    أقرب لحظة يتغيّر فيها شيء من اللقطة بدون أي تعديل بيانات:
+      - منتصف الليل المحلي التالي
+      - أقرب "دورة يوم" لكل بداية حول: days_left / completed / مواعيد الاستحقاق
+        كلها تُحسب بفروق أيام كاملة من بداية الحول فتتغيّر عند نفس ساعة البداية.
+    """
+    now = now or timezone.now()
+    local_now = timezone.localtime(now)
+    until = (local_now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    starts = (HaulState.objects
+              .filter(user_id=user_id, haul_started_at__isnull=False)
+              .values_list("haul_started_at", flat=True))
+    for start in starts:
+        tick = start + timedelta(days=(now - start).days + 1)
+        if tick < until:
+            until = tick
+    return until
+
+def get_cached_snapshot_etag(user: User, price_version: int, variant: str = "") -> Optional[str]:
+    """بصمة اللقطة المخزّنة (مفتاح صغير منفصل) لخدمة If-None-Match بدون تحميل اللقطة."""
+    return cache.get(f"{snapshot_cache_key(user, price_version, variant)}:etag")
+
+def get_or_compute_snapshot(user: User, builder: Callable[[], Dict[str, Any]], variant: str = "",
+                            price_version: Optional[int] = None) -> Dict[str, Any]:
+    """
+    يعيد نتيجة builder() من الكاش إن كانت نسخة دفتر المستخدم ونسخة الأسعار واليوم
+    لم تتغيّر؛ وإلا يحسبها ويخزّنها حتى أقرب لحظة تتغيّر فيها عدّادات الأيام.
+    النتيجة تحمل "etag" (بصمة محتواها) ويُخزَّن بجانبها في مفتاح صغير.
+    """
+    if price_version is None:
+        price_version = get_price_version()
+    key = snapshot_cache_key(user, price_version, variant)
+    data = cache.get(key)
+    if data is not None:
+        return data
+
+    data = builder()
+    data["etag"] = content_etag(data)
+    now = timezone.now()
+    timeout = int((snapshot_valid_until(user.id, now) - now).total_seconds())
+    if timeout > 0:
+        cache.set_many({key: data, f"{key}:etag": data["etag"]}, timeout)
+    return data
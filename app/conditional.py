@@ -0,0 +1,48 @@
+# app/conditional.py
+import hashlib
+import json
+from typing import Any, Callable
+
+from django.utils.http import parse_etags
+from rest_framework.response import Response
+
+# المحتوى المرجعي الثابت في conf.py: يتغيّر فقط مع نشر جديد
+REFERENCE_CACHE_CONTROL = "public, max-age=86400, stale-while-revalidate=604800"
+# كتالوج الأصول: عام لكن يجب التحقق منه عند كل استخدام (الأسعار تتحدّث)
+CATALOG_CACHE_CONTROL = "public, max-age=0, must-revalidate"
+# لقطة المستخدم: خاصة ويجب التحقق منها عند كل استخدام
+SNAPSHOT_CACHE_CONTROL = "private, max-age=0, must-revalidate"
+
+
+def make_etag(*parts: Any) -> str:
+    """ETag قوي من أجزاء نسخ/بصمات (مرتّبة)."""
+    digest = hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:32]
+    return f'"{digest}"'
+
+def content_etag(data: Any) -> str:
+    """ETag من المحتوى نفسه (JSON مرتّب المفاتيح)."""
+    return make_etag(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str))
+
+def etag_matches(request, etag: str) -> bool:
+    """If-None-Match: مقارنة ضعيفة كما في RFC 9110 (نتجاهل بادئة W/)."""
+    header = request.META.get("HTTP_IF_NONE_MATCH")
+    if not header:
+        return False
+    for tag in parse_etags(header):
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+def with_validators(response: Response, etag: str, cache_control: str) -> Response:
+    response["ETag"] = etag
+    response["Cache-Control"] = cache_control
+    return response
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return with_validators(Response(status=304), etag, cache_control)
+
+def conditional_response(request, etag: str, cache_control: str, build: Callable[[], Response]) -> Response:
+    """304 قبل أي حساب إن طابق If-None-Match، وإلا build() مع نفس الترويسات."""
+    if etag_matches(request, etag):
+        return not_modified(etag, cache_control)
+    return with_validators(build(), etag, cache_control)
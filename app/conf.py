@@ -17,6 +17,56 @@ NISAB_BENCHMARK_FOR_MONEY = "GOLD"
 # تذكيرات قبل موعد الزكاة (أيام) — لا إشعار تأخير
 ZAKAT_REMINDER_OFFSETS = [30, 15, 7, 0]
 
+# حالة الحول المحفوظة: لقطة (checkpoint) كل كم مناقلة
+HAUL_CHECKPOINT_EVERY = 500
+
+# الحد الأقصى لعدد المناقلات في طلب الإدخال الجماعي
+TRANSFER_BULK_MAX_ITEMS = 500
+
+# تصدير السجل: حجم الدفعة عند المرور على المناقلات
+EXPORT_CHUNK_SIZE = 2000
+
+# سجل الأصول داخل العملية: أقصى مدة (ثوانٍ) قبل إعادة فحص نسخة الأسعار
+ASSET_REGISTRY_CHECK_SECONDS = 5
+
+# صندوق التذكيرات الصادر: عدد محاولات التسليم قبل اعتبار الرسالة فاشلة
+NOTIFICATION_MAX_ATTEMPTS = 5
+# انتظار (ثوانٍ) قبل إعادة محاولة رسالة فشل إرسالها: يتضاعف مع كل محاولة حتى الحد الأعلى
+NOTIFICATION_RETRY_BACKOFF_SECONDS = 60
+NOTIFICATION_RETRY_MAX_BACKOFF_SECONDS = 6 * 60 * 60
+# مهلة حجز الدفعة (ثوانٍ): المستهلك الذي تعطّل أثناء الإرسال تُعاد رسائله غير المسجَّلة بعدها
+NOTIFICATION_CLAIM_SECONDS = 5 * 60
+
+# فهرس هامش النصاب: عدد المستخدمين في كل دفعة تقييم بعد تحديث الأسعار
+NISAB_INDEX_CHUNK_SIZE = 2000
+
+# منسّق تحديث الأسعار: نتيجة ناجحة أحدث من هذه المدة (ثوانٍ) تُعاد بدون طلب للمزوّد
+# (أو حتى time_next_update_utc الذي يعلنه المزوّد إن كان أبعد)
+RATE_REFRESH_STALE_SECONDS = 600
+# تحديث "قيد التشغيل" أقدم من هذا يُعتبر عالقًا (عامل مات) ويمكن الاستيلاء عليه
+RATE_REFRESH_LOCK_TIMEOUT_SECONDS = 120
+
+# جلب مزوّدي الأسعار: إعادة المحاولة (تراجع أُسّي بعشوائية كاملة) وقاطع دائرة لكل مزوّد
+RATE_FETCH_RETRIES = 3
+RATE_FETCH_BACKOFF_SECONDS = 0.5
+RATE_BREAKER_FAILURES = 3
+RATE_BREAKER_RESET_SECONDS = 300
+RATE_HTTP_POOL_SIZE = 4
+
+# مصادر الأسعار (مسارات أصناف RateSource؛ أكثر من مصدر لنفس النوع يُسأل بالتوازي ويفوز أسرع حمولة سليمة)
+RATE_SOURCES = [
+    "app.rate_fetch.ErApiSource",
+    "app.rate_fetch.MetalPriceApiSource",
+]
+RATE_FETCH_WORKERS = 8
+# حمولة تغيّر سعر أصل سبق جلبه بأكثر من هذه النسبة تُرفض (قيمة شاذة)؛
+# settings.RATE_OUTLIER_MAX_CHANGE (متغيّر البيئة بنفس الاسم) يتجاوزها
+RATE_OUTLIER_MAX_CHANGE = 0.25
+# نسبة خاصة لأصول بعينها (عملات شديدة التقلّب مثلًا): {"VES": 0.6}؛ وتتجاوزها الإعدادات أيضًا
+RATE_OUTLIER_MAX_CHANGE_BY_CODE = {}
+# آخر حمولة سليمة لكل نوع تُحفظ على القرص (settings.RATE_CACHE_DIR) وتُستخدم عند تعطّل كل المصادر
+RATE_CACHE_MAX_AGE_SECONDS = 86400
+
 # conf.py
 
 ZAKAT_REFERENCE_JSON = {
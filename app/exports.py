@@ -0,0 +1,107 @@
+# app/exports.py
+import csv
+import json
+from typing import Any, Dict, Iterator, List, Tuple
+
+from .conf import EXPORT_CHUNK_SIZE
+from .models import Asset, Transfer, User
+from .services import (
+    HAUL_KINDS, HaulReplay, allocate_paid_over_cycles, asset_kind,
+    asset_value_micro, get_display_currency, haul_nisab_usd, usd_to_display,
+)
+from .fixed import from_micro
+
+EXPORT_FORMATS = ("csv", "jsonl")
+
+EXPORT_COLUMNS = [
+    "record", "id", "transfer_date", "asset_code", "class", "transfer_type",
+    "quantity", "unit_price_usd", "value_usd", "value_display", "display_currency", "note",
+    "due_at", "base_value_usd", "required_usd", "remaining_usd", "remaining_display",
+]
+
+
+def iter_ledger_records(user: User) -> Iterator[Dict[str, Any]]:
+    """
+    يمرّ على مناقلات المستخدم بدفعات (iterator) ويعيد سجلًا لكل مناقلة بقيمتها بالدولار
+    وبعملة العرض، ثم سجلات الحوالات المكتملة لكل فئة. آلة الحول تُشغَّل أثناء المرور
+    نفسه فالذاكرة ثابتة مهما طال السجل (عدا دفعات الزكاة المخرجة).
+    """
+    display = get_display_currency(user)
+    display_code = display.asset_code if display else "USD"
+    all_assets = list(Asset.objects.all())
+    assets_by_id = {a.id: a for a in all_assets}
+    active = [a for a in all_assets if a.is_active]
+
+    replays = {kind: HaulReplay(haul_nisab_usd(kind, active)) for kind in HAUL_KINDS}
+    zakat_out: Dict[str, List[Tuple[Any, int]]] = {kind: [] for kind in HAUL_KINDS}
+
+    qs = (Transfer.objects
+          .filter(user=user)
+          .order_by("transfer_date", "id")
+          .values_list("id", "asset_id", "transfer_type", "quantity", "transfer_date", "note"))
+    for tid, asset_id, ttype, qty, ts, note in qs.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        asset = assets_by_id[asset_id]
+        kind = asset_kind(asset)
+        value_micro = asset_value_micro(qty, asset)
+        value_usd = from_micro(value_micro)
+        yield {
+            "record": "transfer",
+            "id": tid,
+            "transfer_date": ts.isoformat(),
+            "asset_code": asset.asset_code,
+            "class": kind or "",
+            "transfer_type": ttype,
+            "quantity": str(qty),
+            "unit_price_usd": str(asset.unit_price_usd),
+            "value_usd": str(value_usd),
+            "value_display": str(usd_to_display(value_usd, display)),
+            "display_currency": display_code,
+            "note": note,
+        }
+
+        if not asset.is_active or kind is None:
+            continue
+        for haul_kind, kinds in HAUL_KINDS.items():
+            if kind in kinds:
+                replays[haul_kind].apply(tid, ts, ttype, value_micro)
+                if ttype == "ZAKAT_OUT":
+                    zakat_out[haul_kind].append((ts, value_micro))
+
+    # الحوالات المكتملة لكل فئة + ما بقي منها بعد توزيع المدفوع (FIFO)
+    for kind, replay in replays.items():
+        cycles = replay.overdue_cycles()
+        if not cycles:
+            continue
+        first_due = cycles[0]["due_at"]
+        paid = from_micro(sum(v for ts, v in zakat_out[kind] if ts >= first_due))
+        allocate_paid_over_cycles(paid, cycles)
+        for i, c in enumerate(cycles, start=1):
+            yield {
+                "record": "haul_cycle",
+                "class": kind,
+                "display_currency": display_code,
+                "due_at": c["due_at"].isoformat(),
+                "base_value_usd": str(replay.value_at_due(i)),
+                "required_usd": str(c["required_usd"]),
+                "remaining_usd": str(c["remaining_usd"]),
+                "remaining_display": str(usd_to_display(c["remaining_usd"], display)),
+            }
+
+
+class _Echo:
+    """ملف وهمي لـ csv.writer: يعيد السطر بدل كتابته (نمط التدفق في Django)."""
+    def write(self, value):
+        return value
+
+
+def iter_export_lines(user: User, output: str = "csv") -> Iterator[str]:
+    records = iter_ledger_records(user)
+    if output == "jsonl":
+        for rec in records:
+            yield json.dumps(rec, ensure_ascii=False) + "\n"
+        return
+
+    writer = csv.DictWriter(_Echo(), fieldnames=EXPORT_COLUMNS, restval="")
+    yield writer.writeheader()
+    for rec in records:
+        yield writer.writerow(rec)
@@ -0,0 +1,29 @@
+# app/filters.py
+import django_filters
+
+from .models import Transfer
+from .services import ASSET_CLASSES
+
+
+class TransferFilter(django_filters.FilterSet):
+    """
+    فلاتر قائمة المناقلات:
+      ?kind=gold|silver|money  ?asset=<id>  ?asset_code=USD
+      ?type=ADD|WITHDRAW|ZAKAT_OUT  ?date_from=...&date_to=... (ISO، شاملة)
+    """
+    kind = django_filters.ChoiceFilter(
+        choices=[(k, k) for k in ASSET_CLASSES], method="filter_kind",
+    )
+    asset = django_filters.NumberFilter(field_name="asset_id")
+    asset_code = django_filters.CharFilter(field_name="asset__asset_code", lookup_expr="iexact")
+    type = django_filters.ChoiceFilter(field_name="transfer_type", choices=Transfer.TRANSFER_TYPE_CHOICES)
+    date_from = django_filters.IsoDateTimeFilter(field_name="transfer_date", lookup_expr="gte")
+    date_to = django_filters.IsoDateTimeFilter(field_name="transfer_date", lookup_expr="lte")
+
+    class Meta:
+        model = Transfer
+        fields = ["kind", "asset", "asset_code", "type", "date_from", "date_to"]
+
+    def filter_kind(self, queryset, name, value):
+        f = ASSET_CLASSES[value]
+        return queryset.filter(asset__name=f["name"], asset__unit_name=f["unit_name"])
@@ -0,0 +1,67 @@
+# app/fixed.py
+"""
+محرك الأعداد الثابتة: القيم المالية كأعداد صحيحة بوحدات 10^-6 (مثل DECIMAL_18_6)
+داخل الحلقات الساخنة (خطوط الزمن، الحول، توزيع المدفوع، الإجماليات).
+Decimal يظهر فقط على الحدود (قراءة القاعدة/المدخلات وإخراج الـ API).
+
+التقريب half-even في كل مكان ليطابق DEC6 (سياق Decimal الافتراضي) حتى آخر خانة.
+"""
+from decimal import Decimal
+from typing import Any, List, Optional, Tuple
+
+from .conf import ZAKAT_RATE
+
+MICRO = 10 ** 6
+_MICRO_EXP = Decimal("0.000001")
+
+
+def to_micro(value: Any) -> int:
+    """Decimal/int/str → وحدات صحيحة (half-even مثل DEC6)."""
+    if isinstance(value, int):
+        return value * MICRO
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return int(value.quantize(_MICRO_EXP).scaleb(6))
+
+def from_micro(n: int) -> Decimal:
+    """وحدات صحيحة → Decimal بست خانات (نفس شكل DEC6: 0 → 0.000000)."""
+    return Decimal(n).scaleb(-6)
+
+def div_round(n: int, d: int) -> int:
+    """n / d مقرّبًا half-even (d > 0)."""
+    q, r = divmod(abs(n), d)
+    if 2 * r > d or (2 * r == d and q % 2):
+        q += 1
+    return q if n >= 0 else -q
+
+def mul_micro(a: int, b: int) -> int:
+    """ناتج قيمتين بالوحدات الصغرى = DEC6(a × b)."""
+    return div_round(a * b, MICRO)
+
+ZAKAT_RATE_MICRO = to_micro(str(ZAKAT_RATE))
+
+def zakat_micro(value: int) -> int:
+    """DEC6(value × ZAKAT_RATE)."""
+    return mul_micro(value, ZAKAT_RATE_MICRO)
+
+
+def allocate_micro(total_paid: int, required: List[int]) -> Tuple[List[int], int, Optional[int]]:
+    """
+    توزيع المدفوع على الحوالات بالترتيب (FIFO) بالوحدات الصغرى.
+    يعيد (المتبقي لكل حول، مجموع المتبقي، فهرس أقدم حول غير مسدَّد أو None).
+    """
+    remaining_paid = total_paid
+    remaining: List[int] = []
+    total_remaining = 0
+    first_unpaid: Optional[int] = None
+    for i, req in enumerate(required):
+        left = req
+        if remaining_paid > 0:
+            used = req if remaining_paid >= req else remaining_paid
+            left = req - used
+            remaining_paid -= used
+        remaining.append(left)
+        if left > 0 and first_unpaid is None:
+            first_unpaid = i
+        total_remaining += left
+    return remaining, total_remaining, first_unpaid
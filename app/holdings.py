@@ -0,0 +1,116 @@
+# app/holdings.py
+"""
+صيانة جدول الأرصدة (Holding) مع كل كتابة على المناقلات:
+  - حفظ مناقلة (إنشاء/تعديل من الواجهات أو لوحة الإدارة): pre_save يقرأ القيم القديمة
+    وpost_save يطبّق الفرق (الجديد − القديم)
+  - حذف مناقلة (مفردًا أو QuerySet.delete): post_delete يطرح أثرها
+  - الإدخال الجماعي (bulk_create لا يرسل إشارات): apply_holding_deltas مباشرة
+كل تطبيق داخل transaction.atomic فيلتحق بمعاملة الكتابة المحيطة إن وُجدت.
+صفوف فهرس هامش النصاب (app/nisab_index.py) لأنواع الحول التي تمسّها الأصول المتغيّرة
+تُحدَّث بعد تثبيت المعاملة (on_commit)، مرة واحدة لكل مستخدم مهما تعددت كتابات المعاملة.
+"""
+import threading
+from decimal import Decimal
+from typing import Dict, Iterable, Set, Tuple
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Holding, Transfer
+
+HOLDING_SIGNS = {"ADD": 1, "WITHDRAW": -1, "ZAKAT_OUT": -1}
+HOLDING_FIELDS = ("user_id", "asset_id", "transfer_type", "quantity")
+
+HoldingKey = Tuple[int, int]
+
+# مفاتيح (مستخدم، أصل) تنتظر تحديث هامش النصاب بعد تثبيت معاملة هذا الخيط
+_margin_keys = threading.local()
+
+
+def holding_deltas(rows: Iterable[Tuple], sign: int = 1) -> Dict[HoldingKey, Decimal]:
+    """rows: (user_id, asset_id, transfer_type, quantity) → فرق صافي الكمية لكل (مستخدم، أصل)."""
+    deltas: Dict[HoldingKey, Decimal] = {}
+    for user_id, asset_id, ttype, qty in rows:
+        key = (user_id, asset_id)
+        deltas[key] = deltas.get(key, Decimal("0")) + sign * HOLDING_SIGNS.get(ttype, 0) * Decimal(qty)
+    return deltas
+
+def merge_deltas(*parts: Dict[HoldingKey, Decimal]) -> Dict[HoldingKey, Decimal]:
+    out: Dict[HoldingKey, Decimal] = {}
+    for part in parts:
+        for key, value in part.items():
+            out[key] = out.get(key, Decimal("0")) + value
+    return out
+
+def _pending_margin_keys() -> Set[HoldingKey]:
+    if not hasattr(_margin_keys, "keys"):
+        _margin_keys.keys = set()
+    return _margin_keys.keys
+
+def flush_margin_refresh() -> None:
+    """أول نداء بعد التثبيت يأخذ كل المفاتيح المتراكمة؛ البقية لا تجد شيئًا."""
+    from .nisab_index import refresh_nisab_margins
+
+    keys = _pending_margin_keys()
+    if keys:
+        batch = set(keys)
+        keys.clear()
+        refresh_nisab_margins(batch)
+
+def refresh_margins_on_commit(keys: Iterable[HoldingKey]) -> None:
+    """
+    يضم المفاتيح إلى المعلّقة ويسجّل التحديث بعد التثبيت (فورًا خارج المعاملات).
+    معاملة تراجعت تُسقط نداءها وتبقى مفاتيحها فتُحدَّث مع التالية: عمل زائد لا خطأ
+    (الهامش يُحسب من الأرصدة الحالية). robust: الكتابة ثُبّتت؛ الإخفاق يُسجَّل
+    ويصلحه rebuild_nisab_index.
+    """
+    _pending_margin_keys().update(keys)
+    transaction.on_commit(flush_margin_refresh, robust=True)
+
+def apply_holding_deltas(deltas: Dict[HoldingKey, Decimal]) -> None:
+    """تحديث ذرّي (F) لكل صف؛ الترتيب ثابت لتفادي الـ deadlock بين معاملات متزامنة."""
+    now = timezone.now()
+    with transaction.atomic():
+        for (user_id, asset_id), delta in sorted(deltas.items()):
+            if not delta:
+                continue
+            rows = Holding.objects.filter(user_id=user_id, asset_id=asset_id)
+            if rows.update(net_quantity=F("net_quantity") + delta, updated_at=now):
+                continue
+            _, created = Holding.objects.get_or_create(
+                user_id=user_id, asset_id=asset_id, defaults={"net_quantity": delta},
+            )
+            if not created:
+                rows.update(net_quantity=F("net_quantity") + delta, updated_at=now)
+        refresh_margins_on_commit(key for key, delta in deltas.items() if delta)
+
+
+@receiver(pre_save, sender=Transfer)
+def _transfer_before_save(sender, instance, update_fields=None, **kwargs):
+    instance._holding_old = None
+    if instance.pk is None:
+        return
+    if update_fields is not None and not {"user", "asset", "transfer_type", "quantity"} & set(update_fields):
+        instance._holding_old = False  # لا شيء يمس الرصيد
+        return
+    instance._holding_old = Transfer.objects.filter(pk=instance.pk).values_list(*HOLDING_FIELDS).first()
+
+@receiver(post_save, sender=Transfer)
+def _transfer_saved(sender, instance, **kwargs):
+    old = getattr(instance, "_holding_old", None)
+    if old is False:
+        return
+    new = tuple(getattr(instance, f) for f in HOLDING_FIELDS)
+    if old == new:
+        return
+    apply_holding_deltas(merge_deltas(
+        holding_deltas([new]),
+        holding_deltas([old] if old else [], sign=-1),
+    ))
+
+@receiver(post_delete, sender=Transfer)
+def _transfer_deleted(sender, instance, **kwargs):
+    apply_holding_deltas(holding_deltas([tuple(getattr(instance, f) for f in HOLDING_FIELDS)], sign=-1))
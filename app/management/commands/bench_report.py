@@ -0,0 +1,112 @@
+# app/management/commands/bench_report.py
+import random
+import time as _time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from app.models import Asset, Transfer, User
+from app.services import _q, compute_user_report
+
+
+def _legacy_report_buckets(target_user_id, display_per_usd):
+    # المسار السابق: تحميل كل المناقلات والتجميع في بايثون (للمقارنة فقط)
+    def usd_to_display(amount_usd):
+        return _q((amount_usd or Decimal("0")) * display_per_usd)
+
+    def base_bucket():
+        return {
+            "gold":   {"quantity_gram": Decimal("0"), "value_usd": Decimal("0"), "value_display": Decimal("0")},
+            "silver": {"quantity_gram": Decimal("0"), "value_usd": Decimal("0"), "value_display": Decimal("0")},
+            "money":  {"value_usd": Decimal("0"), "value_display": Decimal("0")},
+        }
+
+    buckets = {"ADD": base_bucket(), "WITHDRAW": base_bucket(), "ZAKAT_OUT": base_bucket()}
+    for t in Transfer.objects.select_related("asset").filter(user_id=target_user_id):
+        a = t.asset
+        if not a or not a.is_active:
+            continue
+        cls = (a.name or "").strip().lower()
+        if cls not in ("gold", "silver", "money") or t.transfer_type not in buckets:
+            continue
+        qty = t.quantity or Decimal("0")
+        b = buckets[t.transfer_type][cls]
+        if cls != "money":
+            b["quantity_gram"] += qty
+        b["value_usd"] += qty * (a.unit_price_usd or Decimal("0"))
+
+    for bucket in buckets.values():
+        for cls, b in bucket.items():
+            if cls != "money":
+                b["quantity_gram"] = _q(b["quantity_gram"])
+            b["value_usd"] = _q(b["value_usd"])
+            b["value_display"] = usd_to_display(b["value_usd"])
+    return buckets["ADD"], buckets["WITHDRAW"], buckets["ZAKAT_OUT"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark compute_user_report (DB aggregation) against the previous Python loop "
+        "on a synthetic user. Data is created inside a transaction and rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transfers", type=int, default=100000)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self._run(options)
+            transaction.set_rollback(True)
+
+    def _run(self, options):
+        rnd = random.Random(options["seed"])
+        assets = list(Asset.objects.filter(is_active=True, name__in=["Gold", "Silver", "Money"]))
+        if not assets:
+            self.stdout.write(self.style.ERROR("❌ No active assets; run seed_assets_basic first."))
+            return
+
+        user = User.objects.create_user(
+            username="bench-report", email="bench-report@example.invalid", password=None, full_name="bench",
+        )
+        start = timezone.now() - timedelta(days=3650)
+        n = options["transfers"]
+        batch = []
+        for i in range(n):
+            batch.append(Transfer(
+                user=user, asset=rnd.choice(assets),
+                transfer_type=rnd.choices(["ADD", "WITHDRAW", "ZAKAT_OUT"], [6, 3, 1])[0],
+                quantity=Decimal(rnd.randint(1, 50_000_000)) / Decimal(10_000),
+                transfer_date=start + timedelta(minutes=i * 5),
+            ))
+            if len(batch) == 5000:
+                Transfer.objects.bulk_create(batch)
+                batch = []
+        Transfer.objects.bulk_create(batch)
+
+        def best(fn):
+            times = []
+            for _ in range(options["repeat"]):
+                t0 = _time.perf_counter()
+                result = fn()
+                times.append(_time.perf_counter() - t0)
+            return min(times), result
+
+        new_t, report = best(lambda: compute_user_report(user, user.id))
+        per_usd = Decimal(report["fx_line"].split(" = ")[1].split(" ")[0])
+        old_t, legacy = best(lambda: _legacy_report_buckets(user.id, per_usd))
+
+        self.stdout.write(f"transfers={n} db={connection.vendor}")
+        self.stdout.write(f"python loop    : {old_t * 1000:.1f} ms")
+        self.stdout.write(f"db aggregation : {new_t * 1000:.1f} ms")
+        self.stdout.write(f"speedup        : x{(old_t / new_t) if new_t else float('inf'):.1f}")
+        if (report["added"], report["withdrawn"], report["zakat_out"]) == legacy:
+            self.stdout.write(self.style.SUCCESS("✅ Results identical."))
+        else:
+            self.stdout.write(self.style.ERROR("❌ Results differ between implementations."))
+            self.stdout.write(str(legacy))
+            self.stdout.write(str((report["added"], report["withdrawn"], report["zakat_out"])))
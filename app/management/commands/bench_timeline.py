@@ -0,0 +1,87 @@
+# app/management/commands/bench_timeline.py
+import random
+import time as _time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.conf import ZAKAT_HAUL_DAYS, ZAKAT_RATE
+from app.services import DEC6, Timeline, compute_overdue_zakat_cycles
+
+
+def _legacy_value_at(timeline, dt):
+    # البحث الخطي السابق (للمقارنة فقط)
+    last = Decimal("0")
+    for ts, val in timeline:
+        if ts <= dt:
+            last = val
+        else:
+            break
+    return DEC6(last)
+
+
+def _legacy_overdue_cycles(timeline, start, nisab_usd):
+    now = timezone.now()
+    days_since_start = (now - start).days
+    if days_since_start < ZAKAT_HAUL_DAYS:
+        return []
+    cycles = []
+    for i in range(1, days_since_start // ZAKAT_HAUL_DAYS + 1):
+        due_at = start + timedelta(days=ZAKAT_HAUL_DAYS * i)
+        if due_at > now:
+            break
+        val_at_due = _legacy_value_at(timeline, due_at)
+        if val_at_due < nisab_usd:
+            break
+        cycles.append({"due_at": due_at, "required_usd": DEC6(val_at_due * Decimal(str(ZAKAT_RATE)))})
+    return cycles
+
+
+class Command(BaseCommand):
+    help = "Benchmark linear vs bisect/merge-walk timeline lookups on a synthetic transfer history (no DB access)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transfers", type=int, default=50000)
+        parser.add_argument("--years", type=int, default=40)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options["seed"])
+        n = options["transfers"]
+        now = timezone.now()
+        start = now - timedelta(days=365 * options["years"])
+        step = (now - start) / n
+
+        # تاريخ صاعد فوق النصاب دائمًا كي تُحسب كل الحوالات
+        points, running, ts = [], Decimal("10000"), start
+        for _ in range(n):
+            ts = ts + step
+            running = DEC6(running + Decimal(rnd.randint(-500, 1000)) / 100)
+            points.append((ts, running))
+        timeline_list = points
+        timeline = Timeline(points)
+        nisab = Decimal("1000")
+        first = points[0][0]
+
+        def best(fn):
+            times = []
+            for _ in range(options["repeat"]):
+                t0 = _time.perf_counter()
+                result = fn()
+                times.append(_time.perf_counter() - t0)
+            return min(times), result
+
+        old_t, old_res = best(lambda: _legacy_overdue_cycles(timeline_list, first, nisab))
+        new_t, new_res = best(lambda: compute_overdue_zakat_cycles(timeline, first, nisab))
+
+        self.stdout.write(f"transfers={n} cycles={len(new_res)}")
+        self.stdout.write(f"linear scan      : {old_t * 1000:.2f} ms")
+        self.stdout.write(f"bisect/merge-walk: {new_t * 1000:.2f} ms")
+        self.stdout.write(f"speedup          : x{(old_t / new_t) if new_t else float('inf'):.1f}")
+        if old_res != new_res:
+            self.stdout.write(self.style.ERROR("❌ Results differ between implementations."))
+        else:
+            self.stdout.write(self.style.SUCCESS("✅ Results identical."))
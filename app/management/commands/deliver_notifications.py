@@ -0,0 +1,45 @@
+# app/management/commands/deliver_notifications.py
+import json
+import time as _time
+
+from django.core.management.base import BaseCommand
+
+from app.reminders import deliver_notifications
+
+
+class Command(BaseCommand):
+    help = "Local outbox consumer: deliver pending reminders as JSON lines to stdout or a file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=100, help="Messages per batch.")
+        parser.add_argument("--file", help="Append to this path instead of stdout.")
+        parser.add_argument("--watch", type=float, default=0,
+                            help="Keep polling every N seconds instead of exiting when the outbox is empty.")
+
+    def handle(self, *args, **options):
+        out = open(options["file"], "a", encoding="utf-8") if options["file"] else self.stdout
+
+        def send(n):
+            out.write(json.dumps({
+                "id": n.id, "user_id": n.user_id, "email": n.user.email, "kind": n.kind,
+                "due_at": n.due_at.isoformat(), "offset_days": n.offset_days, "message": n.message,
+            }, ensure_ascii=False) + "\n")
+            out.flush()
+
+        total_sent = total_failed = 0
+        try:
+            while True:
+                sent, failed = deliver_notifications(send, limit=options["limit"])
+                total_sent += sent
+                total_failed += failed
+                if sent or failed:
+                    continue
+                if not options["watch"]:
+                    break
+                _time.sleep(options["watch"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if options["file"]:
+                out.close()
+        self.stderr.write(self.style.SUCCESS(f"✅ delivered={total_sent} failed={total_failed}"))
@@ -0,0 +1,32 @@
+# app/management/commands/export_ledger.py
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.exports import EXPORT_FORMATS, iter_export_lines
+from app.models import User
+
+
+class Command(BaseCommand):
+    help = "Stream a user's full ledger (transfers with USD/display values + haul cycles) as CSV or JSON Lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument("user", help="User id or email.")
+        parser.add_argument("--output", choices=EXPORT_FORMATS, default="csv")
+        parser.add_argument("--file", help="Write to this path instead of stdout.")
+
+    def handle(self, *args, **options):
+        ident = options["user"]
+        lookup = {"id": int(ident)} if ident.isdigit() else {"email": ident}
+        user = User.objects.filter(**lookup).first()
+        if user is None:
+            raise CommandError(f"User not found: {ident}")
+
+        out = open(options["file"], "w", encoding="utf-8", newline="") if options["file"] else sys.stdout
+        try:
+            for line in iter_export_lines(user, options["output"]):
+                out.write(line)
+        finally:
+            if options["file"]:
+                out.close()
+                self.stderr.write(self.style.SUCCESS(f"✅ Ledger exported to {options['file']}"))
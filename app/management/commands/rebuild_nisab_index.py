@@ -0,0 +1,19 @@
+# app/management/commands/rebuild_nisab_index.py
+from django.core.management.base import BaseCommand
+
+from app.conf import NISAB_INDEX_CHUNK_SIZE
+from app.nisab_index import rebuild_nisab_index
+
+
+class Command(BaseCommand):
+    help = ("Re-base the nisab margin index on current prices and re-evaluate every user with holdings "
+            "(records haul start/reset events for anyone whose side of nisab changed). Run nightly.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=NISAB_INDEX_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        stats = rebuild_nisab_index(chunk_size=max(1, options["chunk_size"]))
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Re-indexed {stats['evaluated']} users, {stats['events']} nisab crossings recorded"
+        ))
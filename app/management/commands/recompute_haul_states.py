@@ -0,0 +1,66 @@
+# app/management/commands/recompute_haul_states.py
+import time as _time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.batch import batch_overdue_cycles, batch_window, batch_haul, load_ledger_columns, recompute_haul_states
+from app.fixed import to_micro
+from app.models import User
+from app.registry import get_asset_registry
+from app.services import (
+    HAUL_KINDS, compute_overdue_zakat_cycles, haul_nisab_usd, haul_window_from_timeline, load_user_ledger,
+)
+
+
+class Command(BaseCommand):
+    help = "Nightly batch recomputation of haul states for all users (vectorized NumPy engine, chunked by user)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--user", type=int, action="append", help="Only these user ids (repeatable).")
+        parser.add_argument("--verify", action="store_true",
+                            help="Compare each user against the per-user timeline path and report mismatches.")
+
+    def handle(self, *args, **options):
+        qs = User.objects.order_by("id")
+        if options["user"]:
+            qs = qs.filter(id__in=options["user"])
+        user_ids = list(qs.values_list("id", flat=True))
+        registry = get_asset_registry()
+        chunk = max(1, options["chunk_size"])
+
+        t0 = _time.perf_counter()
+        written = mismatches = 0
+        for i in range(0, len(user_ids), chunk):
+            ids = user_ids[i:i + chunk]
+            now = timezone.now()
+            written += recompute_haul_states(ids, registry, now)
+            if options["verify"]:
+                mismatches += self.verify(ids, registry, now)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {len(user_ids)} users, {written} haul states in {_time.perf_counter() - t0:.2f}s"
+        ))
+        if options["verify"]:
+            style = self.style.SUCCESS if not mismatches else self.style.ERROR
+            self.stdout.write(style(f"verify: {mismatches} mismatches"))
+
+    def verify(self, ids, registry, now):
+        cols = load_ledger_columns(ids, registry)
+        mismatches = 0
+        for kind, kinds in HAUL_KINDS.items():
+            nisab = haul_nisab_usd(kind, registry.assets)
+            results = batch_haul(cols.select(kinds), to_micro(nisab), now)
+            for user in User.objects.filter(id__in=ids):
+                _running, timeline = load_user_ledger(user, kinds).timeline(kinds)
+                res = results.get(user.id)
+                window = haul_window_from_timeline(timeline, nisab)
+                expected = (compute_overdue_zakat_cycles(timeline, window["haul_started_at"], nisab)
+                            if window["haul_started_at"] else [])
+                got = [{"due_at": c["due_at"], "required_usd": c["required_usd"]}
+                       for c in batch_overdue_cycles(res, to_micro(nisab))]
+                if window["haul_started_at"] != batch_window(res)["haul_started_at"] or got != expected:
+                    mismatches += 1
+                    self.stderr.write(f"mismatch: user={user.id} kind={kind}")
+        return mismatches
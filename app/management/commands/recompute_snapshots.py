@@ -0,0 +1,83 @@
+# app/management/commands/recompute_snapshots.py
+import os
+import time as _time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from app.summaries import recompute_user_summaries, users_to_recompute
+
+
+def _init_worker():
+    # كل عامل يفتح اتصاله الخاص بالقاعدة عند أول استعلام (spawn/forkserver يحتاجان setup)
+    django.setup()
+
+
+def _run_chunk(user_ids):
+    return recompute_user_summaries(user_ids)
+
+
+def _parse_since(value):
+    dt = parse_datetime(value)
+    if dt is None:
+        d = parse_date(value)
+        if d is None:
+            raise CommandError(f"Invalid --since value: {value}")
+        dt = timezone.datetime.combine(d, timezone.datetime.min.time())
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt
+
+
+class Command(BaseCommand):
+    help = ("Recompute every user's zakat snapshot into UserSummary using a process pool. "
+            "Resumable: users whose summary is already current are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                            help="Worker processes (0 = run in this process).")
+        parser.add_argument("--chunk-size", type=int, default=200)
+        parser.add_argument("--since", help="Only users with transfers or repriced holdings since this date/datetime.")
+        parser.add_argument("--force", action="store_true", help="Recompute even current summaries.")
+
+    def handle(self, *args, **options):
+        since = _parse_since(options["since"]) if options["since"] else None
+        user_ids = users_to_recompute(since=since, force=options["force"])
+        total = len(user_ids)
+        if not total:
+            self.stdout.write(self.style.SUCCESS("✅ All summaries are current"))
+            return
+
+        size = max(1, options["chunk_size"])
+        chunks = [user_ids[i:i + size] for i in range(0, total, size)]
+        workers = options["workers"]
+        self.stdout.write(f"{total} users in {len(chunks)} chunks, workers={workers or 'inline'}")
+
+        t0 = _time.perf_counter()
+        done = 0
+        if workers <= 0:
+            for chunk in chunks:
+                done += recompute_user_summaries(chunk)
+                self.progress(done, total, t0)
+        else:
+            # لا نورّث اتصالات مفتوحة للعمليات الفرعية
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+                futures = [pool.submit(_run_chunk, chunk) for chunk in chunks]
+                for future in as_completed(futures):
+                    done += future.result()
+                    self.progress(done, total, t0)
+
+        elapsed = _time.perf_counter() - t0
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {done} summaries in {elapsed:.2f}s ({done / elapsed if elapsed else 0:.1f} users/s)"
+        ))
+
+    def progress(self, done, total, t0):
+        elapsed = _time.perf_counter() - t0
+        rate = done / elapsed if elapsed else 0
+        self.stdout.write(f"  [{done}/{total}] {rate:.1f} users/s")
@@ -0,0 +1,25 @@
+# app/management/commands/reconcile_holdings.py
+from django.core.management.base import BaseCommand
+
+from app.services import reconcile_holdings
+
+
+class Command(BaseCommand):
+    help = "Compare the Holding table with net quantities aggregated from Transfer; optionally repair drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, action="append", help="Only these user ids (repeatable).")
+        parser.add_argument("--repair", action="store_true", help="Rewrite drifted rows from the Transfer aggregates.")
+
+    def handle(self, *args, **options):
+        drift = reconcile_holdings(options["user"], repair=options["repair"])
+        for d in drift:
+            self.stdout.write(
+                f"user={d['user_id']} asset={d['asset_id']} expected={d['expected']} actual={d['actual']}"
+            )
+        if not drift:
+            self.stdout.write(self.style.SUCCESS("✅ Holdings match transfers"))
+        elif options["repair"]:
+            self.stdout.write(self.style.SUCCESS(f"✅ Repaired {len(drift)} drifted holdings"))
+        else:
+            self.stdout.write(self.style.ERROR(f"❌ {len(drift)} drifted holdings (run with --repair)"))
@@ -0,0 +1,30 @@
+# app/management/commands/refresh_rates.py
+from django.core.management.base import BaseCommand
+
+from app.rate_refresh import request_refresh
+
+
+class Command(BaseCommand):
+    help = ("Fetch FX (ER-API) and metal (metalpriceapi) rates concurrently and apply both "
+            "in one transaction, coordinated with the other rate refreshes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Refresh even if the last result is still fresh.")
+
+    def handle(self, *args, **options):
+        res = request_refresh("rates", force=options["force"], background=False)
+        result = res["result"]
+        if not res["started"]:
+            self.stdout.write(self.style.SUCCESS(
+                f"✅ Rate refresh skipped ({'fresh' if res['status'] == 'ok' else 'in progress'})."
+            ))
+        elif result.get("status") == "ok":
+            self.stdout.write(self.style.SUCCESS(f"✅ Rates updated (price version {result['price_version']})."))
+        elif result.get("status") == "partial":
+            self.stdout.write(self.style.WARNING(
+                f"⚠️ Rates partially updated (price version {result['price_version']}): {result.get('message')}"
+            ))
+        else:
+            self.stdout.write(self.style.ERROR(f"❌ Rate refresh {result.get('status')}: {result.get('message')}"))
+        for name, report in (result.get("providers") or {}).items():
+            self.stdout.write(f"  {name}: {report.get('status')} {report.get('message')}")
@@ -0,0 +1,19 @@
+# app/management/commands/schedule_reminders.py
+from django.core.management.base import BaseCommand
+
+from app.reminders import refresh_stale_haul_states, schedule_zakat_reminders
+
+
+class Command(BaseCommand):
+    help = "Daily job: queue zakat reminders (30/15/7/0 days before due) into the notification outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--no-refresh", action="store_true",
+                            help="Skip rebuilding haul states that are stale or missing before scheduling.")
+
+    def handle(self, *args, **options):
+        if not options["no_refresh"]:
+            refreshed = refresh_stale_haul_states()
+            self.stdout.write(f"refreshed haul states for {refreshed} users")
+        queued = schedule_zakat_reminders()
+        self.stdout.write(self.style.SUCCESS(f"✅ {queued} reminders due today (already queued ones are skipped)"))
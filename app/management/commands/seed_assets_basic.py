@@ -1,7 +1,9 @@
 # app/management/commands/seed_assets_basic.py
 from django.core.management.base import BaseCommand
 from decimal import Decimal
-from app.models import Asset
+from django.utils import timezone
+from app.models import Asset, AssetPrice
+from app.caching import bump_price_version
 
 
 class Command(BaseCommand):
@@ -60,6 +62,11 @@ class Command(BaseCommand):
 
         all_assets = metals + currencies
 
+        # الأسعار قبل البذر: نضيف نقطة للسجل التاريخي فقط للأصول الجديدة أو التي تغيّر سعرها
+        before = dict(Asset.objects.values_list("asset_code", "unit_price_usd"))
+        now = timezone.now()
+        history = []
+
         for code, name, a_type, unit, country, price in all_assets:
             obj, created = Asset.objects.update_or_create(
                 asset_code=code,
@@ -72,7 +79,11 @@ class Command(BaseCommand):
                     "is_active": True,
                 },
             )
+            if created or before.get(code) != price:
+                history.append(AssetPrice(asset=obj, price_usd=price, effective_at=now, source="seed"))
             status = "Created" if created else "Updated"
             self.stdout.write(f"{status}: {code} ({price} USD per {unit})")
 
+        AssetPrice.objects.bulk_create(history)
+        bump_price_version()
         self.stdout.write(self.style.SUCCESS("✅ Asset table seeded successfully with codes."))
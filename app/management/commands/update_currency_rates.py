@@ -1,14 +1,21 @@
 from django.core.management.base import BaseCommand
-from app.services import update_currency_assets_from_erapi
+from app.rate_refresh import request_refresh
 
 class Command(BaseCommand):
     help = "Fetch FX rates from ER-API and update Money assets (unit_price_usd)."
 
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Refresh even if the last result is still fresh.")
+
     def handle(self, *args, **options):
-        res = update_currency_assets_from_erapi()
+        res = request_refresh("currencies", force=options["force"], background=False)
         status = res.get("status")
-        if status == "ok":
+        if status == "ok" and res["started"]:
             self.stdout.write(self.style.SUCCESS("✅ Currency rates updated."))
+        elif status in ("ok", "running"):
+            self.stdout.write(self.style.SUCCESS(f"✅ Currency refresh skipped ({'fresh' if status == 'ok' else 'in progress'})."))
         else:
             self.stdout.write(self.style.ERROR("❌ Currency update failed. See details below."))
-        self.stdout.write(str(res))
+        for warning in res["warning"]:
+            self.stdout.write(self.style.WARNING(f"⚠️ {warning}"))
+        self.stdout.write(str(res["result"]))
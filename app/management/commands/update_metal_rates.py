@@ -1,16 +1,21 @@
 from django.core.management.base import BaseCommand
-from django.conf import settings
-from app.services import update_metals_assets_from_metalpriceapi
+from app.rate_refresh import request_refresh
 
 class Command(BaseCommand):
     help = "Fetch metal prices (gold/silver) from metalpriceapi and update metal assets (USD/gram)."
 
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Refresh even if the last result is still fresh.")
+
     def handle(self, *args, **options):
-        api_key = 'd9aac6787678279fbb25f9098ab579cc'
-        res = update_metals_assets_from_metalpriceapi(api_key=api_key)
+        res = request_refresh("metals", force=options["force"], background=False)
         status = res.get("status")
-        if status == "ok":
+        if status == "ok" and res["started"]:
             self.stdout.write(self.style.SUCCESS("✅ Metal rates updated."))
+        elif status in ("ok", "running"):
+            self.stdout.write(self.style.SUCCESS(f"✅ Metal refresh skipped ({'fresh' if status == 'ok' else 'in progress'})."))
         else:
             self.stdout.write(self.style.ERROR("❌ Metal update failed. See details below."))
-        self.stdout.write(str(res))
+        for warning in res["warning"]:
+            self.stdout.write(self.style.WARNING(f"⚠️ {warning}"))
+        self.stdout.write(str(res["result"]))
@@ -0,0 +1,52 @@
+# app/management/commands/valuation_history.py
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from app.models import User
+from app.services import HAUL_KINDS, load_price_history, load_user_ledger
+
+
+def _parse_at(value):
+    dt = parse_datetime(value)
+    if dt is None:
+        d = parse_date(value)
+        if d is None:
+            raise CommandError(f"Invalid --at value: {value}")
+        dt = timezone.datetime.combine(d, timezone.datetime.max.time())
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt
+
+
+class Command(BaseCommand):
+    help = ("Historical valuation of a user's class: the timeline valued at the prices in effect at each "
+            "moment (AssetPrice history) next to the same holdings at current prices, as CSV.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("user", help="User id or email.")
+        parser.add_argument("--class", dest="kind", choices=sorted(HAUL_KINDS), default="combined")
+        parser.add_argument("--at", help="Only the value at this date/datetime (end of day for a date).")
+
+    def handle(self, *args, **options):
+        ident = options["user"]
+        lookup = {"id": int(ident)} if ident.isdigit() else {"email": ident}
+        user = User.objects.filter(**lookup).first()
+        if user is None:
+            raise CommandError(f"User not found: {ident}")
+
+        kinds = HAUL_KINDS[options["kind"]]
+        ledger = load_user_ledger(user, kinds)
+        at = _parse_at(options["at"]) if options["at"] else None
+        # استعلام واحد لنقاط الأسعار (حتى at إن أُعطي) ثم مرور دمج واحد
+        history = load_price_history(ledger.assets_for(kinds), until=at)
+        _, asof = ledger.asof_timeline(kinds, history)
+        _, current = ledger.timeline(kinds)
+
+        times = [at] if at is not None else asof.times
+        writer = csv.writer(self.stdout, lineterminator="\n")
+        writer.writerow(["at", "value_usd", "value_current_prices_usd"])
+        for ts, value, value_now in zip(times, asof.values_at(times), current.values_at(times)):
+            writer.writerow([ts.isoformat(), value, value_now])
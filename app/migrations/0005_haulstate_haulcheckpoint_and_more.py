@@ -0,0 +1,58 @@
+# Generated by Django 5.0.6 on 2026-10-17 22:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_transfer_bill_alter_asset_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HaulState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('gold', 'gold'), ('silver', 'silver'), ('money', 'money'), ('combined', 'combined')], max_length=10)),
+                ('prices_key', models.CharField(max_length=40)),
+                ('running_usd', models.DecimalField(decimal_places=6, default=0, max_digits=18)),
+                ('haul_started_at', models.DateTimeField(blank=True, null=True)),
+                ('last_transfer_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_transfer_date', models.DateTimeField(blank=True, null=True)),
+                ('settled_cycles', models.JSONField(blank=True, default=list)),
+                ('transfers_since_checkpoint', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='haul_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Haul State',
+                'verbose_name_plural': 'Haul States',
+            },
+        ),
+        migrations.CreateModel(
+            name='HaulCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('gold', 'gold'), ('silver', 'silver'), ('money', 'money'), ('combined', 'combined')], max_length=10)),
+                ('prices_key', models.CharField(max_length=40)),
+                ('transfer_id', models.BigIntegerField()),
+                ('transfer_date', models.DateTimeField()),
+                ('running_usd', models.DecimalField(decimal_places=6, max_digits=18)),
+                ('haul_started_at', models.DateTimeField(blank=True, null=True)),
+                ('settled_cycles', models.JSONField(blank=True, default=list)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='haul_checkpoints', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Haul Checkpoint',
+                'verbose_name_plural': 'Haul Checkpoints',
+                'indexes': [models.Index(fields=['user', 'kind', 'transfer_date'], name='app_haulche_user_id_1d01e0_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='haulstate',
+            constraint=models.UniqueConstraint(fields=('user', 'kind'), name='uniq_haul_state_user_kind'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.6 on 2026-10-17 22:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_dataversion_user_ledger_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transfer',
+            name='client_key',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Client Key'),
+        ),
+        migrations.AddConstraint(
+            model_name='transfer',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_key__isnull', False)), fields=('user', 'client_key'), name='uniq_transfer_user_client_key'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-17 22:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_transfer_client_key_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('old_price_usd', models.DecimalField(blank=True, decimal_places=6, max_digits=18, null=True)),
+                ('new_price_usd', models.DecimalField(decimal_places=6, max_digits=18)),
+                ('price_version', models.PositiveBigIntegerField()),
+                ('source', models.CharField(max_length=30)),
+                ('changed_at', models.DateTimeField(auto_now_add=True)),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_changes', to='app.asset')),
+            ],
+            options={
+                'verbose_name': 'Price Change',
+                'verbose_name_plural': 'Price Changes',
+                'indexes': [models.Index(fields=['price_version'], name='app_pricech_price_v_20958f_idx'), models.Index(fields=['changed_at'], name='app_pricech_changed_e9eb3a_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.0.6 on 2026-10-17 22:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_current_prices(apps, schema_editor):
+    # نقطة أولى لكل أصل بسعره الحالي: ما قبلها يُقيَّم بهذا السعر كما كان يحدث سابقًا
+    Asset = apps.get_model("app", "Asset")
+    AssetPrice = apps.get_model("app", "AssetPrice")
+    now = timezone.now()
+    AssetPrice.objects.bulk_create([
+        AssetPrice(asset_id=asset_id, price_usd=price, effective_at=now, source="backfill")
+        for asset_id, price in Asset.objects.values_list("id", "unit_price_usd")
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_pricechange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price_usd', models.DecimalField(decimal_places=6, max_digits=18)),
+                ('effective_at', models.DateTimeField()),
+                ('source', models.CharField(max_length=30)),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_history', to='app.asset')),
+            ],
+            options={
+                'verbose_name': 'Asset Price',
+                'verbose_name_plural': 'Asset Prices',
+                'indexes': [models.Index(fields=['asset', 'effective_at'], name='app_assetpr_asset_i_1a9e70_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_current_prices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:00
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_assetprice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('ledger_version', models.PositiveIntegerField(default=0)),
+                ('price_version', models.PositiveBigIntegerField(default=0)),
+                ('computed_on', models.DateField()),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'User Summary',
+                'verbose_name_plural': 'User Summaries',
+            },
+        ),
+    ]
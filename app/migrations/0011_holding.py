@@ -0,0 +1,52 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:03
+
+import django.db.models.deletion
+from django.conf import settings
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def backfill_holdings(apps, schema_editor):
+    # الجمع في بايثون بـ Decimal (مطابق على كل القواعد) بمرور واحد على المناقلات
+    Transfer = apps.get_model("app", "Transfer")
+    Holding = apps.get_model("app", "Holding")
+    signs = {"ADD": 1, "WITHDRAW": -1, "ZAKAT_OUT": -1}
+    net = {}
+    rows = Transfer.objects.values_list("user_id", "asset_id", "transfer_type", "quantity")
+    for user_id, asset_id, ttype, qty in rows.iterator(chunk_size=5000):
+        key = (user_id, asset_id)
+        net[key] = net.get(key, Decimal("0")) + signs.get(ttype, 0) * qty
+    Holding.objects.bulk_create(
+        [Holding(user_id=u, asset_id=a, net_quantity=q) for (u, a), q in net.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_usersummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('net_quantity', models.DecimalField(decimal_places=6, default=0, max_digits=18)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holdings', to='app.asset')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holdings', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Holding',
+                'verbose_name_plural': 'Holdings',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='holding',
+            constraint=models.UniqueConstraint(fields=('user', 'asset'), name='uniq_holding_user_asset'),
+        ),
+        migrations.RunPython(backfill_holdings, migrations.RunPython.noop),
+    ]
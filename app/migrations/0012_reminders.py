@@ -0,0 +1,70 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:05
+
+import django.db.models.deletion
+from django.conf import settings
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_next_due(apps, schema_editor):
+    # أقرب موعد start + n × حول (354 يومًا) لم يمضِ بعد
+    HaulState = apps.get_model("app", "HaulState")
+    haul, now = timedelta(days=354), timezone.now()
+    states = list(HaulState.objects.filter(haul_started_at__isnull=False))
+    for state in states:
+        state.next_due_at = state.haul_started_at + haul * max(1, -(-(now - state.haul_started_at) // haul))
+    HaulState.objects.bulk_update(states, ["next_due_at"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_holding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=10)),
+                ('due_at', models.DateTimeField()),
+                ('offset_days', models.PositiveSmallIntegerField()),
+                ('message', models.CharField(max_length=240)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('sent', 'sent'), ('failed', 'failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.CharField(blank=True, default='', max_length=240)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Notification',
+                'verbose_name_plural': 'Notification Outbox',
+            },
+        ),
+        migrations.AddField(
+            model_name='haulstate',
+            name='next_due_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='haulstate',
+            index=models.Index(fields=['kind', 'next_due_at'], name='app_haulsta_kind_8dc95c_idx'),
+        ),
+        migrations.AddField(
+            model_name='notificationoutbox',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='notificationoutbox',
+            index=models.Index(fields=['status', 'id'], name='app_notific_status_ef19c9_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='notificationoutbox',
+            constraint=models.UniqueConstraint(fields=('user', 'kind', 'due_at', 'offset_days'), name='uniq_notification_reminder'),
+        ),
+        migrations.RunPython(backfill_next_due, migrations.RunPython.noop),
+    ]
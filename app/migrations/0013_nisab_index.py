@@ -0,0 +1,68 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_reminders'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NisabBase',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price_version', models.PositiveBigIntegerField()),
+                ('prices', models.JSONField(default=dict)),
+                ('nisab', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Nisab Index Base',
+                'verbose_name_plural': 'Nisab Index Bases',
+            },
+        ),
+        migrations.CreateModel(
+            name='HaulEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('gold', 'gold'), ('silver', 'silver'), ('money', 'money'), ('combined', 'combined')], max_length=10)),
+                ('event', models.CharField(choices=[('start', 'start'), ('reset', 'reset')], max_length=5)),
+                ('value_usd', models.DecimalField(decimal_places=6, max_digits=18)),
+                ('nisab_usd', models.DecimalField(decimal_places=6, max_digits=18)),
+                ('price_version', models.PositiveBigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='haul_events', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Haul Event',
+                'verbose_name_plural': 'Haul Events',
+                'indexes': [models.Index(fields=['user', 'created_at'], name='app_hauleve_user_id_6868e8_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='NisabMargin',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('gold', 'gold'), ('silver', 'silver'), ('money', 'money'), ('combined', 'combined')], max_length=10)),
+                ('ratio', models.FloatField(blank=True, null=True)),
+                ('above', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('base', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='margins', to='app.nisabbase')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='nisab_margins', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Nisab Margin',
+                'verbose_name_plural': 'Nisab Margins',
+                'indexes': [models.Index(fields=['kind', 'base', 'above', 'ratio'], name='app_nisabma_kind_95c160_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='nisabmargin',
+            constraint=models.UniqueConstraint(fields=('user', 'kind'), name='uniq_nisab_margin_user_kind'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:14
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_nisab_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateRefreshJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=20, unique=True)),
+                ('status', models.CharField(choices=[('idle', 'idle'), ('running', 'running'), ('ok', 'ok'), ('error', 'error')], default='idle', max_length=10)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('fresh_until', models.DateTimeField(blank=True, null=True)),
+                ('result', models.JSONField(blank=True, default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('runs', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Rate Refresh Job',
+                'verbose_name_plural': 'Rate Refresh Jobs',
+            },
+        ),
+    ]
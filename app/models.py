@@ -1,4 +1,5 @@
 # app/models.py
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator
@@ -76,6 +77,9 @@ class User(AbstractUser):
         help_text=_("Must point to an Asset with unit_name='amount'."),
     )
 
+    # يزداد مع كل تغيير في مناقلات المستخدم أو عملة عرضه (مفتاح كاش اللقطة)
+    ledger_version = models.PositiveIntegerField(default=0, editable=False)
+
     # نُبقي تسجيل الدخول بالبريد
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["username", "full_name"]  # سيُطلب عند createsuperuser
@@ -117,6 +121,8 @@ class Transfer(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     bill = models.ImageField(_("Bill"), upload_to="bills/", blank=True, null=True)
+    # مفتاح من العميل (offline) لمنع تكرار المناقلة عند إعادة إرسال الدفعة
+    client_key = models.CharField(_("Client Key"), max_length=64, null=True, blank=True)
     class Meta:
         verbose_name = _("Transfer")
         verbose_name_plural = _("Transfers")
@@ -125,6 +131,326 @@ class Transfer(models.Model):
             models.Index(fields=["user", "transfer_date"]),
             models.Index(fields=["asset", "transfer_type"]),
         ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "client_key"],
+                condition=models.Q(client_key__isnull=False),
+                name="uniq_transfer_user_client_key",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user} - {self.asset} - {self.get_transfer_type_display()} - {self.quantity}"
+
+
+class DataVersion(models.Model):
+    """
+    عدّادات نسخ عامة مشتركة بين كل العمليات (مثل "prices")؛ تُزاد عند تغيّر
+    البيانات المرجعية لإبطال الكاش المبني عليها.
+    """
+    key = models.CharField(max_length=40, unique=True)
+    value = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("Data Version")
+        verbose_name_plural = _("Data Versions")
+
+    def __str__(self):
+        return f"{self.key} = {self.value}"
+
+
+class HaulState(models.Model):
+    """
+    حالة الحول المحفوظة لكل مستخدم وفئة (تُحدَّث تزايديًا مع كل مناقلة):
+    القيمة الجارية بالدولار، بداية الحول، آخر مناقلة معالجة، والحوالات المستقرة.
+    prices_key بصمة أسعار أصول الفئة والنصاب وقت الحساب؛ إذا تغيّرت يُعاد البناء.
+    """
+    KIND_CHOICES = [
+        ("gold", "gold"),
+        ("silver", "silver"),
+        ("money", "money"),
+        ("combined", "combined"),
+    ]
+
+    user = models.ForeignKey("app.User", on_delete=models.CASCADE, related_name="haul_states")
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    prices_key = models.CharField(max_length=40)
+    running_usd = models.DecimalField(default=0, **DECIMAL_18_6)
+    haul_started_at = models.DateTimeField(null=True, blank=True)
+    last_transfer_id = models.BigIntegerField(null=True, blank=True)
+    last_transfer_date = models.DateTimeField(null=True, blank=True)
+    # [[due_at_iso, value_usd], ...] قيمة الرصيد عند كل موعد استحقاق مضى
+    settled_cycles = models.JSONField(default=list, blank=True)
+    transfers_since_checkpoint = models.PositiveIntegerField(default=0)
+    # موعد الاستحقاق القادم (haul_started_at + حول) — فهرس مجدول التذكيرات
+    next_due_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("Haul State")
+        verbose_name_plural = _("Haul States")
+        constraints = [
+            models.UniqueConstraint(fields=["user", "kind"], name="uniq_haul_state_user_kind"),
+        ]
+        indexes = [
+            models.Index(fields=["kind", "next_due_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.kind} - {self.haul_started_at}"
+
+
+class HaulCheckpoint(models.Model):
+    """
+    لقطة من حالة الحول بعد مناقلة معيّنة؛ عند تعديل مناقلة قديمة نعيد البناء
+    من أقرب لقطة قبل تاريخها بدل إعادة تشغيل كامل السجل.
+    """
+    user = models.ForeignKey("app.User", on_delete=models.CASCADE, related_name="haul_checkpoints")
+    kind = models.CharField(max_length=10, choices=HaulState.KIND_CHOICES)
+    prices_key = models.CharField(max_length=40)
+    transfer_id = models.BigIntegerField()
+    transfer_date = models.DateTimeField()
+    running_usd = models.DecimalField(**DECIMAL_18_6)
+    haul_started_at = models.DateTimeField(null=True, blank=True)
+    settled_cycles = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        verbose_name = _("Haul Checkpoint")
+        verbose_name_plural = _("Haul Checkpoints")
+        indexes = [
+            models.Index(fields=["user", "kind", "transfer_date"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.kind} @ {self.transfer_date}"
+
+
+class AssetPrice(models.Model):
+    """
+    سجل أسعار تاريخي (إضافة فقط): سعر الأصل بالدولار ابتداءً من effective_at.
+    السعر عند لحظة t هو آخر نقطة effective_at <= t لنفس الأصل.
+    """
+    asset = models.ForeignKey(Asset, on_delete=models.CASCADE, related_name="price_history")
+    price_usd = models.DecimalField(**DECIMAL_18_6)
+    effective_at = models.DateTimeField()
+    source = models.CharField(max_length=30)
+
+    class Meta:
+        verbose_name = _("Asset Price")
+        verbose_name_plural = _("Asset Prices")
+        indexes = [
+            models.Index(fields=["asset", "effective_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.asset_id} = {self.price_usd} @ {self.effective_at}"
+
+
+class PriceChange(models.Model):
+    """
+    سجل مختصر لتغيّرات أسعار الأصول: السعر القديم والجديد ونسخة الأسعار بعد التغيير،
+    ليعرف المستهلك (الكاش، إعادة الحساب) أي الأصول تحرّكت فعلًا منذ نسخة معيّنة.
+    """
+    asset = models.ForeignKey(Asset, on_delete=models.CASCADE, related_name="price_changes")
+    old_price_usd = models.DecimalField(null=True, blank=True, **DECIMAL_18_6)
+    new_price_usd = models.DecimalField(**DECIMAL_18_6)
+    price_version = models.PositiveBigIntegerField()
+    source = models.CharField(max_length=30)
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Price Change")
+        verbose_name_plural = _("Price Changes")
+        indexes = [
+            models.Index(fields=["price_version"]),
+            models.Index(fields=["changed_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.asset_id}: {self.old_price_usd} → {self.new_price_usd} (v{self.price_version})"
+
+
+class UserSummary(models.Model):
+    """
+    ملخص الزكاة المحسوب مسبقًا لكل مستخدم (نتيجة compute_user_snapshot) — يكتبه
+    أمر recompute_snapshots. صالح ما دامت نسخة دفتر المستخدم ونسخة الأسعار
+    وتاريخ الحساب كما هي (نفس مكوّنات مفتاح كاش اللقطة).
+    """
+    user = models.OneToOneField("app.User", on_delete=models.CASCADE, related_name="summary")
+    data = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    ledger_version = models.PositiveIntegerField(default=0)
+    price_version = models.PositiveBigIntegerField(default=0)
+    computed_on = models.DateField()
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("User Summary")
+        verbose_name_plural = _("User Summaries")
+
+    def __str__(self):
+        return f"{self.user_id} @ {self.computed_on} (v{self.ledger_version}/{self.price_version})"
+
+
+class Holding(models.Model):
+    """
+    صافي كمية كل أصل لكل مستخدم (ADD − WITHDRAW − ZAKAT_OUT)، مُحدَّث في نفس معاملة
+    حفظ/حذف المناقلة (app/holdings.py). المجاميع من Transfer تبقى مرجع المطابقة
+    (أمر reconcile_holdings).
+    """
+    user = models.ForeignKey("app.User", on_delete=models.CASCADE, related_name="holdings")
+    asset = models.ForeignKey(Asset, on_delete=models.CASCADE, related_name="holdings")
+    net_quantity = models.DecimalField(default=0, **DECIMAL_18_6)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("Holding")
+        verbose_name_plural = _("Holdings")
+        constraints = [
+            models.UniqueConstraint(fields=["user", "asset"], name="uniq_holding_user_asset"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.asset_id} = {self.net_quantity}"
+
+
+class NotificationOutbox(models.Model):
+    """
+    صندوق صادر للتذكيرات: يكتبه المجدول اليومي (schedule_reminders) ويستهلكه
+    أمر deliver_notifications. القيد الفريد يجعل إعادة تشغيل المجدول آمنة.
+    """
+    STATUS_CHOICES = [
+        ("pending", "pending"),
+        ("sent", "sent"),
+        ("failed", "failed"),
+    ]
+
+    user = models.ForeignKey("app.User", on_delete=models.CASCADE, related_name="notifications")
+    kind = models.CharField(max_length=10)
+    due_at = models.DateTimeField()
+    offset_days = models.PositiveSmallIntegerField()
+    message = models.CharField(max_length=240)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # بعد فشل الإرسال: لا تُعاد المحاولة قبل هذا الوقت (تراجع أُسّي)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.CharField(max_length=240, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _("Notification")
+        verbose_name_plural = _("Notification Outbox")
+        constraints = [
+            models.UniqueConstraint(fields=["user", "kind", "due_at", "offset_days"],
+                                    name="uniq_notification_reminder"),
+        ]
+        indexes = [
+            models.Index(fields=["status", "id"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.kind} - {self.offset_days}d ({self.status})"
+
+
+class NisabBase(models.Model):
+    """
+    أسعار "الأساس" لفهرس هامش النصاب (app/nisab_index.py): أسعار الأصول الفعّالة
+    والنصاب لكل نوع حول لحظة إعادة بناء الفهرس. الأحدث هو الأساس الحالي.
+    """
+    price_version = models.PositiveBigIntegerField()
+    prices = models.JSONField(default=dict)  # {asset_id: unit_price_usd}
+    nisab = models.JSONField(default=dict)   # {kind: nisab_usd}
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Nisab Index Base")
+        verbose_name_plural = _("Nisab Index Bases")
+
+    def __str__(self):
+        return f"base #{self.pk} (v{self.price_version})"
+
+
+class NisabMargin(models.Model):
+    """
+    هامش المستخدم من النصاب لكل نوع حول: ratio = قيمة أرصدته ÷ النصاب بأسعار الأساس
+    (فارغ إن لم يمكن حصره: كمية سالبة أو أصل خارج الأساس)، وabove = جانبه من النصاب
+    عند آخر تقييم فعلي. الفهرس (kind, base, above, ratio) يخدم استعلام النطاق بعد كل تحديث أسعار.
+    """
+    user = models.ForeignKey("app.User", on_delete=models.CASCADE, related_name="nisab_margins")
+    kind = models.CharField(max_length=10, choices=HaulState.KIND_CHOICES)
+    base = models.ForeignKey(NisabBase, on_delete=models.CASCADE, related_name="margins")
+    ratio = models.FloatField(null=True, blank=True)
+    above = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("Nisab Margin")
+        verbose_name_plural = _("Nisab Margins")
+        constraints = [
+            models.UniqueConstraint(fields=["user", "kind"], name="uniq_nisab_margin_user_kind"),
+        ]
+        indexes = [
+            models.Index(fields=["kind", "base", "above", "ratio"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.kind}: {self.ratio} ({'above' if self.above else 'below'})"
+
+
+class HaulEvent(models.Model):
+    """
+    عبور النصاب بسبب تحرّك الأسعار: start = صعد فوق النصاب (يبدأ الحول)،
+    reset = هبط تحته (ينقطع الحول). القيمة والنصاب بأسعار نسخة price_version.
+    """
+    EVENT_CHOICES = [
+        ("start", "start"),
+        ("reset", "reset"),
+    ]
+
+    user = models.ForeignKey("app.User", on_delete=models.CASCADE, related_name="haul_events")
+    kind = models.CharField(max_length=10, choices=HaulState.KIND_CHOICES)
+    event = models.CharField(max_length=5, choices=EVENT_CHOICES)
+    value_usd = models.DecimalField(**DECIMAL_18_6)
+    nisab_usd = models.DecimalField(**DECIMAL_18_6)
+    price_version = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Haul Event")
+        verbose_name_plural = _("Haul Events")
+        indexes = [
+            models.Index(fields=["user", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.kind} {self.event} (v{self.price_version})"
+
+
+class RateRefreshJob(models.Model):
+    """
+    صف قفل وحالة لكل مزوّد أسعار (app/rate_refresh.py): من ينجح في تحويله إلى running
+    بتحديث شرطي واحد هو من يتصل بالمزوّد؛ البقية يقرؤون حالته. fresh_until حد
+    صلاحية آخر نتيجة ناجحة.
+    """
+    STATUS_CHOICES = [
+        ("idle", "idle"),
+        ("running", "running"),
+        ("ok", "ok"),
+        ("error", "error"),
+    ]
+
+    provider = models.CharField(max_length=20, unique=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="idle")
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    fresh_until = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    runs = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _("Rate Refresh Job")
+        verbose_name_plural = _("Rate Refresh Jobs")
+
+    def __str__(self):
+        return f"{self.provider}: {self.status}"
@@ -0,0 +1,209 @@
+# app/nisab_index.py
+"""
+فهرس هامش النصاب: من عبر النصاب بعد تحديث الأسعار، بدون إعادة حساب كل المستخدمين.
+
+لكل (مستخدم، نوع حول) صف NisabMargin فيه:
+  - ratio: قيمة أرصدته (جدول Holding) ÷ النصاب، بأسعار أساس ثابتة (NisabBase)؛
+    لا يتغيّر إلا بتغيّر أرصدته
+  - above: جانبه من النصاب عند آخر تقييم فعلي بالأسعار الحالية
+قيمة الفئة خطية في الأسعار؛ فإن كانت الكميات موجبة كانت النسبة الحالية
+ratio × متوسطًا مرجّحًا لعوامل g_i = (سعر الأصل الآن ÷ سعره في الأساس) ÷ (النصاب الآن ÷ نصاب الأساس)
+أي محصورة في ratio × [g_min, g_max]. عند كل تحديث أسعار يكفي إذن استعلام نطاق مفهرس:
+  - تحت النصاب سابقًا و ratio ≥ 1/g_max   (ربما صعد)
+  - فوقه سابقًا و ratio < 1/g_min         (ربما هبط)
+  - صفوف غير محصورة (ratio فارغ) أو مبنية على أساس أقدم
+هؤلاء فقط يُقيَّمون بدقة (وحدات صغرى)، ومن تغيّر جانبه يُسجَّل له HaulEvent
+وتُعاد حالة حوله. كلما ابتعدت الأسعار عن الأساس اتسعت النافذة؛ rebuild_nisab_index
+يعيد الأساس إلى الأسعار الحالية (ليليًا، أو تلقائيًا عند تغيّر كتالوج الأصول).
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Q
+
+from .batch import recompute_haul_states
+from .conf import NISAB_INDEX_CHUNK_SIZE
+from .fixed import from_micro, mul_micro, to_micro
+from .models import HaulEvent, Holding, NisabBase, NisabMargin
+from .registry import AssetRegistry, get_asset_registry
+from .services import HAUL_KINDS, asset_kind, haul_nisab_usd
+
+# هامش أمان لمقارنة النسب العائمة في استعلام النطاق
+RATIO_EPSILON = 1e-9
+
+# (user_id, kind) → (ratio بأسعار الأساس أو None، above، القيمة الآن، النصاب الآن) بالوحدات الصغرى
+Margins = Dict[Tuple[int, str], Tuple[Optional[float], bool, int, int]]
+
+
+def current_base() -> Optional[NisabBase]:
+    return NisabBase.objects.order_by("-id").first()
+
+
+def evaluate_margins(user_ids: Iterable[int], registry: AssetRegistry, base: NisabBase) -> Margins:
+    """تقييم دقيق من جدول الأرصدة؛ الأنواع التي لا يملك فيها المستخدم شيئًا تُحذف من النتيجة."""
+    kind_of = {a.id: asset_kind(a) for a in registry.assets}
+    price = {a.id: to_micro(a.unit_price_usd) for a in registry.assets}
+    base_price = {int(asset_id): to_micro(p) for asset_id, p in base.prices.items()}
+    nisab = {kind: to_micro(haul_nisab_usd(kind, registry.assets)) for kind in HAUL_KINDS}
+    base_nisab = {kind: to_micro(base.nisab[kind]) for kind in HAUL_KINDS}
+
+    held: Dict[int, List[Tuple[str, int, int]]] = defaultdict(list)
+    rows = Holding.objects.filter(user_id__in=list(user_ids)).values_list("user_id", "asset_id", "net_quantity")
+    for user_id, asset_id, qty in rows:
+        if qty and asset_id in kind_of:
+            held[user_id].append((kind_of[asset_id], asset_id, to_micro(qty)))
+
+    out: Margins = {}
+    for user_id, items in held.items():
+        for kind, kinds in HAUL_KINDS.items():
+            value = base_value = 0
+            bounded, held_any = True, False
+            for asset_kind_, asset_id, qty in items:
+                if asset_kind_ not in kinds:
+                    continue
+                held_any = True
+                value += mul_micro(qty, price[asset_id])
+                bp = base_price.get(asset_id)
+                if qty < 0 or not bp:
+                    bounded = False
+                else:
+                    base_value += mul_micro(qty, bp)
+            if not held_any:
+                continue
+            ratio = base_value / base_nisab[kind] if bounded and base_nisab[kind] > 0 else None
+            out[(user_id, kind)] = (ratio, value >= nisab[kind], value, nisab[kind])
+    return out
+
+
+def write_margins(user_ids: List[int], margins: Margins, base: NisabBase,
+                  keys: Optional[List[Tuple[int, str]]] = None) -> None:
+    """يستبدل صفوف المستخدمين كلها، أو صفوف keys (مستخدم، نوع حول) وحدها إن أُعطيت."""
+    if keys is None:
+        stale = Q(user_id__in=user_ids)
+    else:
+        stale = Q(pk__in=[])
+        for user_id, kind in keys:
+            stale |= Q(user_id=user_id, kind=kind)
+        margins = {key: margins[key] for key in keys if key in margins}
+    with transaction.atomic():
+        NisabMargin.objects.filter(stale).delete()
+        NisabMargin.objects.bulk_create([
+            NisabMargin(user_id=user_id, kind=kind, base=base, ratio=ratio, above=above)
+            for (user_id, kind), (ratio, above, _, _) in margins.items()
+        ])
+
+
+def refresh_nisab_margins(holding_keys: Iterable[Tuple[int, int]]) -> None:
+    """
+    بعد تغيّر أرصدة (app/holdings.py)، holding_keys: (user_id, asset_id).
+    تُعاد كتابة صفوف أنواع الحول التي تضم تلك الأصول فقط؛ بقية صفوف المستخدم لم تتغيّر.
+    قبل أول بناء للفهرس لا شيء يُكتب.
+    """
+    holding_keys = set(holding_keys)
+    base = current_base() if holding_keys else None
+    if base is None:
+        return
+    registry = get_asset_registry()
+    kind_of = {a.id: asset_kind(a) for a in registry.assets}
+    keys = sorted({
+        (user_id, kind)
+        for user_id, asset_id in holding_keys
+        for kind, kinds in HAUL_KINDS.items()
+        if kind_of.get(asset_id) in kinds
+    })
+    if not keys:
+        return
+    user_ids = sorted({user_id for user_id, _ in keys})
+    write_margins(user_ids, evaluate_margins(user_ids, registry, base), base, keys)
+
+
+def crossing_window(kind: str, registry: AssetRegistry, base: NisabBase) -> Tuple[float, float]:
+    """(1/g_max, 1/g_min): خارج هذا المجال لا يمكن لنسبة محصورة أن تعبر النصاب."""
+    kinds = HAUL_KINDS[kind]
+    nisab_move = float(haul_nisab_usd(kind, registry.assets)) / float(base.nisab[kind])
+    moves = [
+        float(a.unit_price_usd) / float(base.prices[str(a.id)]) / nisab_move
+        for a in registry.assets
+        if asset_kind(a) in kinds and float(base.prices[str(a.id)]) > 0
+    ]
+    if not moves:
+        return float("inf"), 0.0
+    g_min, g_max = min(moves), max(moves)
+    lo = (1 / g_max) * (1 - RATIO_EPSILON) if g_max > 0 else float("inf")
+    hi = (1 / g_min) * (1 + RATIO_EPSILON) if g_min > 0 else float("inf")
+    return lo, hi
+
+
+def reevaluate_users(user_ids: List[int], registry: AssetRegistry, base: NisabBase,
+                     chunk_size: int = NISAB_INDEX_CHUNK_SIZE) -> Dict[str, int]:
+    """تقييم دقيق + كتابة الصفوف بالأساس المعطى + HaulEvent لمن تغيّر جانبه + إعادة حالة حوله."""
+    events = 0
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        before = {(u, k): above for u, k, above in
+                  NisabMargin.objects.filter(user_id__in=chunk).values_list("user_id", "kind", "above")}
+        margins = evaluate_margins(chunk, registry, base)
+        crossed = []
+        # بلا صف سابق لا نعرف جانبه (أول بناء للفهرس) فلا حدث
+        for key in sorted(before):
+            _, now_above, value, nisab = margins.get(key, (None, False, 0, 0))
+            if now_above == before[key]:
+                continue
+            if key not in margins:  # لم يعد يملك شيئًا من الفئة
+                nisab = to_micro(haul_nisab_usd(key[1], registry.assets))
+            crossed.append(HaulEvent(
+                user_id=key[0], kind=key[1], event="start" if now_above else "reset",
+                value_usd=from_micro(value), nisab_usd=from_micro(nisab), price_version=registry.version,
+            ))
+        with transaction.atomic():
+            write_margins(chunk, margins, base)
+            HaulEvent.objects.bulk_create(crossed)
+        if crossed:
+            recompute_haul_states(sorted({e.user_id for e in crossed}), registry)
+        events += len(crossed)
+    return {"evaluated": len(user_ids), "events": events}
+
+
+def rebuild_nisab_index(registry: Optional[AssetRegistry] = None,
+                        chunk_size: int = NISAB_INDEX_CHUNK_SIZE) -> Dict[str, int]:
+    """أساس جديد بالأسعار الحالية ثم تقييم كل من له أرصدة أو صف في الفهرس."""
+    registry = registry or get_asset_registry()
+    base = NisabBase.objects.create(
+        price_version=registry.version,
+        prices={str(a.id): str(a.unit_price_usd) for a in registry.assets},
+        nisab={kind: str(haul_nisab_usd(kind, registry.assets)) for kind in HAUL_KINDS},
+    )
+    user_ids = set(Holding.objects.exclude(net_quantity=0).values_list("user_id", flat=True).distinct())
+    user_ids |= set(NisabMargin.objects.values_list("user_id", flat=True).distinct())
+    stats = reevaluate_users(sorted(user_ids), registry, base, chunk_size)
+    stats["rebuilt"] = 1
+    return stats
+
+
+def process_price_tick(registry: Optional[AssetRegistry] = None,
+                       chunk_size: int = NISAB_INDEX_CHUNK_SIZE) -> Dict[str, int]:
+    """
+    بعد كل تحديث أسعار (apply_price_changes): يقيّم فقط من قد يكون عبر النصاب.
+    بلا أساس بعد، أو إن تغيّرت مجموعة الأصول الفعّالة، يُعاد بناء الفهرس كاملًا.
+    """
+    registry = registry or get_asset_registry()
+    base = current_base()
+    if base is None or set(base.prices) != {str(a.id) for a in registry.assets}:
+        return rebuild_nisab_index(registry, chunk_size)
+
+    candidates = set()
+    for kind in HAUL_KINDS:
+        lo, hi = crossing_window(kind, registry, base)
+        current = Q(kind=kind, base=base)
+        q = (current & Q(ratio__isnull=True)) | Q(kind=kind, base_id__lt=base.id)
+        if lo != float("inf"):
+            q |= current & Q(above=False, ratio__gte=lo)
+        if hi != float("inf"):
+            q |= current & Q(above=True, ratio__lt=hi)
+        else:
+            q |= current & Q(above=True)
+        candidates |= set(NisabMargin.objects.filter(q).values_list("user_id", flat=True))
+    stats = reevaluate_users(sorted(candidates), registry, base, chunk_size)
+    stats["rebuilt"] = 0
+    return stats
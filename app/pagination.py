@@ -0,0 +1,72 @@
+# app/pagination.py
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.utils.urls import replace_query_param
+
+from .utils import success_response
+
+
+class TransferKeysetPagination(BasePagination):
+    """
+    ترقيم بالمؤشر (keyset) على (transfer_date, id) تنازليًا — نفس Transfer.Meta.ordering
+    ويستفيد من فهرس (user, transfer_date). كلفة الصفحة ثابتة مهما تعمّقنا في السجل
+    (بعكس OFFSET).
+      ?page_size=20&cursor=<next_cursor>
+    """
+    page_size = 20
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    @staticmethod
+    def encode_cursor(transfer_date: datetime, transfer_id: int) -> str:
+        raw = f"{transfer_date.isoformat()}|{transfer_id}".encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+            date_part, id_part = raw.rsplit("|", 1)
+            return datetime.fromisoformat(date_part), int(id_part)
+        except (ValueError, UnicodeDecodeError):
+            raise ValidationError({"cursor": ["Invalid cursor."]})
+
+    def get_page_size(self, request) -> int:
+        value = request.query_params.get(self.page_size_query_param)
+        if value and value.isdigit() and int(value) > 0:
+            return min(int(value), self.max_page_size)
+        return self.page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        size = self.get_page_size(request)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            last_date, last_id = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(transfer_date__lt=last_date) | Q(transfer_date=last_date, id__lt=last_id)
+            )
+
+        rows = list(queryset.order_by("-transfer_date", "-id")[:size + 1])
+        has_next = len(rows) > size
+        rows = rows[:size]
+        self.next_cursor = self.encode_cursor(rows[-1].transfer_date, rows[-1].id) if has_next else None
+        return rows
+
+    def get_next_link(self):
+        if not self.next_cursor:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return success_response(data={
+            "results": data,
+            "next_cursor": self.next_cursor,
+            "next": self.get_next_link(),
+        })
@@ -0,0 +1,85 @@
+# app/prerendered.py
+import gzip
+import hashlib
+from typing import Dict, List, Optional
+
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+
+from .conditional import etag_matches, make_etag, not_modified
+
+try:  # اختياري: بدون الحزمة نكتفي بـ gzip
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# ترتيب التفضيل عند تساوي q في Accept-Encoding
+ENCODING_PREFERENCE = ("br", "gzip", "identity")
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """{"gzip": 1.0, "br": 0.5, ...} مع دعم q=0 و *."""
+    out: Dict[str, float] = {}
+    for item in (header or "").split(","):
+        parts = [p.strip() for p in item.split(";")]
+        coding = parts[0].lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        out[coding] = q
+    return out
+
+
+class PrerenderedDocument:
+    """
+    مستند JSON ثابت مُسلسل مرة واحدة لكل عملية داخل غلاف {"message","data"} المعتاد،
+    مع نسخ مضغوطة (gzip وbrotli إن توفّر) تُخدم مباشرة بدون serializer أو renderer.
+    """
+
+    def __init__(self, data, message: List[str], cache_control: str):
+        body = JSONRenderer().render({"message": message, "data": data})
+        self.cache_control = cache_control
+        self.variants: Dict[str, bytes] = {
+            "identity": body,
+            "gzip": gzip.compress(body, compresslevel=9, mtime=0),
+        }
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(body, quality=11)
+        # ETag قوي لكل تمثيل (البايتات تختلف بين الترميزات)
+        digest = hashlib.sha256(body).hexdigest()
+        self.etags: Dict[str, str] = {enc: make_etag(digest, enc) for enc in self.variants}
+
+    def choose_encoding(self, accept_encoding: Optional[str]) -> str:
+        accepted = parse_accept_encoding(accept_encoding or "")
+        wildcard = accepted.get("*")
+        best, best_q = "identity", -1.0
+        for enc in ENCODING_PREFERENCE:
+            if enc not in self.variants:
+                continue
+            q = accepted.get(enc, wildcard if wildcard is not None else (1.0 if enc == "identity" else 0.0))
+            if q > best_q and q > 0:
+                best, best_q = enc, q
+        return best
+
+    def response(self, request) -> HttpResponse:
+        encoding = self.choose_encoding(request.META.get("HTTP_ACCEPT_ENCODING"))
+        etag = self.etags[encoding]
+        if any(etag_matches(request, tag) for tag in self.etags.values()):
+            response = not_modified(etag, self.cache_control)
+        else:
+            response = HttpResponse(self.variants[encoding], content_type="application/json")
+            response["ETag"] = etag
+            response["Cache-Control"] = self.cache_control
+            if encoding != "identity":
+                response["Content-Encoding"] = encoding
+            response["Content-Length"] = str(len(self.variants[encoding]))
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return response
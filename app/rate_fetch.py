@@ -0,0 +1,373 @@
+# app/rate_fetch.py
+"""
+تحديث مُجمَّع لأسعار العملات والمعادن من مصادر قابلة للاستبدال (RATE_SOURCES):
+  - كل مصدر (RateSource) ينتمي لنوع: currencies أو metals، ويعيد حمولة بصيغة
+    مخطِّط ذلك النوع (plan_currency_changes / plan_metal_changes)
+  - مصادر النوع الواحد تُسأل معًا؛ أول حمولة تجتاز الفحص تفوز ولا ننتظر البقية:
+    المخطِّط يقبلها، لا سعر غير موجب، ولا تغيّر أكبر من outlier_limit (RATE_OUTLIER_MAX_CHANGE)
+    عن آخر سعر معروف لأصل سبق جلبه من مزوّد
+  - الجلب عبر Session واحدة مشتركة بمجمّع اتصالات keep-alive؛ أخطاء الشبكة
+    و5xx/429 تُعاد بتراجع أُسّي بعشوائية كاملة (RATE_FETCH_RETRIES)
+  - قاطع دائرة لكل مصدر داخل العملية: بعد RATE_BREAKER_FAILURES إخفاقات متتالية
+    (شبكة أو حمولة مرفوضة) لا نطلبه حتى تمضي RATE_BREAKER_RESET_SECONDS ثم محاولة واحدة
+  - الحمولة الفائزة تُحفظ على القرص؛ إن فشلت كل مصادر نوع تُستخدم آخر حمولة سليمة
+    أحدث من RATE_CACHE_MAX_AGE_SECONDS (بعد إعادة التشغيل أو أثناء الانقطاع)،
+    عدا أصول سُجّل لها سعر (AssetPrice) بعد حفظ تلك الحمولة
+  - ما نجح يُطبَّق بنداء apply_price_changes واحد: معاملة واحدة ونسخة أسعار واحدة
+"""
+import json
+import os
+import random
+import tempfile
+import threading
+import time as _time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import lru_cache
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+from .conf import (
+    RATE_BREAKER_FAILURES, RATE_BREAKER_RESET_SECONDS, RATE_CACHE_MAX_AGE_SECONDS,
+    RATE_FETCH_BACKOFF_SECONDS, RATE_FETCH_RETRIES, RATE_FETCH_WORKERS, RATE_HTTP_POOL_SIZE,
+    RATE_OUTLIER_MAX_CHANGE, RATE_OUTLIER_MAX_CHANGE_BY_CODE, RATE_SOURCES,
+)
+from .models import Asset, AssetPrice
+from .services import (
+    apply_price_changes, currency_rate_assets, fetch_erapi_payload, fetch_metal_payload, metal_rate_assets,
+    plan_currency_changes, plan_metal_changes,
+)
+
+RATE_PLANNERS: Dict[str, Callable] = {
+    "currencies": plan_currency_changes,
+    "metals": plan_metal_changes,
+}
+RATE_ASSETS: Dict[str, Callable[[], List[Asset]]] = {
+    "currencies": currency_rate_assets,
+    "metals": metal_rate_assets,
+}
+
+
+class RateSource:
+    """مصدر أسعار: name فريد، kind من RATE_PLANNERS، وfetch(http) تعيد الحمولة."""
+    name = ""
+    kind = ""
+
+    def fetch(self, http: requests.Session) -> dict:
+        raise NotImplementedError
+
+
+class ErApiSource(RateSource):
+    name, kind = "erapi", "currencies"
+
+    def fetch(self, http):
+        return fetch_erapi_payload(http)
+
+
+class MetalPriceApiSource(RateSource):
+    name, kind = "metalpriceapi", "metals"
+
+    def fetch(self, http):
+        # المفتاح من الإعدادات (متغيّر البيئة METALPRICE_API_KEY) وقت الطلب
+        if not settings.METALPRICE_API_KEY:
+            raise ImproperlyConfigured("METALPRICE_API_KEY is not set")
+        return fetch_metal_payload(settings.METALPRICE_API_KEY, http)
+
+
+@lru_cache(maxsize=None)
+def get_rate_sources() -> Dict[str, List[RateSource]]:
+    sources: Dict[str, List[RateSource]] = defaultdict(list)
+    for path in RATE_SOURCES:
+        source = import_string(path)()
+        sources[source.kind].append(source)
+    return dict(sources)
+
+
+class CircuitBreaker:
+    """closed → (إخفاقات متتالية) open → بعد reset_seconds محاولة واحدة (half-open) → closed/open."""
+
+    def __init__(self, failures: int = RATE_BREAKER_FAILURES, reset_seconds: float = RATE_BREAKER_RESET_SECONDS):
+        self.threshold = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if _time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if _time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self.opened_at = _time.monotonic()  # محاولة تجريبية واحدة؛ البقية تنتظر نتيجتها
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = _time.monotonic()
+
+
+BREAKERS: Dict[str, CircuitBreaker] = {}
+
+def breaker_for(name: str) -> CircuitBreaker:
+    return BREAKERS.setdefault(name, CircuitBreaker())
+
+
+_session: Optional[requests.Session] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_shared_lock = threading.Lock()
+
+
+def http_session() -> requests.Session:
+    global _session
+    with _shared_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(RATE_SOURCES), pool_maxsize=RATE_HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def fetch_executor() -> ThreadPoolExecutor:
+    # منفّذ مشترك طويل العمر: المصادر الخاسرة البطيئة تكمل فيه دون أن يُنتظر إغلاقه
+    global _executor
+    with _shared_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=RATE_FETCH_WORKERS, thread_name_prefix="rate-fetch")
+        return _executor
+
+
+def _retryable(exc: requests.RequestException) -> bool:
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(exc, "response", None)
+    return isinstance(exc, requests.HTTPError) and response is not None and (
+        response.status_code >= 500 or response.status_code == 429
+    )
+
+
+def fetch_with_retries(fetch: Callable[[], dict], retries: Optional[int] = None) -> dict:
+    retries = RATE_FETCH_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            return fetch()
+        except requests.RequestException as exc:
+            if attempt == retries or not _retryable(exc):
+                raise
+            _time.sleep(random.uniform(0, RATE_FETCH_BACKOFF_SECONDS * 2 ** attempt))
+
+
+# -------- فحص الحمولة --------
+class Accepted(NamedTuple):
+    source: str
+    payload: dict
+    changes: List[Tuple[Asset, Decimal]]
+    report: dict
+
+
+def tracked_asset_ids(assets: List[Asset]) -> Set[int]:
+    """أصول لها سعر سابق من مزوّد (لا من البذر): عليها فقط فحص القيم الشاذة."""
+    return set(AssetPrice.objects.filter(asset__in=assets).exclude(source="seed")
+               .values_list("asset_id", flat=True).distinct())
+
+
+def outlier_limit(asset_code: str) -> Decimal:
+    """نسبة التغيّر المقبولة للأصل: الخاصة به ثم العامة، والإعدادات تتجاوز قيم conf."""
+    by_code = getattr(settings, "RATE_OUTLIER_MAX_CHANGE_BY_CODE", RATE_OUTLIER_MAX_CHANGE_BY_CODE)
+    default = getattr(settings, "RATE_OUTLIER_MAX_CHANGE", RATE_OUTLIER_MAX_CHANGE)
+    return Decimal(str(by_code.get(asset_code, default)))
+
+
+def check_payload(kind: str, payload: dict, assets: List[Asset], tracked: Set[int]) -> Tuple[list, dict, List[str]]:
+    """(التغييرات، التقرير، المشاكل) — بلا استعلامات (الأصول مقروءة مسبقًا)."""
+    changes, report = RATE_PLANNERS[kind](payload, assets)
+    if report.get("status") != "ok":
+        return changes, report, list(report.get("message") or ["rejected by planner"])
+    problems = []
+    for asset, new_price in changes:
+        old = asset.unit_price_usd
+        if new_price <= 0:
+            problems.append(f"{asset.asset_code}: non-positive price {new_price}")
+        elif asset.id in tracked and old and abs(new_price - old) > old * outlier_limit(asset.asset_code):
+            problems.append(f"{asset.asset_code}: outlier {old} → {new_price}")
+    return changes, report, problems
+
+
+def judge(kind: str, source: RateSource, fut: Future, assets: List[Asset],
+          tracked: Set[int]) -> Tuple[Optional[Accepted], Optional[str]]:
+    """(الحمولة المقبولة، أو سبب الرفض) لجلب مكتمل، مع تحديث قاطع دائرة المصدر."""
+    breaker = breaker_for(source.name)
+    try:
+        payload = fut.result()
+    except Exception as exc:
+        breaker.record_failure()
+        return None, f"HTTP/JSON error: {exc}"
+    try:
+        changes, report, problems = check_payload(kind, payload, assets, tracked)
+    except Exception as exc:
+        changes, report, problems = [], {}, [f"bad payload: {exc}"]
+    if problems:
+        breaker.record_failure()
+        return None, "; ".join(problems)
+    breaker.record_success()
+    return Accepted(source.name, payload, changes, report), None
+
+
+def fetch_all(kinds: List[str], sources: Dict[str, List[RateSource]], assets: Dict[str, List[Asset]],
+              tracked: Set[int]) -> Dict[str, Tuple[Optional[Accepted], Dict[str, str]]]:
+    """
+    كل مصادر كل الأنواع تُطلب معًا على fetch_executor وننتظرها بـ concurrent.futures
+    (بلا حلقة asyncio، فيصلح النداء من داخل حلقة جارية: ASGI، اختبارات async...).
+    لكل نوع: أسرع حمولة سليمة، و{المصدر: سبب الرفض} لما سبقها؛ الخاسرون لا يُنتظرون.
+    """
+    session = http_session()
+    accepted: Dict[str, Accepted] = {}
+    rejected: Dict[str, Dict[str, str]] = {kind: {} for kind in kinds}
+    pending: Dict[Future, Tuple[str, RateSource]] = {}
+    for kind in kinds:
+        for source in sources.get(kind, []):
+            if not breaker_for(source.name).allow():
+                rejected[kind][source.name] = "circuit open"
+                continue
+            fut = fetch_executor().submit(fetch_with_retries, lambda s=source: s.fetch(session))
+            pending[fut] = (kind, source)
+
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                kind, source = pending.pop(fut)
+                if kind in accepted:
+                    continue
+                winner, reason = judge(kind, source, fut, assets[kind], tracked)
+                if winner is None:
+                    rejected[kind][source.name] = reason
+                else:
+                    accepted[kind] = winner
+            for fut in [f for f, (kind, _) in pending.items() if kind in accepted]:
+                fut.cancel()
+                del pending[fut]
+    finally:
+        for fut in pending:
+            fut.cancel()
+    return {kind: (accepted.get(kind), rejected[kind]) for kind in kinds}
+
+
+# -------- آخر حمولة سليمة على القرص --------
+def cache_path(kind: str) -> str:
+    return os.path.join(settings.RATE_CACHE_DIR, f"{kind}.json")
+
+
+def save_last_good(kind: str, source: str, payload: dict) -> None:
+    """كتابة ذرّية (ملف مؤقت ثم replace) فلا يُقرأ ملف نصف مكتوب."""
+    os.makedirs(settings.RATE_CACHE_DIR, exist_ok=True)
+    data = {"source": source, "fetched_at": timezone.now().isoformat(), "payload": payload}
+    fd, tmp = tempfile.mkstemp(dir=settings.RATE_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, cache_path(kind))
+
+
+def priced_since(asset_ids: List[int], since: datetime) -> Set[int]:
+    """أصول سُجّل لها سعر (AssetPrice: مزوّد أو الإدارة) بعد since."""
+    return set(AssetPrice.objects.filter(asset_id__in=asset_ids, effective_at__gt=since)
+               .values_list("asset_id", flat=True).distinct())
+
+
+def load_last_good(kind: str, now: Optional[datetime] = None) -> Optional[dict]:
+    try:
+        with open(cache_path(kind)) as f:
+            data = json.load(f)
+        fetched_at = datetime.fromisoformat(data["fetched_at"])
+    except (OSError, ValueError, KeyError):
+        return None
+    if (now or timezone.now()) - fetched_at > timedelta(seconds=RATE_CACHE_MAX_AGE_SECONDS):
+        return None
+    return data
+
+
+def refresh_all_rates(kinds: Optional[List[str]] = None,
+                      sources: Optional[Dict[str, List[RateSource]]] = None) -> dict:
+    """
+    يجلب كل الأنواع معًا ويطبّق ما نجح في معاملة واحدة.
+    status للنوع: ok (مصدر حي) / cached (آخر حمولة سليمة من القرص) / error؛
+    وللمجموع: ok إن كانت كل الأنواع ok، وإلا partial إن طُبّق شيء، وإلا error.
+    """
+    kinds = list(kinds or RATE_PLANNERS)
+    sources = sources if sources is not None else get_rate_sources()
+    assets = {kind: RATE_ASSETS[kind]() for kind in kinds}
+    tracked = tracked_asset_ids([a for kind in kinds for a in assets[kind]])
+    outcomes = fetch_all(kinds, sources, assets, tracked)
+
+    reports, changes, used, to_save = {}, [], [], []
+    for kind in kinds:
+        accepted, rejected = outcomes[kind]
+        messages = [f"{name}: {reason}" for name, reason in rejected.items()]
+        if accepted is not None:
+            to_save.append((kind, accepted.source, accepted.payload))
+            changes += accepted.changes
+            used.append(accepted.source)
+            reports[kind] = dict(accepted.report, source=accepted.source, rejected=rejected)
+            continue
+
+        cached = load_last_good(kind)
+        if cached is not None:
+            # سعر ضُبط بعد حفظ الحمولة (الإدارة أو مصدر آخر) أحدث منها: لا نعيده إلى الخلف
+            newer = priced_since([a.id for a in assets[kind]], datetime.fromisoformat(cached["fetched_at"]))
+            fallback_assets = [a for a in assets[kind] if a.id not in newer]
+            planned, report, problems = check_payload(kind, cached["payload"], fallback_assets, tracked)
+            if not problems:
+                changes += planned
+                used.append(f"{cached['source']}(c)")
+                kept = sorted(a.asset_code for a in assets[kind] if a.id in newer)
+                notes = [f"kept newer prices for {', '.join(kept)}"] if kept else []
+                reports[kind] = dict(report, status="cached", source=cached["source"],
+                                     fetched_at=cached["fetched_at"], rejected=rejected, kept_newer=kept,
+                                     message=messages + [f"served last good payload from {cached['fetched_at']}"] + notes)
+                continue
+            messages.append(f"cache: {'; '.join(problems)}")
+        reports[kind] = {"status": "error", "message": messages or ["no rate source configured"],
+                         "rejected": rejected}
+
+    # عمود المصدر في PriceChange/AssetPrice بطول 30
+    version = apply_price_changes(changes, source="+".join(used)[:30])
+    # الحفظ بعد التطبيق: لحظة الحفظ لا تسبق سجلات AssetPrice التي كتبتها هذه الحمولة نفسها
+    for kind, source, payload in to_save:
+        save_last_good(kind, source, payload)
+
+    ok = [r["status"] == "ok" for r in reports.values()]
+    status = "ok" if all(ok) else "partial" if any(r["status"] != "error" for r in reports.values()) else "error"
+    # موعد التحديث التالي المعلن (ER-API) يُرفع فقط إن اتفقت عليه كل الأنواع
+    announced = {r.get("time_next_update_utc") for r in reports.values()}
+    return {
+        "status": status,
+        "time_next_update_utc": announced.pop() if len(announced) == 1 else None,
+        "message": [f"{kind}: {r['status']}" + (f" ({r['source']})" if r.get("source") else "")
+                    for kind, r in reports.items()],
+        "price_version": version,
+        "breakers": {s.name: breaker_for(s.name).state for k in kinds for s in sources.get(k, [])},
+        "providers": reports,
+    }
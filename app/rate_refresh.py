@@ -0,0 +1,154 @@
+# app/rate_refresh.py
+"""
+منسّق تحديث الأسعار (single-flight) لنقاط rates/update وأوامر الإدارة:
+  - صف RateRefreshJob لكل مزوّد هو القفل: تحديث شرطي واحد (ليس running، أو running
+    عالق أقدم من RATE_REFRESH_LOCK_TIMEOUT_SECONDS) يحدّد من يتصل بالمزوّد؛
+    المتزامنون معه ينضمّون إلى نفس المهمة بدل تكرار الجلب
+  - نتيجة ناجحة صالحة حتى fresh_until = max(الآن + RATE_REFRESH_STALE_SECONDS،
+    time_next_update_utc المعلن) — قبلها لا طلب للمزوّد إلا بـ force
+  - نتيجة partial (نوع من آخر حمولة سليمة أو فاشل) نجاح مع حقل warning
+  - الواجهة تشغّل المهمة في خيط خلفي وتعيد حالتها فورًا فلا يُحجز عامل الخادم.
+    الخيط أفضل جهد: داخل العملية تُكتب نتيجة المهمة دائمًا (finally)، وعند إيقاف العامل
+    تُعلَّم مهامه الجارية error (atexit) فيُفك القفل فورًا؛ إن قُتل العامل قسرًا يبقى
+    القفل حتى RATE_REFRESH_LOCK_TIMEOUT_SECONDS. التحديث المضمون هو أمر refresh_rates
+    (cron أو مشغّل خارج الطلبات)
+"""
+import atexit
+import threading
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from django.db import connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .conf import RATE_REFRESH_LOCK_TIMEOUT_SECONDS, RATE_REFRESH_STALE_SECONDS
+from .models import RateRefreshJob
+from .rate_fetch import refresh_all_rates
+
+# كلها عبر مصادر RATE_SOURCES (أسرع حمولة سليمة + آخر حمولة سليمة عند الانقطاع)؛
+# "rates" يجمع العملات والمعادن في جلب متزامن ومعاملة واحدة (app/rate_fetch.py)
+RATE_REFRESHERS: Dict[str, Callable[[], dict]] = {
+    "currencies": lambda: refresh_all_rates(["currencies"]),
+    "metals": lambda: refresh_all_rates(["metals"]),
+    "rates": refresh_all_rates,
+}
+
+# مهام هذه العملية الجارية في خيوط خلفية: (provider, started_at)
+_in_flight: Set[Tuple[str, datetime]] = set()
+_in_flight_lock = threading.Lock()
+
+
+def start_in_background(fn: Callable[[], None]) -> None:
+    def target():
+        try:
+            fn()
+        finally:
+            # اتصالات القاعدة خاصة بكل خيط
+            connections.close_all()
+    threading.Thread(target=target, name="rate-refresh", daemon=True).start()
+
+
+def fresh_until_for(result: dict, finished_at: datetime) -> datetime:
+    until = finished_at + timedelta(seconds=RATE_REFRESH_STALE_SECONDS)
+    announced = result.get("time_next_update_utc")
+    if announced:
+        try:
+            until = max(until, parsedate_to_datetime(announced))
+        except (TypeError, ValueError):
+            pass
+    return until
+
+
+def run_refresh(provider: str, started_at: datetime) -> None:
+    """
+    ينفّذ المهمة المستولى عليها ويكتب نتيجتها (فقط إن بقيت مهمتنا: started_at لم يتغيّر).
+    النتيجة تُكتب في finally: حتى مع BaseException (إيقاف الخيط) لا تبقى المهمة running.
+    """
+    result = {"status": "error", "message": ["interrupted"]}
+    try:
+        result = RATE_REFRESHERS[provider]()
+    except Exception as exc:
+        result = {"status": "error", "message": [f"{type(exc).__name__}: {exc}"]}
+    finally:
+        finish_job(provider, started_at, result)
+        with _in_flight_lock:
+            _in_flight.discard((provider, started_at))
+
+
+def finish_job(provider: str, started_at: datetime, result: dict) -> None:
+    # partial (بعض الأنواع من آخر حمولة سليمة أو فشلت) طُبّق منه شيء فهو نجاح بتحذير؛
+    # حديث لمدة RATE_REFRESH_STALE_SECONDS فقط (لا نثق بموعد التحديث المعلن لحمولة قديمة)
+    status = result.get("status")
+    applied = status in ("ok", "partial")
+    finished_at = timezone.now()
+    RateRefreshJob.objects.filter(provider=provider, status="running", started_at=started_at).update(
+        status="ok" if applied else "error",
+        finished_at=finished_at,
+        fresh_until=fresh_until_for(result if status == "ok" else {}, finished_at) if applied else None,
+        result=result,
+    )
+
+
+@atexit.register
+def release_interrupted_jobs() -> None:
+    """عند إيقاف العامل: الخيوط الخلفية (daemon) تُقتل، فتُعلَّم مهامها error ويُفك القفل."""
+    with _in_flight_lock:
+        jobs = sorted(_in_flight)
+        _in_flight.clear()
+    for provider, started_at in jobs:
+        try:
+            finish_job(provider, started_at, {"status": "error", "message": ["interrupted by worker shutdown"]})
+        except Exception:
+            pass  # أفضل جهد: القاعدة قد تكون مغلقة؛ يبقى RATE_REFRESH_LOCK_TIMEOUT_SECONDS
+
+
+def result_warnings(result: Optional[dict]) -> List[str]:
+    """رسائل الأنواع التي لم تُحدَّث من مصدر حي (cached / error) في نتيجة partial."""
+    if not result or result.get("status") != "partial":
+        return []
+    return [f"{kind}: {r.get('status')} — " + "; ".join(r.get("message") or [])
+            for kind, r in (result.get("providers") or {}).items() if r.get("status") != "ok"]
+
+
+def job_status(job: RateRefreshJob, started: bool) -> Dict[str, Any]:
+    return {
+        "provider": job.provider,
+        "status": job.status,
+        "started": started,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "fresh_until": job.fresh_until,
+        "result": job.result,
+        # نتيجة آخر تشغيل مكتمل؛ أثناء running تخص التشغيل السابق فلا تحذير
+        "warning": result_warnings(job.result) if job.status == "ok" else [],
+    }
+
+
+def request_refresh(provider: str, force: bool = False, background: bool = True,
+                    now: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    يبدأ تحديثًا لـ provider إن لزم، أو ينضم إلى الجاري، أو يعيد النتيجة الحديثة.
+    started=True فقط للمستدعي الذي استولى على القفل. background=False ينفّذ هنا وينتظر.
+    """
+    if provider not in RATE_REFRESHERS:
+        raise KeyError(provider)
+    now = now or timezone.now()
+    RateRefreshJob.objects.get_or_create(provider=provider)
+
+    claimable = ~Q(status="running") | Q(started_at__lt=now - timedelta(seconds=RATE_REFRESH_LOCK_TIMEOUT_SECONDS))
+    if not force:
+        claimable &= Q(fresh_until__isnull=True) | Q(fresh_until__lte=now)
+    claimed = bool(RateRefreshJob.objects.filter(claimable, provider=provider).update(
+        status="running", started_at=now, finished_at=None, runs=F("runs") + 1,
+    ))
+
+    if claimed:
+        if background:
+            with _in_flight_lock:
+                _in_flight.add((provider, now))
+            start_in_background(lambda: run_refresh(provider, now))
+        else:
+            run_refresh(provider, now)
+    return job_status(RateRefreshJob.objects.get(provider=provider), started=claimed)
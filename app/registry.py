@@ -0,0 +1,99 @@
+# app/registry.py
+import threading
+import time as _time
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+
+from .caching import get_price_version
+from .conditional import content_etag
+from .conf import ASSET_REGISTRY_CHECK_SECONDS
+from .models import Asset
+
+
+class AssetRegistry:
+    """
+    لقطة ثابتة (للقراءة فقط) من الأصول الفعّالة داخل العملية، مفهرسة بالمعرّف والرمز والفئة
+    مع قيم النصاب محسوبة مسبقًا. تُستبدل كاملة عند تغيّر نسخة الأسعار/الكتالوج.
+    """
+
+    def __init__(self, version: int, assets: List[Asset]):
+        from .services import ASSET_CLASSES, asset_kind, nisab_usd_for_gold, nisab_usd_for_money, nisab_usd_for_silver
+
+        self.version = version
+        self.assets = assets
+        self.by_id: Dict[int, Asset] = {a.id: a for a in assets}
+        self.by_code: Dict[str, Asset] = {}
+        for a in assets:
+            self.by_code.setdefault(a.asset_code, a)
+        self.by_kind: Dict[str, List[Asset]] = {
+            kind: [a for a in assets if asset_kind(a) == kind] for kind in ASSET_CLASSES
+        }
+        self.nisab: Dict[str, Decimal] = {
+            "gold": nisab_usd_for_gold(assets),
+            "silver": nisab_usd_for_silver(assets),
+            "money": nisab_usd_for_money(assets),
+        }
+
+    @cached_property
+    def catalog(self) -> list:
+        """قائمة الأصول المسلسلة كما تعيدها AssetListView (تُحسب مرة لكل نسخة)."""
+        from .serializers import AssetSerializer
+        return AssetSerializer(self.assets, many=True).data
+
+    @cached_property
+    def catalog_etag(self) -> str:
+        return content_etag(self.catalog)
+
+    def get(self, asset_id: int) -> Optional[Asset]:
+        return self.by_id.get(asset_id)
+
+    def by_asset_code(self, code: str) -> Optional[Asset]:
+        return self.by_code.get(code)
+
+
+_lock = threading.Lock()
+_registry: Optional[AssetRegistry] = None
+_checked_at = 0.0
+
+
+def get_asset_registry(version: Optional[int] = None) -> AssetRegistry:
+    """
+    سجل الأصول الحالي. إن مُرِّرت نسخة الأسعار (مقروءة مسبقًا) نقارن بها مباشرة؛
+    وإلا نقرأ النسخة من القاعدة مرة كل ASSET_REGISTRY_CHECK_SECONDS على الأكثر.
+    """
+    global _registry, _checked_at
+    registry = _registry
+    now = _time.monotonic()
+    if registry is not None:
+        if version is None and now - _checked_at < ASSET_REGISTRY_CHECK_SECONDS:
+            return registry
+        if version is None:
+            version = get_price_version()
+            _checked_at = now
+        if registry.version == version:
+            return registry
+
+    with _lock:
+        if _registry is not None and version is not None and _registry.version == version:
+            return _registry
+        if version is None:
+            version = get_price_version()
+        _registry = AssetRegistry(version, list(Asset.objects.filter(is_active=True)))
+        _checked_at = _time.monotonic()
+        return _registry
+
+
+def invalidate_asset_registry() -> None:
+    """يُسقط السجل في هذه العملية فورًا (العمليات الأخرى تلتقط تغيّر النسخة)."""
+    global _registry
+    _registry = None
+
+
+@receiver(post_save, sender=Asset)
+@receiver(post_delete, sender=Asset)
+def _asset_changed(sender, **kwargs):
+    invalidate_asset_registry()
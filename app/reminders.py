@@ -0,0 +1,152 @@
+# app/reminders.py
+"""
+تذكيرات الزكاة الاستباقية بدون حساب لقطة لكل مستخدم:
+  - HaulState.next_due_at (مفهرس مع kind): أقرب موعد استحقاق لم يمضِ، يُكتب مع كل تغيّر
+    لحالة الحول ويُرحَّل حولًا كاملًا عند مروره (الحوالات المتعددة)
+  - المجدول اليومي: لكل إزاحة d في ZAKAT_REMINDER_OFFSETS استعلام نطاق واحد
+    next_due_at ∈ [now + d, now + d + يوم) — نفس شرط days_left == d في إشعارات اللقطة
+  - next_due_at لا يعرف توزيع الزكاة المدفوعة على الحوالات: بعد أول حول مكتمل تعرض اللقطة
+    أقدم حول غير مسدَّد (days_left سالب غالبًا) بدل الموعد القادم، فالمرشّحون الذين أكملوا
+    حولًا يُؤكَّدون بحساب اللقطة نفسه (compute_class_snapshot) قبل الكتابة
+  - صندوق صادر (NotificationOutbox) بقيد فريد: إعادة تشغيل المجدول لا تكرّر الرسائل
+  - فشل الإرسال يؤجّل المحاولة التالية (next_attempt_at) بتراجع أُسّي حتى NOTIFICATION_MAX_ATTEMPTS
+  - الإرسال خارج أي معاملة: الدفعة تُحجز في معاملة قصيرة (مهلة NOTIFICATION_CLAIM_SECONDS)
+    ونتيجة كل رسالة تُكتب في صفها فور إرسالها، فتعطّل المستهلك لا يعيد ما أُرسل
+"""
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from .batch import recompute_haul_states
+from .conf import (
+    NOTIFICATION_CLAIM_SECONDS, NOTIFICATION_MAX_ATTEMPTS, NOTIFICATION_RETRY_BACKOFF_SECONDS,
+    NOTIFICATION_RETRY_MAX_BACKOFF_SECONDS,
+    ZAKAT_HAUL_DAYS, ZAKAT_REMINDER_OFFSETS,
+)
+from .models import HaulState, NotificationOutbox, Transfer, User
+from .registry import AssetRegistry, get_asset_registry
+from .services import ASSET_CLASSES, compute_class_snapshot, haul_prices_key, load_user_ledger, reminder_message
+
+# نفس فئات إشعارات اللقطة (كل فئة على حدة)
+REMINDER_KINDS = tuple(ASSET_CLASSES)
+
+
+def refresh_stale_haul_states(registry: Optional[AssetRegistry] = None, chunk_size: int = 500) -> int:
+    """
+    قبل الجدولة: الحالات المبنية بأسعار قديمة، أو المفقودة لمستخدم له مناقلات،
+    تُعاد بالمحرك الدفعي كي يكون next_due_at مطابقًا لما ستعرضه اللقطة. يعيد عدد المستخدمين.
+    """
+    registry = registry or get_asset_registry()
+    stale = Q(pk__in=[])
+    for kind in REMINDER_KINDS:
+        stale |= Q(kind=kind) & ~Q(prices_key=haul_prices_key(kind, registry.assets))
+    user_ids = set(HaulState.objects.filter(stale).values_list("user_id", flat=True))
+
+    has_transfers = User.objects.filter(Exists(Transfer.objects.filter(user=OuterRef("pk"))))
+    for kind in REMINDER_KINDS:
+        user_ids |= set(has_transfers.exclude(haul_states__kind=kind).values_list("id", flat=True))
+
+    ids = sorted(user_ids)
+    for i in range(0, len(ids), chunk_size):
+        recompute_haul_states(ids[i:i + chunk_size], registry)
+    return len(ids)
+
+
+def roll_forward_due_dates(now: datetime) -> int:
+    """المواعيد التي مضت تُرحَّل إلى الحول التالي (تحديث جماعي؛ يتكرر لمن تأخر أكثر من حول)."""
+    total = 0
+    while True:
+        moved = (HaulState.objects.filter(next_due_at__lt=now)
+                 .update(next_due_at=F("next_due_at") + timedelta(days=ZAKAT_HAUL_DAYS)))
+        if not moved:
+            return total
+        total += moved
+
+
+def snapshot_days_left(user: User, kind: str) -> Optional[int]:
+    """days_left كما تعرضه اللقطة (بعد توزيع المدفوع على الحوالات)؛ None إن كان تحت النصاب."""
+    haul = compute_class_snapshot(user, kind, load_user_ledger(user, (kind,)))["haul"]
+    return haul["days_left"] if haul["above_now"] else None
+
+
+def schedule_zakat_reminders(now: Optional[datetime] = None) -> int:
+    """يكتب تذكيرات اليوم في الصندوق الصادر (المكرّر يُتجاهل). يعيد عدد التذكيرات المطابقة."""
+    now = now or timezone.now()
+    roll_forward_due_dates(now)
+    haul = timedelta(days=ZAKAT_HAUL_DAYS)
+    rows: List[NotificationOutbox] = []
+    for d in ZAKAT_REMINDER_OFFSETS:
+        lo = now + timedelta(days=d)
+        due = list(HaulState.objects
+                   .filter(kind__in=REMINDER_KINDS, next_due_at__gte=lo, next_due_at__lt=lo + timedelta(days=1))
+                   .values_list("user_id", "kind", "next_due_at", "haul_started_at"))
+        # في الحول الأول لا دفعات تُوزَّع: next_due_at هو موعد اللقطة نفسه
+        completed = [(user_id, kind) for user_id, kind, _, start in due if start is not None and now - start >= haul]
+        users = User.objects.in_bulk({user_id for user_id, _ in completed})
+        confirmed = {(user_id, kind) for user_id, kind in completed
+                     if snapshot_days_left(users[user_id], kind) == d}
+        rows += [
+            NotificationOutbox(user_id=user_id, kind=kind, due_at=due_at, offset_days=d, message=reminder_message(d))
+            for user_id, kind, due_at, start in due
+            if start is None or now - start < haul or (user_id, kind) in confirmed
+        ]
+    NotificationOutbox.objects.bulk_create(rows, ignore_conflicts=True)
+    return len(rows)
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """انتظار ما بعد المحاولة رقم attempts الفاشلة: 1×، 2×، 4×... من الأساس حتى الحد الأعلى."""
+    seconds = NOTIFICATION_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1)
+    return timedelta(seconds=min(seconds, NOTIFICATION_RETRY_MAX_BACKOFF_SECONDS))
+
+
+def claim_notifications(limit: int, now: datetime) -> Tuple[List[NotificationOutbox], int]:
+    """
+    معاملة قصيرة: تحجز دفعة حان وقتها (skip_locked فيمكن تشغيل أكثر من مستهلك) بعدّ المحاولة
+    وتأجيل next_attempt_at مدة المهلة. حجز سابق انتهت مهلته في آخر محاولة مسموحة
+    (تعطّل المستهلك) يصبح failed. يعيد (المحجوزة، عدد الفاشلة).
+    """
+    lease_until = now + timedelta(seconds=NOTIFICATION_CLAIM_SECONDS)
+    with transaction.atomic():
+        batch = list(NotificationOutbox.objects
+                     .select_for_update(skip_locked=True, of=("self",))
+                     .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now), status="pending")
+                     .select_related("user")
+                     .order_by("id")[:limit])
+        claimed, expired = [], []
+        for n in batch:
+            if n.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                n.status, n.next_attempt_at, n.last_error = "failed", None, "claim expired"
+                expired.append(n)
+            else:
+                n.attempts += 1
+                n.next_attempt_at = lease_until
+                claimed.append(n)
+        NotificationOutbox.objects.bulk_update(batch, ["status", "attempts", "next_attempt_at", "last_error"])
+    return claimed, len(expired)
+
+
+def deliver_notifications(send: Callable[[NotificationOutbox], None], limit: int = 100) -> Tuple[int, int]:
+    """
+    يستهلك دفعة من الرسائل المعلّقة التي حان وقت محاولتها بالترتيب. send يرمي استثناء
+    عند الفشل؛ الرسالة تبقى معلّقة ولا تُعاد قبل next_attempt_at (retry_delay)، وبعد
+    NOTIFICATION_MAX_ATTEMPTS تصبح failed. send يُنادى خارج المعاملة والأقفال، ونتيجة
+    كل رسالة تُكتب فورًا (فقط إن بقي حجزنا: attempts لم يتغيّر). يعيد (sent, failed).
+    """
+    sent = 0
+    claimed, failed = claim_notifications(limit, timezone.now())
+    for n in claimed:
+        mine = NotificationOutbox.objects.filter(pk=n.pk, status="pending", attempts=n.attempts)
+        try:
+            send(n)
+        except Exception as exc:
+            if n.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                failed += mine.update(status="failed", next_attempt_at=None, last_error=str(exc)[:240])
+            else:
+                mine.update(next_attempt_at=timezone.now() + retry_delay(n.attempts), last_error=str(exc)[:240])
+            continue
+        sent += mine.update(status="sent", sent_at=timezone.now(), next_attempt_at=None)
+    return sent, failed
@@ -297,8 +297,16 @@ class ReportsInputSerializer(serializers.Serializer):
     start_date = serializers.DateField(required=False)  # مخصص
     end_date   = serializers.DateField(required=False)  # مخصص
 
+    # عدة نوافذ في طلب واحد (تتجاهل filter عند وجودها)
+    filters = serializers.ListField(
+        child=serializers.ChoiceField(choices=["none", "last_1m", "last_3m", "last_6m", "custom"]),
+        required=False, allow_empty=False, max_length=5,
+    )
+    # سلسلة زمنية اختيارية للرسوم البيانية
+    series = serializers.ChoiceField(required=False, choices=["none", "month", "week"], default="none")
+
     def validate(self, attrs):
-        if attrs.get("filter") == "custom":
+        if attrs.get("filter") == "custom" or "custom" in attrs.get("filters", []):
             if not attrs.get("start_date") or not attrs.get("end_date"):
                 raise serializers.ValidationError("start_date and end_date are required for custom filter.")
             if attrs["start_date"] > attrs["end_date"]:
@@ -348,3 +356,39 @@ class TransferUpdateSerializer(serializers.Serializer):
 
 
 
+
+
+# --------------------------
+# إدخال جماعي للمناقلات (عملاء offline)
+# --------------------------
+from .conf import TRANSFER_BULK_MAX_ITEMS
+
+
+class TransferBulkItemSerializer(serializers.Serializer):
+    """عنصر واحد في الدفعة — تحقق بدون استعلامات (الأصل يُتحقق منه من خريطة محمّلة مسبقًا)."""
+    asset_id = serializers.IntegerField(min_value=1)
+    transfer_type = serializers.ChoiceField(choices=TRANSFER_TYPE_CHOICES)
+    quantity = serializers.DecimalField(max_digits=18, decimal_places=6)
+    transfer_date = serializers.DateTimeField(required=False)
+    note = serializers.CharField(required=False, allow_blank=True, max_length=240)
+    client_key = serializers.CharField(required=False, allow_blank=False, max_length=64)
+
+    def validate_quantity(self, value: Decimal):
+        if value <= 0:
+            raise serializers.ValidationError("الكمية يجب أن تكون أكبر من الصفر.")
+        return value
+
+
+class TransferBulkCreateSerializer(serializers.Serializer):
+    user_id = serializers.IntegerField(required=True)
+    items = serializers.ListField(
+        child=serializers.DictField(), allow_empty=False, max_length=TRANSFER_BULK_MAX_ITEMS,
+    )
+
+    def validate_user_id(self, value):
+        request = self.context["request"]
+        if not request.user.is_staff and request.user.id != value:
+            raise serializers.ValidationError("لا يمكنك إنشاء مناقلة لمستخدم آخر.")
+        if not User.objects.filter(id=value, is_active=True).exists():
+            raise serializers.ValidationError("المستخدم غير موجود أو غير فعّال.")
+        return value
@@ -4,18 +4,29 @@ from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from typing import Dict, Any, List, Optional, Tuple
 
 from django.utils import timezone
-from django.db.models import Sum, F
-from django.db.models.functions import Coalesce
-from django.db import transaction
+from django.db.models import Sum, F, BigIntegerField
+from django.db.models.functions import Coalesce, Cast, Round, TruncMonth, TruncWeek
+from django.db import connection, transaction, IntegrityError
 
-from .models import Asset, Transfer, User
+from django.db.models import Q
+
+from .models import Asset, AssetPrice, Holding, Transfer, User, HaulState, HaulCheckpoint, PriceChange
+from .caching import bump_ledger_version, bump_price_version
+from .registry import get_asset_registry
+from .fixed import allocate_micro, from_micro, mul_micro, to_micro, zakat_micro
+from .holdings import apply_holding_deltas, holding_deltas
 from .conf import (
     ZAKAT_RATE, ZAKAT_HAUL_DAYS,
     NISAB_GOLD_GRAMS, NISAB_SILVER_GRAMS,
-    NISAB_BENCHMARK_FOR_MONEY, ZAKAT_REMINDER_OFFSETS
+    NISAB_BENCHMARK_FOR_MONEY, ZAKAT_REMINDER_OFFSETS,
+    HAUL_CHECKPOINT_EVERY,
 )
 
+from bisect import bisect_right
 from datetime import datetime, time
+from operator import itemgetter
+import hashlib
+import heapq
 import requests
 
 
@@ -25,6 +36,7 @@ import requests
 METAL_API_URL = "https://api.metalpriceapi.com/v1/latest"
 OUNCE_TROY_TO_GRAM = Decimal("31.1034768")
 ERAPI_URL = "https://open.er-api.com/v6/latest/USD"
+METAL_RATE_CODES = ("GOLD_24", "GOLD_21", "GOLD_19", "SILVER")
 TRANSFER_DATE_FIELD = "transfer_date"  
 
 # -------- أدوات رقمية --------
@@ -35,7 +47,7 @@ def now_utc(): return timezone.now()
 def get_display_currency(user: User) -> Optional[Asset]:
     if user.display_currency and user.display_currency.unit_name == "amount":
         return user.display_currency
-    return Asset.objects.filter(asset_code="USD", is_active=True).first()
+    return get_asset_registry().by_asset_code("USD")
 
 def usd_to_display(usd_value: Decimal, display_asset: Optional[Asset]) -> Decimal:
     if not display_asset or Decimal(display_asset.unit_price_usd) == 0:
@@ -49,69 +61,63 @@ def metal_grams_to_usd(grams: Decimal, metal_asset: Asset) -> Decimal:
 def money_amount_to_usd(amount: Decimal, money_asset: Asset) -> Decimal:
     return DEC6(Decimal(amount) * Decimal(money_asset.unit_price_usd))
 
-# -------- مجاميع بسيطة --------
-def sum_quantity(user: User, asset_ids: List[int], transfer_type: str) -> Decimal:
-    return DEC6(
-        Transfer.objects.filter(user=user, asset_id__in=asset_ids, transfer_type=transfer_type)
-        .aggregate(s=Sum("quantity"))["s"] or Decimal("0")
-    )
-
 # -------- خط الزمن لقيمة الفئة بالدولار --------
-def running_balance_usd_for_class(user: User, assets: List[Asset]) -> Tuple[Decimal, List[Tuple[datetime, Decimal]]]:
-    """
-    يعيد:
-      running (USD): القيمة الحالية للفئة
-      timeline: [(ts, value_usd_after_this_tx)] تصاعديًا
-    """
-    asset_ids = [a.id for a in assets]
-    qs = (Transfer.objects.filter(user=user, asset_id__in=asset_ids)
-          .order_by("transfer_date", "id")
-          .select_related("asset"))
-
-    running = Decimal("0")
-    timeline: List[Tuple[datetime, Decimal]] = []
-    for t in qs:
-        if t.asset.unit_name == "gram":
-            delta = metal_grams_to_usd(t.quantity, t.asset)
-        else:
-            delta = money_amount_to_usd(t.quantity, t.asset)
+class Timeline:
+    """
+    خط زمن مرتّب [(ts, value_usd)] مع بحث ثنائي للقيمة عند لحظة ما،
+    ومرور واحد (merge-walk) لتقييم قائمة تواريخ مرتّبة دفعة واحدة.
+    يبقى قابلًا للمرور عليه كقائمة أزواج كما في السابق.
+    """
 
-        if t.transfer_type == "ADD":
-            running += delta
-        elif t.transfer_type in ("WITHDRAW", "ZAKAT_OUT"):
-            running -= delta
+    def __init__(self, points: Optional[List[Tuple[datetime, Decimal]]] = None):
+        points = list(points or [])
+        self.times: List[datetime] = [ts for ts, _ in points]
+        self.values: List[Decimal] = [val for _, val in points]
 
-        running = DEC6(running)
-        timeline.append((t.transfer_date, running))
+    def __iter__(self):
+        return zip(self.times, self.values)
 
-    return running, timeline
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, i):
+        return self.times[i], self.values[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def value_at(self, dt: datetime, lo: int = 0) -> Decimal:
+        i = bisect_right(self.times, dt, lo)
+        return DEC6(self.values[i - 1]) if i else DEC6(0)
+
+    def values_at(self, dts: List[datetime]) -> List[Decimal]:
+        """قيم عدة تواريخ تصاعدية في مرور واحد (المؤشر لا يعود للخلف)."""
+        out: List[Decimal] = []
+        i = 0
+        for dt in dts:
+            i = bisect_right(self.times, dt, i)
+            out.append(DEC6(self.values[i - 1]) if i else DEC6(0))
+        return out
 
-def value_at_datetime_from_timeline(timeline: List[Tuple[datetime, Decimal]], dt: datetime) -> Decimal:
-    """
-    قيمة الفئة بالدولار عند لحظة dt: نأخذ آخر قيمة <= dt إن وُجدت،
-    وإن كانت كل الأحداث بعد dt نعيد 0.
-    """
-    last = Decimal("0")
-    for ts, val in timeline:
-        if ts <= dt:
-            last = val
-        else:
-            break
-    return DEC6(last)
 
 # -------- النصاب بالدولار --------
-def nisab_usd_for_gold() -> Decimal:
-    a = Asset.objects.filter(asset_code="GOLD_24", is_active=True).first()
+# assets: قائمة الأصول الفعّالة المحمّلة مسبقًا (اختياري)؛ بدونها القيمة المحسوبة مسبقًا في سجل الأصول
+def nisab_usd_for_gold(assets: Optional[List[Asset]] = None) -> Decimal:
+    if assets is None:
+        return get_asset_registry().nisab["gold"]
+    a = next((x for x in assets if x.asset_code == "GOLD_24" and x.is_active), None)
     if a: return DEC6(Decimal(NISAB_GOLD_GRAMS) * Decimal(a.unit_price_usd))
     return DEC6(Decimal(NISAB_GOLD_GRAMS) * Decimal("75.0"))  # fallback
 
-def nisab_usd_for_silver() -> Decimal:
-    a = Asset.objects.filter(name="Silver", unit_name="gram", is_active=True).first()
+def nisab_usd_for_silver(assets: Optional[List[Asset]] = None) -> Decimal:
+    if assets is None:
+        return get_asset_registry().nisab["silver"]
+    a = next((x for x in assets if x.name == "Silver" and x.unit_name == "gram" and x.is_active), None)
     if a: return DEC6(Decimal(NISAB_SILVER_GRAMS) * Decimal(a.unit_price_usd))
     return DEC6(Decimal(NISAB_SILVER_GRAMS) * Decimal("1.0"))  # fallback
 
-def nisab_usd_for_money() -> Decimal:
-    return nisab_usd_for_silver() if NISAB_BENCHMARK_FOR_MONEY.upper()=="SILVER" else nisab_usd_for_gold()
+def nisab_usd_for_money(assets: Optional[List[Asset]] = None) -> Decimal:
+    return nisab_usd_for_silver(assets) if NISAB_BENCHMARK_FOR_MONEY.upper()=="SILVER" else nisab_usd_for_gold(assets)
 
 # -------- تحديد نافذة الحول (بلغ النصاب واستمر) --------
 def haul_window_from_timeline(timeline: List[Tuple[datetime, Decimal]], nisab_usd: Decimal) -> Dict[str, Any]:
@@ -131,6 +137,9 @@ def haul_window_from_timeline(timeline: List[Tuple[datetime, Decimal]], nisab_us
         else:
             start = None
 
+    return haul_window_from_start(start)
+
+def haul_window_from_start(start: Optional[datetime]) -> Dict[str, Any]:
     now = now_utc()
     if start is None:
         return {
@@ -154,22 +163,14 @@ def haul_window_from_timeline(timeline: List[Tuple[datetime, Decimal]], nisab_us
         "days_left": days_left,
     }
 
-# -------- مجموع ما دُفع منذ الاستحقاق --------
-def total_zakat_out_since(user: User, assets: List[Asset], since_dt: datetime) -> Decimal:
-    qs = (Transfer.objects
-          .filter(user=user, asset__in=assets, transfer_type="ZAKAT_OUT", transfer_date__gte=since_dt)
-          .select_related("asset"))
-    total = Decimal("0")
-    for t in qs:
-        if t.asset.unit_name == "gram":
-            total += metal_grams_to_usd(t.quantity, t.asset)
-        else:
-            total += money_amount_to_usd(t.quantity, t.asset)
-    return DEC6(total)
+def next_due_after(start: datetime, now: datetime) -> datetime:
+    """أول موعد start + n × حول (n ≥ 1) لا يسبق now."""
+    haul = timezone.timedelta(days=ZAKAT_HAUL_DAYS)
+    return start + haul * max(1, -(-(now - start) // haul))
 
 # -------- دورات الحول المكتملة (عدة سنوات) --------
 def compute_overdue_zakat_cycles(
-    timeline: List[Tuple[datetime, Decimal]],
+    timeline,
     start: datetime,
     nisab_usd: Decimal,
 ) -> List[Dict[str, Any]]:
@@ -183,16 +184,20 @@ def compute_overdue_zakat_cycles(
     if days_since_start < ZAKAT_HAUL_DAYS:
         return []
 
+    if not isinstance(timeline, Timeline):
+        timeline = Timeline(timeline)
+
     max_cycles = days_since_start // ZAKAT_HAUL_DAYS
-    cycles: List[Dict[str, Any]] = []
+    due_dates = []
     for i in range(1, max_cycles + 1):
         due_at = start + timezone.timedelta(days=ZAKAT_HAUL_DAYS * i)
         if due_at > now:
             break
+        due_dates.append(due_at)
 
-        # قيمة الرصيد عند تاريخ الاستحقاق
-        val_at_due = value_at_datetime_from_timeline(timeline, due_at)
-
+    # قيم الرصيد عند كل مواعيد الاستحقاق في مرور واحد على خط الزمن
+    cycles: List[Dict[str, Any]] = []
+    for due_at, val_at_due in zip(due_dates, timeline.values_at(due_dates)):
         # احتياط إضافي: لو كان أقل من النصاب عند هذا التاريخ نوقف (تجديد حول)
         if val_at_due < nisab_usd:
             break
@@ -218,77 +223,695 @@ def allocate_paid_over_cycles(
       - total_remaining_usd: مجموع الزكاة المتبقية عن كل السنوات
       - earliest_unpaid_due_at: تاريخ أقدم حول غير مسدَّد (إن وجد)
     """
-    remaining_paid = DEC6(total_paid_usd)
-    total_remaining = Decimal("0")
-    earliest_unpaid: Optional[datetime] = None
+    # الحساب بالوحدات الصغرى (fixed.py)؛ Decimal على الحدود فقط
+    remaining, total_remaining, first_unpaid = allocate_micro(
+        to_micro(total_paid_usd),
+        [c["required_micro"] if "required_micro" in c else to_micro(c["required_usd"]) for c in cycles],
+    )
+    for c, left in zip(cycles, remaining):
+        c["remaining_usd"] = from_micro(left)
 
-    for c in cycles:
-        required = c["required_usd"]
-        remaining_for_cycle = required
+    earliest_unpaid = cycles[first_unpaid]["due_at"] if first_unpaid is not None else None
+    return from_micro(total_remaining), earliest_unpaid
 
-        if remaining_paid > 0:
-            used = required if remaining_paid >= required else remaining_paid
-            remaining_for_cycle = DEC6(required - used)
-            remaining_paid = DEC6(remaining_paid - used)
 
-        c["remaining_usd"] = remaining_for_cycle
 
-        if remaining_for_cycle > 0 and earliest_unpaid is None:
-            earliest_unpaid = c["due_at"]
+# -------- الفئات --------
+ASSET_CLASSES = {
+    "gold":   {"name": "Gold", "unit_name": "gram"},
+    "silver": {"name": "Silver", "unit_name": "gram"},
+    "money":  {"name": "Money", "unit_name": "amount"},
+}
+COMBINED_KINDS = ("gold", "silver", "money")
 
-        total_remaining = DEC6(total_remaining + remaining_for_cycle)
+def asset_kind(asset: Asset) -> Optional[str]:
+    for kind, f in ASSET_CLASSES.items():
+        if asset.name == f["name"] and asset.unit_name == f["unit_name"]:
+            return kind
+    return None
 
-    return total_remaining, earliest_unpaid
+def asset_value_usd(quantity: Decimal, asset: Asset) -> Decimal:
+    if asset.unit_name == "gram":
+        return metal_grams_to_usd(quantity, asset)
+    return money_amount_to_usd(quantity, asset)
 
-    
-# -------- حساب فئة واحدة (ذهب/فضة/أموال) --------
-def compute_class_snapshot(user: User, kind: str) -> Dict[str, Any]:
-    display = get_display_currency(user)
 
-    if kind == "gold":
-        assets = list(Asset.objects.filter(name="Gold", unit_name="gram", is_active=True))
-        nisab_usd = nisab_usd_for_gold()
-    elif kind == "silver":
-        assets = list(Asset.objects.filter(name="Silver", unit_name="gram", is_active=True))
-        nisab_usd = nisab_usd_for_silver()
-    elif kind == "money":
-        assets = list(Asset.objects.filter(name="Money", unit_name="amount", is_active=True))
-        nisab_usd = nisab_usd_for_money()
+# -------- دفتر المستخدم (تحميل واحد لكل اللقطة) --------
+class UserLedger:
+    """
+    يحمّل مناقلات المستخدم مرة واحدة (مع أسعار أصولها) ويقسّمها في الذاكرة
+    حسب الفئة والأصل، ليخدم كل مراحل اللقطة بدون استعلامات إضافية:
+      - صافي الكمية لكل أصل
+      - خط الزمن (بالدولار) لكل فئة أو لمجموع عدة فئات
+      - مجموع الزكاة المخرجة منذ تاريخ معيّن
+    الصف: (transfer_id, asset_id, transfer_type, quantity, transfer_date, delta_micro)
+    delta_micro: قيمة المناقلة بالدولار كعدد صحيح بوحدات 10^-6 (fixed.py)
+    """
+
+    def __init__(self, user: User, assets: List[Asset], rows: List[Tuple], kinds=None):
+        self.user = user
+        # الفئات المحمّلة مناقلاتها (None = الكل)
+        self.kinds = tuple(ASSET_CLASSES) if kinds is None else tuple(kinds)
+        self.assets = assets
+        self.assets_by_id = {a.id: a for a in assets}
+        self.assets_by_kind: Dict[str, List[Asset]] = {
+            kind: [a for a in assets if asset_kind(a) == kind] for kind in ASSET_CLASSES
+        }
+        self.kind_by_asset_id = {a.id: asset_kind(a) for a in assets}
+        self.rows = rows
+
+        # صافي الكمية لكل أصل بالوحدات الصغرى
+        self.net_micro_by_asset: Dict[int, int] = {}
+        self.last_id_by_kind: Dict[str, int] = {}
+        for tid, asset_id, ttype, qty, _ts, _delta in rows:
+            kind = self.kind_by_asset_id.get(asset_id)
+            if kind:
+                self.last_id_by_kind[kind] = tid
+                self.last_id_by_kind["combined"] = tid
+            if ttype == "ADD":
+                self.net_micro_by_asset[asset_id] = self.net_micro_by_asset.get(asset_id, 0) + to_micro(qty)
+            elif ttype in ("WITHDRAW", "ZAKAT_OUT"):
+                self.net_micro_by_asset[asset_id] = self.net_micro_by_asset.get(asset_id, 0) - to_micro(qty)
+        self._timelines: Dict[Tuple[str, ...], Tuple[Decimal, Timeline]] = {}
+        self._haul_records: Optional[Dict[str, HaulState]] = None
+
+    def assets_for(self, kinds) -> List[Asset]:
+        return [a for kind in kinds for a in self.assets_by_kind[kind]]
+
+    def rows_for(self, kinds) -> List[Tuple]:
+        kinds = set(kinds)
+        return [r for r in self.rows if self.kind_by_asset_id.get(r[1]) in kinds]
+
+    def net_quantity(self, asset_id: int) -> Decimal:
+        return from_micro(self.net_micro_by_asset.get(asset_id, 0))
+
+    def timeline(self, kinds) -> Tuple[Decimal, Timeline]:
+        """(القيمة الحالية بالدولار، خط الزمن [(ts, القيمة بعد المناقلة)] تصاعديًا) بالأسعار الحالية."""
+        key = tuple(kinds)
+        if key not in self._timelines:
+            running = 0
+            times: List[datetime] = []
+            values: List[int] = []
+            for _id, _asset_id, ttype, _qty, ts, delta in self.rows_for(kinds):
+                if ttype == "ADD":
+                    running += delta
+                elif ttype in ("WITHDRAW", "ZAKAT_OUT"):
+                    running -= delta
+                times.append(ts)
+                values.append(running)
+            self._timelines[key] = (from_micro(running), Timeline(zip(times, map(from_micro, values))))
+        return self._timelines[key]
+
+    def asof_timeline(self, kinds, history: Optional["PriceHistory"] = None) -> Tuple[Decimal, Timeline]:
+        """خط الزمن مقيّمًا بالأسعار السارية عند كل لحظة (سجل AssetPrice) بدل الأسعار الحالية."""
+        if history is None:
+            history = load_price_history(self.assets_for(kinds))
+        return asof_timeline(self.rows_for(kinds), history)
+
+    def zakat_out_since(self, kinds, since_dt: datetime) -> Decimal:
+        """مجموع ZAKAT_OUT للفئات منذ since_dt بالدولار (الأسعار الحالية)."""
+        total = 0
+        for _id, _asset_id, ttype, _qty, ts, delta in self.rows_for(kinds):
+            if ttype == "ZAKAT_OUT" and ts >= since_dt:
+                total += delta
+        return from_micro(total)
+
+    def nisab_usd(self, kind: str) -> Decimal:
+        if kind == "gold":
+            return nisab_usd_for_gold(self.assets)
+        if kind == "silver":
+            return nisab_usd_for_silver(self.assets)
+        return nisab_usd_for_money(self.assets)
+
+    def haul_state(self, kind: str) -> "HaulReplay":
+        """
+        حالة الحول المحفوظة للفئة (gold/silver/money/combined) بدل إعادة تشغيل السجل.
+        تُبنى من الدفتر المحمّل إن لم توجد أو تغيّرت الأسعار أو لم تعد تطابق آخر مناقلة.
+
+        تنبيه: هذه كتابة على مسار القراءة (GET اللقطة، مسلسلة لكل مستخدم: _catch_up_haul_state)
+        — كتعبئة كسولة لكاش: بعد كل تغيّر
+        في أسعار الفئة تُعاد كتابة HaulState (مع حذف checkpoints) مرة واحدة لكل
+        (مستخدم، فئة) عند أول قراءة، ثم تعود القراءات إلى حالة محفوظة صالحة.
+        لتفادي هذه الكتابات في ساعات الذروة شغّل recompute_haul_states بعد تحديث
+        الأسعار فتجد القراءات حالات بالبصمة الجديدة.
+        """
+        if not set(HAUL_KINDS[kind]) <= set(self.kinds):
+            raise ValueError(f"Ledger was loaded without the transfers needed for {kind!r}")
+        if self._haul_records is None:
+            self._haul_records = {r.kind: r for r in HaulState.objects.filter(user=self.user)}
+        key = haul_prices_key(kind, self.assets)
+        nisab = haul_nisab_usd(kind, self.assets)
+        rec = self._haul_records.get(kind)
+        if rec and rec.prices_key == key and rec.last_transfer_id == self.last_id_by_kind.get(kind):
+            return HaulReplay.from_record(rec, nisab)
+        return self._catch_up_haul_state(kind, key, nisab)
+
+    def _catch_up_haul_state(self, kind: str, key: str, nisab: Decimal) -> "HaulReplay":
+        """
+        قراءات متزامنة لنفس المستخدم تتسلسل على قفل صف المستخدم (موجود دائمًا، بخلاف
+        صف HaulState قبل أول بناء). داخل القفل يُعاد فحص الحالة — قد يكون قارئ آخر بناها —
+        وتُقرأ مناقلات الفئة من جديد: البناء من دفتر حُمّل قبل القفل قد يكتب حالة أقدم
+        مما كتبه advance_haul_states لمناقلة أحدث.
+        """
+        class_ids = [a.id for a in self.assets_for(HAUL_KINDS[kind])]
+        with transaction.atomic():
+            list(User.objects.select_for_update().filter(pk=self.user.id).values_list("pk"))
+            rows = ledger_rows(Transfer.objects.filter(user_id=self.user.id, asset_id__in=class_ids),
+                               self.assets_by_id)
+            rec = HaulState.objects.filter(user_id=self.user.id, kind=kind).first()
+            if rec and rec.prices_key == key and rec.last_transfer_id == (rows[-1][0] if rows else None):
+                replay = HaulReplay.from_record(rec, nisab)
+            else:
+                replay = rebuild_haul_state_from_rows(self.user.id, kind, key, nisab, rows)
+        return replay
+
+    def display_currency(self) -> Optional[Asset]:
+        display_id = self.user.display_currency_id
+        if display_id:
+            a = self.assets_by_id.get(display_id)
+            if a is None:
+                # عملة عرض غير فعّالة: نعود للمسار الأصلي
+                return get_display_currency(self.user)
+            if a.unit_name == "amount":
+                return a
+        return next((a for a in self.assets if a.asset_code == "USD"), None)
+
+
+def asset_value_micro(quantity: Decimal, asset: Asset) -> int:
+    """نفس asset_value_usd لكن بالوحدات الصغرى."""
+    return mul_micro(to_micro(quantity), to_micro(asset.unit_price_usd))
+
+def ledger_rows(qs, assets_by_id: Dict[int, Asset]) -> List[Tuple]:
+    qs = qs.order_by("transfer_date", "id").values_list(
+        "id", "asset_id", "transfer_type", "quantity", "transfer_date"
+    )
+    price_micro = {asset_id: to_micro(a.unit_price_usd) for asset_id, a in assets_by_id.items()}
+    return [
+        (tid, asset_id, ttype, qty, ts, mul_micro(to_micro(qty), price_micro[asset_id]))
+        for tid, asset_id, ttype, qty, ts in qs
+        if asset_id in price_micro
+    ]
+
+
+def load_user_ledger(user: User, kinds=None) -> UserLedger:
+    """
+    استعلام واحد لمناقلات المستخدم؛ الأصول الفعّالة تأتي من سجل الأصول داخل العملية.
+    kinds (اختياري): تحميل مناقلات هذه الفئات فقط.
+    """
+    registry = get_asset_registry()
+    if kinds is None:
+        asset_ids = list(registry.by_id)
     else:
-        raise ValueError("Unknown kind")
+        asset_ids = [a.id for kind in kinds for a in registry.by_kind[kind]]
+    rows = ledger_rows(Transfer.objects.filter(user=user, asset_id__in=asset_ids), registry.by_id)
+    return UserLedger(user, registry.assets, rows, kinds)
 
-    # عناصر الفئة (صافي كمية كل أصل + قيمته)
-    items: List[Dict[str, Any]] = []
-    total_usd = Decimal("0")
-    for a in assets:
-        add = sum_quantity(user, [a.id], "ADD")
-        sub = sum_quantity(user, [a.id], "WITHDRAW")
-        zak = sum_quantity(user, [a.id], "ZAKAT_OUT")
-        net = DEC6(add - sub - zak)
-        if net == 0:
+
+# -------- سجل الأسعار التاريخي (as-of) --------
+class PriceHistory:
+    """
+    نقاط أسعار كل أصل [(effective_at, price_usd)] مرتبة زمنيًا:
+      - السعر عند t = آخر نقطة effective_at <= t
+      - قبل أول نقطة: أقدم سعر معروف؛ وبدون نقاط: السعر الحالي للأصل
+    """
+
+    def __init__(self, points: Dict[int, List[Tuple[datetime, Decimal]]], assets_by_id: Dict[int, Asset]):
+        self.points = points
+        self.assets_by_id = assets_by_id
+
+    def initial_price(self, asset_id: int) -> Decimal:
+        pts = self.points.get(asset_id)
+        if pts:
+            return pts[0][1]
+        return self.assets_by_id[asset_id].unit_price_usd or Decimal("0")
+
+    def price_at(self, asset_id: int, dt: datetime) -> Decimal:
+        pts = self.points.get(asset_id) or []
+        i = bisect_right(pts, dt, key=itemgetter(0))
+        return pts[i - 1][1] if i else self.initial_price(asset_id)
+
+    def events(self, asset_ids):
+        """(effective_at, asset_id, price) لكل الأصول المطلوبة، مدموجة تصاعديًا."""
+        return heapq.merge(*[
+            [(ts, asset_id, price) for ts, price in self.points.get(asset_id, ())]
+            for asset_id in asset_ids
+        ], key=itemgetter(0))
+
+
+def load_price_history(assets: List[Asset], until: Optional[datetime] = None) -> PriceHistory:
+    """استعلام واحد لكل نقاط أسعار الأصول (يستخدم فهرس asset, effective_at)."""
+    qs = AssetPrice.objects.filter(asset_id__in=[a.id for a in assets])
+    if until is not None:
+        qs = qs.filter(effective_at__lte=until)
+    points: Dict[int, List[Tuple[datetime, Decimal]]] = {}
+    for asset_id, ts, price in qs.order_by("asset_id", "effective_at", "id").values_list(
+            "asset_id", "effective_at", "price_usd"):
+        points.setdefault(asset_id, []).append((ts, price))
+    return PriceHistory(points, {a.id: a for a in assets})
+
+
+def asof_timeline(rows: List[Tuple], history: PriceHistory) -> Tuple[Decimal, Timeline]:
+    """
+    خط زمن الفئة بالدولار حيث تُقيَّم الكميات المحتفظ بها بالسعر الساري عند كل لحظة
+    (لا بالسعر الحالي)، في مرور دمج واحد على المناقلات ونقاط الأسعار: O(مناقلات + نقاط أسعار).
+      - مناقلة: القيمة ± الكمية × السعر الساري
+      - نقطة سعر لأصل محتفظ به: القيمة + الكمية × (الجديد − القديم) ونقطة جديدة على الخط
+    عند التعادل في التوقيت يُطبَّق السعر قبل المناقلة.
+    """
+    asset_ids = sorted({r[1] for r in rows})
+    # الحساب كله بالوحدات الصغرى (fixed.py)
+    price = {asset_id: to_micro(history.initial_price(asset_id)) for asset_id in asset_ids}
+    held: Dict[int, int] = {}
+    running = 0
+    times: List[datetime] = []
+    values: List[int] = []
+
+    # 0 = سعر، 1 = مناقلة (ترتيب الأحداث المتزامنة)
+    price_events = ((ts, 0, asset_id, p) for ts, asset_id, p in history.events(asset_ids))
+    transfer_events = ((r[4], 1, r) for r in rows)
+    for ev in heapq.merge(price_events, transfer_events, key=itemgetter(0, 1)):
+        ts = ev[0]
+        if ev[1] == 0:
+            _, _, asset_id, new_price = ev
+            new_price = to_micro(new_price)
+            qty = held.get(asset_id)
+            if qty and new_price != price[asset_id]:
+                running += mul_micro(qty, new_price - price[asset_id])
+                times.append(ts)
+                values.append(running)
+            price[asset_id] = new_price
             continue
 
-        if a.unit_name == "gram":
-            val_usd = metal_grams_to_usd(net, a)
-            items.append({
-                "asset_id": a.id, "asset_code": a.asset_code, "unit": "gram",
-                "quantity": str(net), "value_usd": str(val_usd),
-                "value_display": str(usd_to_display(val_usd, display)),
-            })
+        _id, asset_id, ttype, qty, _ts, _delta = ev[2]
+        qty = to_micro(qty)
+        delta = mul_micro(qty, price[asset_id])
+        if ttype == "ADD":
+            held[asset_id] = held.get(asset_id, 0) + qty
+            running += delta
+        elif ttype in ("WITHDRAW", "ZAKAT_OUT"):
+            held[asset_id] = held.get(asset_id, 0) - qty
+            running -= delta
+        times.append(ts)
+        values.append(running)
+    return from_micro(running), Timeline(zip(times, map(from_micro, values)))
+
+
+# -------- حالة الحول المحفوظة (تزايدية) --------
+HAUL_KINDS = {
+    "gold": ("gold",),
+    "silver": ("silver",),
+    "money": ("money",),
+    "combined": COMBINED_KINDS,  # مجموع الأثمان بنصاب المال
+}
+
+def haul_nisab_usd(kind: str, assets: List[Asset]) -> Decimal:
+    if kind == "gold":
+        return nisab_usd_for_gold(assets)
+    if kind == "silver":
+        return nisab_usd_for_silver(assets)
+    return nisab_usd_for_money(assets)
+
+def haul_prices_key(kind: str, assets: List[Asset]) -> str:
+    """بصمة أسعار أصول الفئة + النصاب؛ خط الزمن يُقيَّم بالأسعار الحالية فتتغيّر معها."""
+    kinds = HAUL_KINDS[kind]
+    parts = [f"{a.id}:{DEC6(a.unit_price_usd)}" for a in sorted(assets, key=lambda a: a.id)
+             if asset_kind(a) in kinds]
+    parts.append(f"nisab:{haul_nisab_usd(kind, assets)}")
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+
+class HaulReplay:
+    """
+    آلة حالة الحول: تعالج المناقلات بالترتيب (transfer_date, id) خطوة بخطوة.
+    settled: [(due_at, value_micro)] قيمة الرصيد عند كل موعد استحقاق سبق آخر مناقلة؛
+    المواعيد اللاحقة قيمتها هي القيمة الجارية نفسها.
+    الحالة الداخلية بالوحدات الصغرى (fixed.py)؛ running/value_at_due تعيد Decimal.
+    """
+
+    def __init__(self, nisab_usd: Decimal, running: Decimal = Decimal("0"),
+                 start: Optional[datetime] = None, settled=None,
+                 last_id: Optional[int] = None, last_date: Optional[datetime] = None):
+        self.nisab_usd = nisab_usd
+        self.nisab_micro = to_micro(nisab_usd)
+        self.running_micro = to_micro(running)
+        self.start = start
+        self.settled: List[Tuple[datetime, int]] = [(d, to_micro(v)) for d, v in settled or []]
+        self.last_id = last_id
+        self.last_date = last_date
+        self.since_checkpoint = 0
+
+    @classmethod
+    def from_record(cls, rec, nisab_usd: Decimal) -> "HaulReplay":
+        last_id = getattr(rec, "last_transfer_id", None) or getattr(rec, "transfer_id", None)
+        last_date = getattr(rec, "last_transfer_date", None) or getattr(rec, "transfer_date", None)
+        replay = cls(
+            nisab_usd, rec.running_usd, rec.haul_started_at,
+            [(datetime.fromisoformat(d), v) for d, v in rec.settled_cycles],
+            last_id, last_date,
+        )
+        replay.since_checkpoint = getattr(rec, "transfers_since_checkpoint", 0)
+        return replay
+
+    def fields(self) -> Dict[str, Any]:
+        return {
+            "running_usd": self.running,
+            "haul_started_at": self.start,
+            "settled_cycles": [[d.isoformat(), str(from_micro(v))] for d, v in self.settled],
+        }
+
+    @property
+    def running(self) -> Decimal:
+        return from_micro(self.running_micro)
+
+    def is_after(self, ts: datetime, tid: int) -> bool:
+        return self.last_date is None or (ts, tid) > (self.last_date, self.last_id)
+
+    def apply(self, tid: int, ts: datetime, ttype: str, delta: int) -> None:
+        """delta: قيمة المناقلة بالوحدات الصغرى (كما في صفوف ledger_rows)."""
+        # مواعيد الاستحقاق التي تسبق هذه المناقلة تستقر على القيمة الجارية
+        if self.start is not None:
+            while True:
+                due_at = self.start + timezone.timedelta(days=ZAKAT_HAUL_DAYS * (len(self.settled) + 1))
+                if due_at >= ts:
+                    break
+                self.settled.append((due_at, self.running_micro))
+
+        if ttype == "ADD":
+            self.running_micro += delta
+        elif ttype in ("WITHDRAW", "ZAKAT_OUT"):
+            self.running_micro -= delta
+
+        if self.running_micro >= self.nisab_micro:
+            if self.start is None:
+                self.start = ts
+                self.settled = []
         else:
-            val_usd = money_amount_to_usd(net, a)
-            items.append({
-                "asset_id": a.id, "asset_code": a.asset_code, "unit": "amount",
-                "quantity": str(net), "value_usd": str(val_usd),
-                "value_display": str(usd_to_display(val_usd, display)),
+            self.start = None
+            self.settled = []
+
+        self.last_id, self.last_date = tid, ts
+        self.since_checkpoint += 1
+
+    def window(self) -> Dict[str, Any]:
+        return haul_window_from_start(self.start)
+
+    @property
+    def next_due_at(self) -> Optional[datetime]:
+        """أقرب موعد استحقاق (start + n حول) لم يمضِ بعد."""
+        return next_due_after(self.start, now_utc()) if self.start is not None else None
+
+    def value_at_due_micro(self, i: int) -> int:
+        """قيمة الرصيد عند موعد الاستحقاق رقم i (1 = start + حول) بالوحدات الصغرى."""
+        if i - 1 < len(self.settled):
+            return self.settled[i - 1][1]
+        return self.running_micro
+
+    def value_at_due(self, i: int) -> Decimal:
+        return from_micro(self.value_at_due_micro(i))
+
+    def overdue_cycles(self) -> List[Dict[str, Any]]:
+        """نفس نتيجة compute_overdue_zakat_cycles بدون خط الزمن."""
+        if self.start is None:
+            return []
+        now = now_utc()
+        days_since_start = (now - self.start).days
+        if days_since_start < ZAKAT_HAUL_DAYS:
+            return []
+
+        cycles: List[Dict[str, Any]] = []
+        for i in range(1, days_since_start // ZAKAT_HAUL_DAYS + 1):
+            due_at = self.start + timezone.timedelta(days=ZAKAT_HAUL_DAYS * i)
+            if due_at > now:
+                break
+            val_at_due = self.value_at_due_micro(i)
+            if val_at_due < self.nisab_micro:
+                break
+            required = zakat_micro(val_at_due)
+            cycles.append({
+                "due_at": due_at,
+                "required_usd": from_micro(required),
+                "required_micro": required,
             })
-        total_usd += val_usd
+        return cycles
+
+
+def _replay_rows(replay: HaulReplay, rows, user_id: int, kind: str, key: str) -> None:
+    checkpoints = []
+    for tid, _asset_id, ttype, _qty, ts, delta in rows:
+        replay.apply(tid, ts, ttype, delta)
+        if replay.since_checkpoint >= HAUL_CHECKPOINT_EVERY:
+            checkpoints.append(HaulCheckpoint(
+                user_id=user_id, kind=kind, prices_key=key,
+                transfer_id=tid, transfer_date=ts, **replay.fields(),
+            ))
+            replay.since_checkpoint = 0
+    if checkpoints:
+        HaulCheckpoint.objects.bulk_create(checkpoints)
+
+
+def _save_haul_state(user_id: int, kind: str, key: str, replay: HaulReplay) -> None:
+    HaulState.objects.update_or_create(
+        user_id=user_id, kind=kind,
+        defaults={
+            "prices_key": key,
+            "last_transfer_id": replay.last_id,
+            "last_transfer_date": replay.last_date,
+            "transfers_since_checkpoint": replay.since_checkpoint,
+            "next_due_at": replay.next_due_at,
+            **replay.fields(),
+        },
+    )
+
+
+@transaction.atomic
+def rebuild_haul_state_from_rows(user_id: int, kind: str, key: str, nisab_usd: Decimal, rows) -> HaulReplay:
+    """إعادة بناء كاملة من صفوف الدفتر (عند غياب الحالة أو تغيّر الأسعار)."""
+    HaulCheckpoint.objects.filter(user_id=user_id, kind=kind).delete()
+    replay = HaulReplay(nisab_usd)
+    _replay_rows(replay, rows, user_id, kind, key)
+    _save_haul_state(user_id, kind, key, replay)
+    return replay
+
+
+def rebuild_haul_states(user_id: int, since_dt: datetime, kinds=None) -> None:
+    """
+    إعادة البناء بعد تعديل/إدراج مناقلة بتاريخ since_dt: نبدأ من أقرب checkpoint
+    قبل هذا التاريخ ونعيد تشغيل ما بعده فقط. الحالات غير الموجودة تُبنى عند أول قراءة.
+    """
+    assets = list(Asset.objects.filter(is_active=True))
+    by_id = {a.id: a for a in assets}
+
+    with transaction.atomic():
+        records = HaulState.objects.select_for_update().filter(user_id=user_id)
+        if kinds is not None:
+            records = records.filter(kind__in=kinds)
+        for rec in records:
+            checkpoints = HaulCheckpoint.objects.filter(user_id=user_id, kind=rec.kind)
+            key = haul_prices_key(rec.kind, assets)
+            if rec.prices_key != key:
+                checkpoints.delete()
+                rec.delete()
+                continue
+            checkpoints.filter(transfer_date__gte=since_dt).delete()
+
+            nisab = haul_nisab_usd(rec.kind, assets)
+            cp = checkpoints.filter(prices_key=key).order_by("-transfer_date", "-transfer_id").first()
+            replay = HaulReplay.from_record(cp, nisab) if cp else HaulReplay(nisab)
+
+            class_ids = [a.id for a in assets if asset_kind(a) in HAUL_KINDS[rec.kind]]
+            qs = Transfer.objects.filter(user_id=user_id, asset_id__in=class_ids)
+            if cp:
+                qs = qs.filter(Q(transfer_date__gt=cp.transfer_date) |
+                               Q(transfer_date=cp.transfer_date, id__gt=cp.transfer_id))
+            _replay_rows(replay, ledger_rows(qs, by_id), user_id, rec.kind, key)
+            _save_haul_state(user_id, rec.kind, key, replay)
+
+
+def advance_haul_states(transfer: Transfer) -> None:
+    """
+    مناقلة جديدة: نقدّم حالة فئتها وحالة المجموع خطوة واحدة O(1).
+    إن كانت بتاريخ سابق لآخر مناقلة معالجة نعيد البناء من أقرب checkpoint.
+    """
+    advance_haul_states_bulk(transfer.user_id, [transfer])
+
+
+def advance_haul_states_bulk(user_id: int, transfers: List[Transfer]) -> None:
+    """
+    مناقلات جديدة لمستخدم واحد (مثل الإدخال الجماعي): كل حالة محفوظة تتقدّم بمناقلات
+    فئتها مرتبةً في مرور واحد إن كانت كلها بعد آخر مناقلة معالجة فيها؛ وإلا (مناقلة
+    بتاريخ سابق) يُعاد بناء تلك الفئات من أقرب checkpoint قبل أقدم مناقلة جديدة.
+    """
+    assets = list(Asset.objects.filter(is_active=True))
+    by_id = {a.id: a for a in assets}
+    new = sorted((t for t in transfers if t.asset_id in by_id), key=lambda t: (t.transfer_date, t.id))
+    kinds = {asset_kind(by_id[t.asset_id]) for t in new} - {None}
+    if not kinds:
+        return
+    kinds.add("combined")
+
+    backdated = set()
+    with transaction.atomic():
+        records = list(HaulState.objects.select_for_update()
+                       .filter(user_id=user_id, kind__in=kinds))
+        for rec in records:
+            key = haul_prices_key(rec.kind, assets)
+            if rec.prices_key != key:
+                # الأسعار تغيّرت منذ آخر بناء — يُعاد البناء كاملًا عند القراءة
+                HaulCheckpoint.objects.filter(user_id=user_id, kind=rec.kind).delete()
+                rec.delete()
+                continue
+            replay = HaulReplay.from_record(rec, haul_nisab_usd(rec.kind, assets))
+            rows = [
+                (t.id, t.asset_id, t.transfer_type, t.quantity, t.transfer_date,
+                 asset_value_micro(t.quantity, by_id[t.asset_id]))
+                for t in new if asset_kind(by_id[t.asset_id]) in HAUL_KINDS[rec.kind]
+            ]
+            if not rows:
+                continue
+            if not replay.is_after(rows[0][4], rows[0][0]):
+                backdated.add(rec.kind)
+                continue
+            _replay_rows(replay, rows, user_id, rec.kind, key)
+            _save_haul_state(user_id, rec.kind, key, replay)
+
+    if backdated:
+        rebuild_haul_states(user_id, new[0].transfer_date, sorted(backdated))
+
+
+# -------- أحداث الدفتر (تُستدعى من الواجهات ولوحة الإدارة) --------
+def note_transfer_created(transfer: Transfer) -> None:
+    advance_haul_states(transfer)
+    bump_ledger_version(transfer.user_id)
+
+def note_transfers_created(user_id: int, transfers: List[Transfer]) -> None:
+    advance_haul_states_bulk(user_id, transfers)
+    bump_ledger_version(user_id)
+
+def note_transfers_changed(user_id: int, since_dt: datetime) -> None:
+    rebuild_haul_states(user_id, since_dt)
+    bump_ledger_version(user_id)
+
+
+# -------- إدخال جماعي للمناقلات --------
+def bulk_create_transfers(user_id: int, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    يتحقق من العناصر مقابل خريطة أصول محمّلة مرة واحدة ويُدخلها بـ bulk_create
+    في معاملة واحدة. client_key (اختياري) يمنع تكرار العناصر عند إعادة إرسال الدفعة.
+    يعيد نتيجة لكل عنصر بنفس ترتيب الإدخال: created / duplicate / error.
+    """
+    from .serializers import TransferBulkItemSerializer
+
+    assets = {a.id: a for a in Asset.objects.filter(is_active=True)}
+    now = now_utc()
+
+    results: List[Dict[str, Any]] = []
+    pending: List[Tuple[Dict[str, Any], Transfer]] = []
+    seen_keys: Dict[str, int] = {}
+    for index, raw in enumerate(items):
+        result: Dict[str, Any] = {"index": index, "client_key": raw.get("client_key")}
+        results.append(result)
+
+        ser = TransferBulkItemSerializer(data=raw)
+        if not ser.is_valid():
+            result.update(status="error", errors=[str(m) for msgs in ser.errors.values() for m in msgs])
+            continue
+        data = ser.validated_data
+        if data["asset_id"] not in assets:
+            result.update(status="error", errors=["الأصل غير موجود أو غير فعّال."])
+            continue
+        key = data.get("client_key")
+        if key and key in seen_keys:
+            result.update(status="duplicate", duplicate_of_index=seen_keys[key])
+            continue
+        if key:
+            seen_keys[key] = index
+
+        pending.append((result, Transfer(
+            user_id=user_id,
+            asset_id=data["asset_id"],
+            transfer_type=data["transfer_type"],
+            quantity=data["quantity"],
+            transfer_date=data.get("transfer_date") or now,
+            note=data.get("note", ""),
+            client_key=key,
+        )))
+
+    created: List[Transfer] = []
+    for attempt in range(2):
+        keys = [t.client_key for _, t in pending if t.client_key]
+        existing = dict(Transfer.objects.filter(user_id=user_id, client_key__in=keys)
+                        .values_list("client_key", "id")) if keys else {}
+        to_create = []
+        for result, t in pending:
+            if t.client_key in existing:
+                result.update(status="duplicate", transfer_id=existing[t.client_key])
+            else:
+                to_create.append((result, t))
+        try:
+            with transaction.atomic():
+                created = Transfer.objects.bulk_create([t for _, t in to_create])
+                # bulk_create لا يرسل إشارات الحفظ: نحدّث الأرصدة في نفس المعاملة
+                apply_holding_deltas(holding_deltas(
+                    (t.user_id, t.asset_id, t.transfer_type, t.quantity) for t in created
+                ))
+            break
+        except IntegrityError:
+            # دفعة متزامنة أدخلت نفس المفاتيح بيننا — أعد القراءة مرة واحدة
+            if attempt:
+                raise
+
+    for (result, _), t in zip(to_create, created):
+        result.update(status="created", transfer_id=t.id)
+
+    if created:
+        # غالبًا كلها بتاريخ الآن: تقدّم تزايدي، وإعادة البناء فقط لمناقلة بتاريخ سابق
+        note_transfers_created(user_id, created)
+
+    return {
+        "created": len(created),
+        "duplicates": sum(1 for r in results if r.get("status") == "duplicate"),
+        "failed": sum(1 for r in results if r.get("status") == "error"),
+        "results": results,
+    }
+
+
+# -------- حساب فئة واحدة (ذهب/فضة/أموال) --------
+def class_holdings(ledger: UserLedger, kind: str, display: Optional[Asset]) -> Tuple[List[Dict[str, Any]], Decimal]:
+    """عناصر الفئة (صافي كمية كل أصل + قيمته) وإجماليها بالدولار — بدون أي حساب للحول."""
+    items: List[Dict[str, Any]] = []
+    total_micro = 0
+    for a in ledger.assets_by_kind[kind]:
+        net = ledger.net_micro_by_asset.get(a.id, 0)
+        if net == 0:
+            continue
+
+        val_micro = mul_micro(net, to_micro(a.unit_price_usd))
+        val_usd = from_micro(val_micro)
+        items.append({
+            "asset_id": a.id, "asset_code": a.asset_code,
+            "unit": "gram" if a.unit_name == "gram" else "amount",
+            "quantity": str(from_micro(net)), "value_usd": str(val_usd),
+            "value_display": str(usd_to_display(val_usd, display)),
+        })
+        total_micro += val_micro
+
+    return items, from_micro(total_micro)
 
-    total_usd = DEC6(total_usd)
 
-    # خط الزمن للفئة (بالدولار) + نافذة الحول
-    running_usd, timeline = running_balance_usd_for_class(user, assets)
-    haul = haul_window_from_timeline(timeline, nisab_usd)
+def compute_class_snapshot(user: User, kind: str, ledger: Optional[UserLedger] = None) -> Dict[str, Any]:
+    if kind not in ASSET_CLASSES:
+        raise ValueError("Unknown kind")
+    if ledger is None:
+        ledger = load_user_ledger(user)
+
+    display = ledger.display_currency()
+    nisab_usd = ledger.nisab_usd(kind)
+    items, total_usd = class_holdings(ledger, kind, display)
+
+    # حالة الحول المحفوظة للفئة (بدل إعادة تشغيل خط الزمن كاملًا)
+    state = ledger.haul_state(kind)
+    running_usd = state.running
+    haul = state.window()
 
     # الواجب الزكوي (قد يكون عن سنة واحدة أو عدة سنوات مكتملة)
     zakat_due_usd = Decimal("0")
@@ -299,7 +922,7 @@ def compute_class_snapshot(user: User, kind: str) -> Dict[str, Any]:
         # في الوضع الطبيعي start لن يكون None هنا، لكن نتحوّط
         if start is not None:
             #  1) احسب جميع الحوالات المكتملة من بداية هذه الشريحة
-            cycles = compute_overdue_zakat_cycles(timeline, start, nisab_usd)
+            cycles = state.overdue_cycles()
         else:
             cycles = []
 
@@ -311,7 +934,7 @@ def compute_class_snapshot(user: User, kind: str) -> Dict[str, Any]:
 
             # مجموع ما دُفع من الزكاة منذ أول موعد استحقاق
             # (أي دفعات زائدة تُعتبر مقدّمة للسنوات التالية)
-            total_paid = total_zakat_out_since(user, assets, first_due)
+            total_paid = ledger.zakat_out_since((kind,), first_due)
 
             # وزّع المدفوع على الحوالات بالترتيب (FIFO: الأقدم فالأقدم)
             total_remaining, earliest_unpaid_due = allocate_paid_over_cycles(total_paid, cycles)
@@ -355,10 +978,10 @@ def compute_class_snapshot(user: User, kind: str) -> Dict[str, Any]:
             #  fallback: لو لأي سبب لم تُستخرج دورات متعددة، نعود للمنطق السابق (حول واحد)
             due_at = haul["next_due_date"]  # تاريخ الاستحقاق
 
-            base_usd_at_due = value_at_datetime_from_timeline(timeline, due_at)
+            base_usd_at_due = state.value_at_due(1)
             required = DEC6(base_usd_at_due * Decimal(str(ZAKAT_RATE)))
 
-            paid = total_zakat_out_since(user, assets, due_at)
+            paid = ledger.zakat_out_since((kind,), due_at)
             remaining = required - paid
 
             if remaining <= 0:
@@ -417,11 +1040,14 @@ def build_notifications_for_class(class_snapshot: Dict[str, Any]) -> List[str]:
         return msgs
     for d in ZAKAT_REMINDER_OFFSETS:
         if days_left == d:
-            msgs.append("حان موعد الزكاة اليوم." if d == 0 else f"تبقّى {d} يومًا على موعد الزكاة.")
+            msgs.append(reminder_message(d))
     return msgs
 
+def reminder_message(days_left: int) -> str:
+    return "حان موعد الزكاة اليوم." if days_left == 0 else f"تبقّى {days_left} يومًا على موعد الزكاة."
+
 
-def compute_combined_gold_money_zakat(user: User) -> Decimal:
+def compute_combined_gold_money_zakat(user: User, ledger: Optional[UserLedger] = None) -> Decimal:
     """
     تحسب الزكاة الواجبة (بالدولار) على مجموع الأثمان:
       - Gold (gram)
@@ -430,23 +1056,17 @@ def compute_combined_gold_money_zakat(user: User) -> Decimal:
     بنفس منطق الحول المتعدد والزكاة المتأخرة.
     النتيجة: إجمالي الزكاة المستحقة الآن على الكل.
     """
+    if ledger is None:
+        ledger = load_user_ledger(user)
 
     # جميع أصول الأثمان
-    gold_assets = list(Asset.objects.filter(name="Gold", unit_name="gram", is_active=True))
-    silver_assets = list(Asset.objects.filter(name="Silver", unit_name="gram", is_active=True))
-    money_assets = list(Asset.objects.filter(name="Money", unit_name="amount", is_active=True))
-
-    assets = gold_assets + silver_assets + money_assets
+    assets = ledger.assets_for(COMBINED_KINDS)
     if not assets:
         return Decimal("0")
 
-    # خط الزمن لقيمة المجموع (ذهب + فضة + أموال)
-    running_usd, timeline = running_balance_usd_for_class(user, assets)
-
-    # نصاب المال بناء على الإعداد NISAB_BENCHMARK_FOR_MONEY (ذهب/فضة)
-    nisab_usd = nisab_usd_for_money()
-
-    haul = haul_window_from_timeline(timeline, nisab_usd)
+    # حالة حول المجموع (ذهب + فضة + أموال) بنصاب المال حسب NISAB_BENCHMARK_FOR_MONEY
+    state = ledger.haul_state("combined")
+    haul = state.window()
     zakat_due_usd = Decimal("0")
 
     # فقط لو المال الآن فوق النصاب ومر عليه حول قمري كامل
@@ -454,7 +1074,7 @@ def compute_combined_gold_money_zakat(user: User) -> Decimal:
         start = haul["haul_started_at"]
 
         if start is not None:
-            cycles = compute_overdue_zakat_cycles(timeline, start, nisab_usd)
+            cycles = state.overdue_cycles()
         else:
             cycles = []
 
@@ -463,7 +1083,7 @@ def compute_combined_gold_money_zakat(user: User) -> Decimal:
             first_due = cycles[0]["due_at"]
 
             # مجموع ما دفعه المستخدم كزكاة (ZAKAT_OUT) منذ أول استحقاق
-            total_paid = total_zakat_out_since(user, assets, first_due)
+            total_paid = ledger.zakat_out_since(COMBINED_KINDS, first_due)
 
             # وزّع المدفوع على السنوات بالترتيب (FIFO)
             total_remaining, earliest_unpaid_due = allocate_paid_over_cycles(total_paid, cycles)
@@ -474,139 +1094,239 @@ def compute_combined_gold_money_zakat(user: User) -> Decimal:
     return zakat_due_usd
 
 
-def compute_user_snapshot(user: User) -> Dict[str, Any]:
-    display = get_display_currency(user)
-
-    # اللقطات المنفصلة لكل فئة (كما هي – لا نغيّر منطقها الداخلي)
-    gold = compute_class_snapshot(user, "gold")
-    silver = compute_class_snapshot(user, "silver")
-    money = compute_class_snapshot(user, "money")
-
-    # إجمالي القيمة بالدولار
-    total_usd = DEC6(
-        Decimal(gold["total_value_usd"]) +
-        Decimal(silver["total_value_usd"]) +
-        Decimal(money["total_value_usd"])
-    )
-
-    # --- جديد: زكاة مجموع الأثمان (ذهب + فضة + أموال) ---
-    combined_zakat_usd = compute_combined_gold_money_zakat(user)
-    combined_zakat_usd = DEC6(combined_zakat_usd)
-    combined_zakat_display = usd_to_display(combined_zakat_usd, display)
-
-    # نضع الزكاة النهائية في "money" فقط كما تريد
-    # ونصفّر الزكاة الظاهرة في الذهب والفضة (عرض فقط، لا يمس الحول أو الحساب الداخلي)
-    zero_usd = Decimal("0")
-    zero_display = usd_to_display(zero_usd, display)
-
-    gold["zakat"]["zakat_due_usd"] = "0"
-    gold["zakat"]["zakat_due_display"] = str(zero_display)
-
-    silver["zakat"]["zakat_due_usd"] = "0"
-    silver["zakat"]["zakat_due_display"] = str(zero_display)
-
-    money["zakat"]["zakat_due_usd"] = str(combined_zakat_usd)
-    money["zakat"]["zakat_due_display"] = str(combined_zakat_display)
+# أقسام اللقطة التي تحسبها compute_user_snapshot (profile و transfers تضيفهما الواجهة)
+SNAPSHOT_SECTIONS = ("display_currency", "totals", "classes", "notifications")
 
-    # الإشعارات تبقى تبع كل فئة كما هي (اعتمادًا على haul لكل واحدة)
-    notifications: List[str] = []
-    notifications += build_notifications_for_class(gold)
-    notifications += build_notifications_for_class(silver)
-    notifications += build_notifications_for_class(money)
+def parse_snapshot_selection(fields: Optional[str], classes: Optional[str], allowed_fields=SNAPSHOT_SECTIONS):
+    """
+    "totals,classes" → ("totals", "classes") بالترتيب القياسي؛ None/فارغ → الكل.
+    ValueError عند اسم غير معروف.
+    """
+    def pick(value, allowed, label):
+        if not value:
+            return tuple(allowed)
+        wanted = {v.strip() for v in value.split(",") if v.strip()}
+        unknown = wanted - set(allowed)
+        if unknown:
+            raise ValueError(f"Unknown {label}: {', '.join(sorted(unknown))}")
+        return tuple(v for v in allowed if v in wanted)
+
+    return pick(fields, allowed_fields, "fields"), pick(classes, tuple(ASSET_CLASSES), "classes")
+
+def snapshot_ledger_kinds(fields, classes) -> Tuple[str, ...]:
+    """
+    الفئات التي يجب تحميل مناقلاتها: زكاة "money" تُحسب على مجموع الأثمان فتحتاج الكل.
+    الإجماليات وحدها لا تحتاج مناقلات (جدول الأرصدة).
+    """
+    if "classes" not in fields and "notifications" not in fields:
+        return ()
+    if "money" in classes:
+        return tuple(ASSET_CLASSES)
+    return tuple(classes)
 
-    return {
-        "display_currency": {
+def compute_user_snapshot(user: User, fields=None, classes=None) -> Dict[str, Any]:
+    """
+    اللقطة كاملة افتراضيًا، أو أجزاء منها فقط:
+      fields  ⊆ SNAPSHOT_SECTIONS — totals وحدها لا تشغّل الحول إطلاقًا
+      classes ⊆ gold/silver/money — لا تُحمَّل ولا تُحسب الفئات الأخرى (الإجماليات تشملها فقط)
+    """
+    fields = SNAPSHOT_SECTIONS if fields is None else tuple(fields)
+    classes = tuple(ASSET_CLASSES) if classes is None else tuple(classes)
+
+    # تحميل واحد للدفتر يخدم كل المراحل (عدد استعلامات ثابت مهما كثرت الأصول)
+    ledger = load_user_ledger(user, kinds=snapshot_ledger_kinds(fields, classes))
+    display = ledger.display_currency()
+
+    # اللقطات المنفصلة لكل فئة (كما هي – لا نغيّر منطقها الداخلي) — فقط إن طُلبت
+    snaps: Dict[str, Dict[str, Any]] = {}
+    if "classes" in fields or "notifications" in fields:
+        for kind in classes:
+            snaps[kind] = compute_class_snapshot(user, kind, ledger)
+
+        # --- جديد: زكاة مجموع الأثمان (ذهب + فضة + أموال) ---
+        # نضع الزكاة النهائية في "money" فقط كما تريد
+        # ونصفّر الزكاة الظاهرة في الذهب والفضة (عرض فقط، لا يمس الحول أو الحساب الداخلي)
+        zero_display = usd_to_display(Decimal("0"), display)
+        for kind in ("gold", "silver"):
+            if kind in snaps:
+                snaps[kind]["zakat"]["zakat_due_usd"] = "0"
+                snaps[kind]["zakat"]["zakat_due_display"] = str(zero_display)
+        if "money" in snaps:
+            combined_zakat_usd = DEC6(compute_combined_gold_money_zakat(user, ledger))
+            snaps["money"]["zakat"]["zakat_due_usd"] = str(combined_zakat_usd)
+            snaps["money"]["zakat"]["zakat_due_display"] = str(usd_to_display(combined_zakat_usd, display))
+
+    out: Dict[str, Any] = {}
+    if "display_currency" in fields:
+        out["display_currency"] = {
             "asset_id": (display.id if display else None),
             "asset_code": (display.asset_code if display else "USD"),
             "unit_price_usd": str(display.unit_price_usd) if display else "1.000000",
-        },
-        "totals": {
+        }
+    if "totals" in fields:
+        # إجمالي القيمة بالدولار (من عناصر الفئات فقط — بدون حول)؛ الفئات غير المحسوبة
+        # من جدول الأرصدة × الأسعار الحالية بقراءة واحدة
+        total_usd = DEC6(sum((Decimal(snaps[kind]["total_value_usd"]) for kind in classes if kind in snaps),
+                             Decimal("0")))
+        missing = [a for kind in classes if kind not in snaps for a in ledger.assets_by_kind[kind]]
+        if missing:
+            total_usd = DEC6(total_usd + holdings_total_usd(user, missing))
+        out["totals"] = {
             "total_value_usd": str(total_usd),
             "total_value_display": str(usd_to_display(total_usd, display)),
-        },
-        "classes": {
-            "gold": gold,
-            "silver": silver,
-            "money": money,
-        },
-        "notifications": notifications,
-    }
-
+        }
+    if "classes" in fields:
+        out["classes"] = {kind: snaps[kind] for kind in classes}
+    if "notifications" in fields:
+        # الإشعارات تبقى تبع كل فئة كما هي (اعتمادًا على haul لكل واحدة)
+        notifications: List[str] = []
+        for kind in classes:
+            notifications += build_notifications_for_class(snaps[kind])
+        out["notifications"] = notifications
+    return out
 
-# حساب الزكاة لكل اصل مختلف عن الاخر
-# def compute_user_snapshot(user: User) -> Dict[str, Any]:
-#     display = get_display_currency(user)
-
-#     gold = compute_class_snapshot(user, "gold")
-#     silver = compute_class_snapshot(user, "silver")
-#     money = compute_class_snapshot(user, "money")
-
-#     total_usd = DEC6(Decimal(gold["total_value_usd"]) + Decimal(silver["total_value_usd"]) + Decimal(money["total_value_usd"]))
-
-#     notifications: List[str] = []
-#     notifications += build_notifications_for_class(gold)
-#     notifications += build_notifications_for_class(silver)
-#     notifications += build_notifications_for_class(money)
-
-#     return {
-#         "display_currency": {
-#             "asset_id": (display.id if display else None),
-#             "asset_code": (display.asset_code if display else "USD"),
-#             "unit_price_usd": str(display.unit_price_usd) if display else "1.000000",
-#         },
-#         "totals": {
-#             "total_value_usd": str(total_usd),
-#             "total_value_display": str(usd_to_display(total_usd, display)),
-#         },
-#         "classes": {
-#             "gold": gold,
-#             "silver": silver,
-#             "money": money,
-#         },
-#         "notifications": notifications,
-#     }
 
 # -------- تجميع المناقلات للرد --------
-def grouped_transfers(user: User, limit: Optional[int] = None) -> Dict[str, List[Transfer]]:
-    gold_ids = list(Asset.objects.filter(name="Gold", unit_name="gram", is_active=True).values_list("id", flat=True))
-    silver_ids = list(Asset.objects.filter(name="Silver", unit_name="gram", is_active=True).values_list("id", flat=True))
-    money_ids = list(Asset.objects.filter(name="Money", unit_name="amount", is_active=True).values_list("id", flat=True))
+# الأعمدة التي يقرؤها TransferSerializer فقط (مع user.email و asset.asset_code بنفس الاستعلام)
+SNAPSHOT_TRANSFER_FIELDS = (
+    "id", "user", "user__email", "asset", "asset__asset_code",
+    "transfer_type", "quantity", "transfer_date", "note", "created_at", "bill",
+)
 
-    def fetch(ids):
+# -------- جدول الأرصدة (Holding) --------
+def holdings_total_usd(user: User, assets: List[Asset]) -> Decimal:
+    """إجمالي قيمة الأصول المعطاة بالأسعار الحالية: قراءة مفهرسة واحدة من جدول الأرصدة."""
+    price = {a.id: to_micro(a.unit_price_usd) for a in assets}
+    rows = (Holding.objects.filter(user=user, asset_id__in=list(price))
+            .values_list("asset_id", "net_quantity"))
+    return from_micro(sum(mul_micro(to_micro(qty), price[asset_id]) for asset_id, qty in rows))
+
+def aggregate_holdings(user_ids: Optional[List[int]] = None) -> Dict[Tuple[int, int], Decimal]:
+    """المرجع: صافي كمية كل (مستخدم، أصل) مجمّعًا من Transfer مباشرة."""
+    qs = Transfer.objects.all() if user_ids is None else Transfer.objects.filter(user_id__in=user_ids)
+    rows = (qs.order_by().values("user_id", "asset_id")
+            .annotate(added=_report_qty_sum(Q(transfer_type="ADD")),
+                      removed=_report_qty_sum(Q(transfer_type__in=("WITHDRAW", "ZAKAT_OUT")))))
+    return {
+        (r["user_id"], r["asset_id"]): DEC6(_report_qty(r["added"]) - _report_qty(r["removed"]))
+        for r in rows
+    }
+
+def reconcile_holdings(user_ids: Optional[List[int]] = None, repair: bool = False) -> List[Dict[str, Any]]:
+    """
+    يقارن جدول الأرصدة بالمجاميع من Transfer ويعيد الفروق:
+      [{"user_id", "asset_id", "expected", "actual"}]   (actual = None: الصف مفقود)
+    repair: يُصلح كل مستخدم منحرف في معاملة تقفل صفوف أرصدته ثم تعيد التجميع،
+    فلا تضيع مناقلة أُدخلت بين الفحص والإصلاح.
+    """
+    expected = aggregate_holdings(user_ids)
+    holdings = Holding.objects.all() if user_ids is None else Holding.objects.filter(user_id__in=user_ids)
+    actual = {(u, a): DEC6(q) for u, a, q in holdings.values_list("user_id", "asset_id", "net_quantity")}
+
+    drift: List[Dict[str, Any]] = []
+    for key in sorted(set(expected) | set(actual)):
+        exp = expected.get(key, DEC6(0))
+        act = actual.get(key)
+        if (DEC6(0) if act is None else act) != exp:
+            drift.append({"user_id": key[0], "asset_id": key[1], "expected": exp, "actual": act})
+
+    if repair:
+        for user_id in sorted({d["user_id"] for d in drift}):
+            with transaction.atomic():
+                current = {h.asset_id: h for h in Holding.objects.select_for_update().filter(user_id=user_id)}
+                fresh = {a: q for (_u, a), q in aggregate_holdings([user_id]).items()}
+                for asset_id in set(current) | set(fresh):
+                    value = fresh.get(asset_id, DEC6(0))
+                    row = current.get(asset_id)
+                    if row is None:
+                        if value:
+                            Holding.objects.create(user_id=user_id, asset_id=asset_id, net_quantity=value)
+                    elif DEC6(row.net_quantity) != value:
+                        row.net_quantity = value
+                        row.save(update_fields=["net_quantity", "updated_at"])
+    return drift
+
+
+def grouped_transfers(user: User, limit: Optional[int] = None, kinds=None) -> Dict[str, List[Transfer]]:
+    """استعلام واحد لكل فئة مطلوبة مهما كان عدد المناقلات (بدون N+1 عند التسلسل)."""
+    def fetch(kind):
+        f = ASSET_CLASSES[kind]
         qs = (Transfer.objects
-              .filter(user=user, asset_id__in=ids)
+              .filter(user=user, asset__is_active=True,
+                      asset__name=f["name"], asset__unit_name=f["unit_name"])
+              .select_related("user", "asset")
+              .only(*SNAPSHOT_TRANSFER_FIELDS)
               .order_by("-transfer_date", "-id"))
         return list(qs[:limit]) if limit else list(qs)
 
-    return {
-        "gold": fetch(gold_ids),
-        "silver": fetch(silver_ids),
-        "money": fetch(money_ids),
-    }
+    return {kind: fetch(kind) for kind in (kinds or ASSET_CLASSES)}
 
 
 ######################################################
 ######################################################
 ######################################################
 # Update Currencies and Metals
-def update_currency_assets_from_erapi() -> dict:
+def apply_price_changes(changes: List[Tuple[Asset, Decimal]], source: str) -> int:
+    """
+    يكتب الأسعار المتغيّرة [(asset, new_price)] بعبارة UPDATE واحدة داخل معاملة قصيرة،
+    ويزيد نسخة الأسعار، ويسجّل (القديم، الجديد) لكل أصل في PriceChange
+    ويضيف السعر الجديد إلى السجل التاريخي AssetPrice. تقييم فهرس هامش النصاب
+    (فقط من قد يكون عبر النصاب يُعاد تقييمه ويُسجَّل له HaulEvent) يُؤجَّل إلى ما بعد
+    تثبيت المعاملة (on_commit) فلا يطيل معاملة الأسعار ولا معاملة المستدعي المحيطة.
+    يعيد نسخة الأسعار الجديدة (أو 0 إن لم يتغيّر شيء).
+    """
+    from .nisab_index import process_price_tick
+
+    if not changes:
+        return 0
+
+    now = timezone.now()
+    journal, history = [], []
+    for a, new_price in changes:
+        journal.append(PriceChange(asset_id=a.id, old_price_usd=a.unit_price_usd,
+                                   new_price_usd=new_price, source=source))
+        history.append(AssetPrice(asset_id=a.id, price_usd=new_price, effective_at=now, source=source))
+        a.unit_price_usd = new_price
+
+    with transaction.atomic():
+        Asset.objects.bulk_update([a for a, _ in changes], ["unit_price_usd"])
+        version = bump_price_version()
+        for row in journal:
+            row.price_version = version
+        PriceChange.objects.bulk_create(journal)
+        AssetPrice.objects.bulk_create(history)
+        # robust: الأسعار ثُبّتت؛ إخفاق التقييم يُسجَّل ولا يفشل التحديث، والدفعة التالية
+        # (أو rebuild_nisab_index) تعيد تقييم من بقي داخل نافذة العبور
+        transaction.on_commit(lambda: process_price_tick(get_asset_registry(version)), robust=True)
+    return version
+
+def fetch_erapi_payload(http=requests) -> dict:
+    """http: وحدة requests أو Session مشتركة (اتصالات keep-alive)."""
+    resp = http.get(ERAPI_URL, timeout=15)
+    resp.raise_for_status()
+    return resp.json()
+
+def currency_rate_assets() -> List[Asset]:
+    return list(Asset.objects.filter(name="Money", unit_name="amount", is_active=True)
+                .only("id", "asset_code", "unit_price_usd"))
+
+def metal_rate_assets() -> List[Asset]:
+    return list(Asset.objects.filter(asset_code__in=METAL_RATE_CODES, is_active=True)
+                .only("id", "asset_code", "unit_name", "unit_price_usd"))
+
+def plan_currency_changes(payload: dict, assets: Optional[List[Asset]] = None) -> Tuple[List[Tuple[Asset, Decimal]], dict]:
+    """
+    من حمولة ER-API: (الأسعار المتغيّرة [(asset, new_price)]، التقرير) بدون كتابة.
+    assets (currency_rate_assets) تُمرَّر مقروءة مسبقًا لتقييم الحمولة بلا استعلامات.
+    """
     from .models import Asset
 
     updated, skipped, missing_code, errors = [], [], [], []
 
-    try:
-        resp = requests.get(ERAPI_URL, timeout=15)
-        resp.raise_for_status()
-        payload = resp.json()
-    except Exception as e:
-        return {"status": "error", "message": [f"HTTP/JSON error: {e}"],
-                "updated": updated, "skipped": skipped,
-                "missing_code": missing_code, "errors": errors}
-
     if payload.get("result") != "success" or "rates" not in payload:
-        return {"status": "error", "message": ["Unexpected payload from ER-API."],
-                "updated": updated, "skipped": skipped,
-                "missing_code": missing_code, "errors": errors}
+        return [], {"status": "error", "message": ["Unexpected payload from ER-API."],
+                    "updated": updated, "skipped": skipped,
+                    "missing_code": missing_code, "errors": errors}
 
     rates = payload["rates"]
 
@@ -614,43 +1334,38 @@ def update_currency_assets_from_erapi() -> dict:
     dec_places = getattr(Asset._meta.get_field("unit_price_usd"), "decimal_places", 6)
     q = Decimal("1").scaleb(-dec_places)  # مثال: 6 -> Decimal('0.000001')
 
-    qs = Asset.objects.filter(name="Money", unit_name="amount", is_active=True)
+    # نحسب كل الأسعار المتغيّرة في الذاكرة بدون أقفال، ثم نكتبها دفعة واحدة
+    if assets is None:
+        assets = currency_rate_assets()
+    changes = []
+    for a in assets:
+        code = (a.asset_code or "").upper().strip()
+        if not code:
+            missing_code.append(a.id)
+            continue
+        if code not in rates:
+            skipped.append({"asset_id": a.id, "code": code, "reason": "code_not_in_response"})
+            continue
 
-    @transaction.atomic
-    def _do_update():
-        for a in qs.select_for_update():
-            code = (a.asset_code or "").upper().strip()
-            if not code:
-                missing_code.append(a.id)
+        try:
+            per_usd = Decimal(str(rates[code]))  # كم عملة أجنبية مقابل 1 USD
+            if per_usd <= 0:
+                skipped.append({"asset_id": a.id, "code": code, "reason": "non_positive_rate"})
                 continue
-            if code not in rates:
-                skipped.append({"asset_id": a.id, "code": code, "reason": "code_not_in_response"})
-                continue
-
-            try:
-                per_usd = Decimal(str(rates[code]))  # كم عملة أجنبية مقابل 1 USD
-                if per_usd <= 0:
-                    skipped.append({"asset_id": a.id, "code": code, "reason": "non_positive_rate"})
-                    continue
 
-                usd_per_unit = (Decimal("1") / per_usd).quantize(q, rounding=ROUND_HALF_UP)
+            usd_per_unit = (Decimal("1") / per_usd).quantize(q, rounding=ROUND_HALF_UP)
 
-                if a.unit_price_usd != usd_per_unit:
-                    old = a.unit_price_usd
-                    a.unit_price_usd = usd_per_unit
-                    # ملاحظة: أزلنا updated_at لأنه غير موجود في الموديل
-                    a.save(update_fields=["unit_price_usd"])
-                    updated.append({"asset_id": a.id, "code": code, "old": str(old), "new": str(usd_per_unit)})
-                else:
-                    skipped.append({"asset_id": a.id, "code": code, "reason": "no_change"})
-            except (InvalidOperation, Exception) as e:
-                errors.append({"asset_id": a.id, "code": code, "error": str(e)})
-
-    _do_update()
+            if a.unit_price_usd != usd_per_unit:
+                changes.append((a, usd_per_unit))
+                updated.append({"asset_id": a.id, "code": code, "old": str(a.unit_price_usd), "new": str(usd_per_unit)})
+            else:
+                skipped.append({"asset_id": a.id, "code": code, "reason": "no_change"})
+        except (InvalidOperation, Exception) as e:
+            errors.append({"asset_id": a.id, "code": code, "error": str(e)})
 
-    return {
+    return changes, {
         "status": "ok",
-        "message": [f"Processed {qs.count()} money assets"],
+        "message": [f"Processed {len(assets)} money assets"],
         "updated": updated, "skipped": skipped,
         "missing_code": missing_code, "errors": errors,
         "time_last_update_utc": payload.get("time_last_update_utc"),
@@ -664,34 +1379,25 @@ def _quantize_to_field(value: Decimal, model_cls, field_name: str) -> Decimal:
     q = Decimal("1").scaleb(-dec_places)  # مثال: 6 -> 0.000001
     return value.quantize(q, rounding=ROUND_HALF_UP)
 
-def update_metals_assets_from_metalpriceapi(api_key: str) -> dict:
-    """
-    يجلب سعر الذهب/الفضة من metalpriceapi (USD base) ويحدّث:
-      GOLD_24, GOLD_21, GOLD_19  (بالغرام)
-      SILVER (بالغرام)
-    """
+def fetch_metal_payload(api_key: str, http=requests) -> dict:
+    resp = http.get(
+        METAL_API_URL,
+        params={"api_key": api_key, "base": "USD", "currencies": "XAU,XAG"},
+        timeout=15,
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+def plan_metal_changes(payload: dict, assets: Optional[List[Asset]] = None) -> Tuple[List[Tuple[Asset, Decimal]], dict]:
+    """من حمولة metalpriceapi: (الأسعار المتغيّرة، التقرير) بدون كتابة. assets: metal_rate_assets."""
     from .models import Asset
 
     updated, skipped, missing, errors = [], [], [], []
 
-    # --- 1) جلب البيانات من API ---
-    try:
-        resp = requests.get(
-            METAL_API_URL,
-            params={"api_key": api_key, "base": "USD", "currencies": "XAU,XAG"},
-            timeout=15,
-        )
-        resp.raise_for_status()
-        payload = resp.json()
-    except Exception as e:
-        return {"status": "error", "message": [f"HTTP/JSON error: {e}"],
-                "updated": updated, "skipped": skipped,
-                "missing": missing, "errors": errors}
-
     if not payload.get("success"):
-        return {"status": "error", "message": ["Unexpected payload from metalpriceapi."],
-                "updated": updated, "skipped": skipped,
-                "missing": missing, "errors": errors}
+        return [], {"status": "error", "message": ["Unexpected payload from metalpriceapi."],
+                    "updated": updated, "skipped": skipped,
+                    "missing": missing, "errors": errors}
 
     rates = payload.get("rates") or {}
     # نحاول أخذ USD/oz مباشرة؛ وإلا نستخدم 1 / XAU (oz/USD) كاحتياط
@@ -701,9 +1407,9 @@ def update_metals_assets_from_metalpriceapi(api_key: str) -> dict:
         if usd_per_oz_gold <= 0 or usd_per_oz_silver <= 0:
             raise InvalidOperation("Non-positive metal rate")
     except Exception as e:
-        return {"status": "error", "message": [f"Bad metal rates: {e}"],
-                "updated": updated, "skipped": skipped,
-                "missing": missing, "errors": errors}
+        return [], {"status": "error", "message": [f"Bad metal rates: {e}"],
+                    "updated": updated, "skipped": skipped,
+                    "missing": missing, "errors": errors}
 
     # --- 2) تحويل إلى دولار/غرام ---
     gold24_usd_per_g = usd_per_oz_gold  / OUNCE_TROY_TO_GRAM
@@ -721,34 +1427,30 @@ def update_metals_assets_from_metalpriceapi(api_key: str) -> dict:
         "SILVER":  silver_usd_per_g,
     }
 
-    qs = Asset.objects.filter(asset_code__in=list(targets.keys()), is_active=True)
-
-    @transaction.atomic
-    def _do_update():
-        for a in qs.select_for_update():
-            try:
-                new_val = _quantize_to_field(targets[a.asset_code], Asset, "unit_price_usd")
-                if a.unit_name != "gram":
-                    # لتجنّب أي ارتباك لو كانت الوحدة مختلفة
-                    skipped.append({"asset_id": a.id, "code": a.asset_code, "reason": f"unexpected_unit:{a.unit_name}"})
-                    continue
-                if a.unit_price_usd != new_val:
-                    old = a.unit_price_usd
-                    a.unit_price_usd = new_val
-                    a.save(update_fields=["unit_price_usd"])
-                    updated.append({"asset_id": a.id, "code": a.asset_code, "old": str(old), "new": str(new_val)})
-                else:
-                    skipped.append({"asset_id": a.id, "code": a.asset_code, "reason": "no_change"})
-            except KeyError:
-                missing.append({"asset_id": a.id, "code": a.asset_code})
-            except Exception as e:
-                errors.append({"asset_id": a.id, "code": a.asset_code, "error": str(e)})
-
-    _do_update()
+    # نحسب كل الأسعار المتغيّرة في الذاكرة بدون أقفال، ثم نكتبها دفعة واحدة
+    if assets is None:
+        assets = metal_rate_assets()
+    changes = []
+    for a in assets:
+        try:
+            new_val = _quantize_to_field(targets[a.asset_code], Asset, "unit_price_usd")
+            if a.unit_name != "gram":
+                # لتجنّب أي ارتباك لو كانت الوحدة مختلفة
+                skipped.append({"asset_id": a.id, "code": a.asset_code, "reason": f"unexpected_unit:{a.unit_name}"})
+                continue
+            if a.unit_price_usd != new_val:
+                changes.append((a, new_val))
+                updated.append({"asset_id": a.id, "code": a.asset_code, "old": str(a.unit_price_usd), "new": str(new_val)})
+            else:
+                skipped.append({"asset_id": a.id, "code": a.asset_code, "reason": "no_change"})
+        except KeyError:
+            missing.append({"asset_id": a.id, "code": a.asset_code})
+        except Exception as e:
+            errors.append({"asset_id": a.id, "code": a.asset_code, "error": str(e)})
 
-    return {
+    return changes, {
         "status": "ok",
-        "message": [f"Processed {qs.count()} metal assets"],
+        "message": [f"Processed {len(assets)} metal assets"],
         "updated": updated, "skipped": skipped,
         "missing": missing, "errors": errors,
         "timestamp": payload.get("timestamp"),
@@ -760,15 +1462,143 @@ def _q(val: Decimal, places=6) -> Decimal:
     q = Decimal("1").scaleb(-places)  # 6 -> 0.000001
     return (val or Decimal("0")).quantize(q, rounding=ROUND_HALF_UP)
 
-def compute_user_report(user, target_user_id: int, start_dt=None, end_dt=None) -> dict:
+# -------- تجميع التقرير في قاعدة البيانات --------
+REPORT_CLASSES = {"gold": "Gold", "silver": "Silver", "money": "Money"}
+REPORT_BUCKETS = {"added": "ADD", "withdrawn": "WITHDRAW", "zakat_out": "ZAKAT_OUT"}
+REPORT_QTY_SCALE = 10 ** Transfer._meta.get_field("quantity").decimal_places
+
+def _report_qty_sum(f: Q):
     """
-    يحسب تقرير التحويلات (Transfers) لمستخدم معيّن.
-    - الأصول المُضافة: نوع ADD
-    - الأصول المسحوبة: نوع WITHDRAW
-    - الزكاة المدفوعة: نوع ZAKAT_OUT
-    * الذهب/الفضة: كمية بالغرام وقيمتها USD و بعملة العرض
-    * الأموال: لا تُعاد الكمية، فقط القيم USD و بعملة العرض
-    * عملة العرض: display_currency على المستخدم؛ وإن لم توجد → USD
+    Sum(quantity) شرطي. SQLite يخزّن العشري كـ REAL ويجمعه بفاصلة عائمة،
+    لذا نجمع هناك وحدات صحيحة (quantity × 10^6) ثم نقسم في بايثون لنبقى مطابقين لـ Decimal.
+    القواعد الأخرى تجمع NUMERIC بدقة تامة فتبقى Sum العادية.
+    """
+    if connection.vendor == "sqlite":
+        # Round قبل Cast ضروري: 0.000249 × 10^6 بفاصلة عائمة = 248.99999999999997
+        # و CAST يقطع إلى 248. الكمية بست خانات وأقل من 2^53 وحدة صغرى، فأقرب عدد صحيح
+        # هو قيمتها الدقيقة دائمًا.
+        return Sum(Cast(Round(F("quantity") * REPORT_QTY_SCALE), BigIntegerField()), filter=f)
+    return Sum("quantity", filter=f)
+
+def _report_qty(value) -> Decimal:
+    if not value:
+        return Decimal("0")
+    if isinstance(value, int):
+        return Decimal(value) / REPORT_QTY_SCALE
+    return value
+
+def _report_annotations(windows: Dict[str, Optional[Q]]) -> Dict[str, Any]:
+    annotations = {}
+    for w, wq in windows.items():
+        for bucket, ttype in REPORT_BUCKETS.items():
+            f = Q(transfer_type=ttype)
+            if wq is not None:
+                f &= wq
+            annotations[f"{w}__{bucket}"] = _report_qty_sum(f)
+    return annotations
+
+def _empty_report_totals(windows) -> Dict[str, Dict[str, Dict[str, Dict[str, Decimal]]]]:
+    return {
+        w: {b: {cls: {"qty": Decimal("0"), "usd": Decimal("0")} for cls in REPORT_CLASSES} for b in REPORT_BUCKETS}
+        for w in windows
+    }
+
+def _accumulate_report_row(totals, row: dict) -> None:
+    cls = row["asset__name"].strip().lower()
+    price = row["asset__unit_price_usd"] or Decimal("0")
+    for w, buckets in totals.items():
+        for bucket in REPORT_BUCKETS:
+            qty = _report_qty(row[f"{w}__{bucket}"])
+            if qty:
+                t = buckets[bucket][cls]
+                t["qty"] += qty
+                t["usd"] += qty * price
+
+def report_totals(qs, windows: Optional[Dict[str, Optional[Q]]] = None) -> Dict[str, Dict[str, Dict[str, Dict[str, Decimal]]]]:
+    """
+    استعلام تجميعي واحد: Sum(quantity) شرطي لكل (نافذة × نوع مناقلة)، مجمّعًا حسب
+    (asset.name, unit_price_usd) — صف لكل سعر أصل تقريبًا بدل كل المناقلات.
+    القيمة بالدولار = مجموع الكمية × السعر بـ Decimal (مساوٍ تمامًا لجمع quantity × price
+    لكل مناقلة، ولا يعتمد على حساب الأعداد العشرية في قاعدة البيانات).
+    يعيد: {window: {bucket: {cls: {"qty": Decimal, "usd": Decimal}}}}
+    """
+    windows = windows or {"all": None}
+    totals = _empty_report_totals(windows)
+    rows = (qs.filter(asset__name__in=REPORT_CLASSES.values())
+            .order_by()
+            .values("asset__name", "asset__unit_price_usd")
+            .annotate(**_report_annotations(windows)))
+    for r in rows:
+        _accumulate_report_row(totals, r)
+    return totals
+
+REPORT_SERIES_PERIODS = {"month": TruncMonth, "week": TruncWeek}
+
+def report_series(qs, period: str) -> List[Tuple[datetime, Dict[str, Dict[str, Dict[str, Decimal]]]]]:
+    """
+    سلسلة زمنية (شهرية/أسبوعية) بنفس بنية report_totals لكل فترة، في استعلام تجميعي واحد.
+    يعيد [(بداية الفترة, totals)] مرتبة تصاعديًا؛ الفترات الخالية لا تظهر.
+    """
+    trunc = REPORT_SERIES_PERIODS[period]
+    windows = {"all": None}
+    series: Dict[datetime, dict] = {}
+    rows = (qs.filter(asset__name__in=REPORT_CLASSES.values())
+            .order_by()
+            .annotate(period_start=trunc(TRANSFER_DATE_FIELD))
+            .values("period_start", "asset__name", "asset__unit_price_usd")
+            .annotate(**_report_annotations(windows)))
+    for r in rows:
+        totals = series.setdefault(r["period_start"], _empty_report_totals(windows))
+        _accumulate_report_row(totals, r)
+    return [(start, series[start]["all"]) for start in sorted(series)]
+
+def report_buckets(totals: Dict[str, Dict[str, Dict[str, Decimal]]], to_display) -> Tuple[dict, dict, dict]:
+    """يبني خانات التقرير (added/withdrawn/zakat_out) من نافذة واحدة من report_totals."""
+    out = []
+    for bucket in REPORT_BUCKETS:
+        b: Dict[str, Dict[str, Decimal]] = {}
+        for cls in REPORT_CLASSES:
+            t = totals[bucket][cls]
+            value_usd = _q(t["usd"])
+            if cls == "money":  # لا كمية للأموال
+                b[cls] = {"value_usd": value_usd, "value_display": to_display(value_usd)}
+            else:
+                b[cls] = {"quantity_gram": _q(t["qty"]), "value_usd": value_usd,
+                          "value_display": to_display(value_usd)}
+        out.append(b)
+    return out[0], out[1], out[2]
+
+REPORT_FILTERS = ("none", "last_1m", "last_3m", "last_6m", "custom")
+REPORT_FILTER_DAYS = {"last_1m": 30, "last_3m": 90, "last_6m": 180}
+
+def report_window_bounds(filt_type: str, start_date=None, end_date=None, now=None):
+    """
+    حدود التاريخ (شاملة) لفلتر التقرير: last_1m/last_3m/last_6m تنتهي بنهاية اليوم الحالي،
+    custom من بداية start_date إلى نهاية end_date، و none بدون فلترة → (None, None).
+    """
+    tz = timezone.get_current_timezone()
+    now = now or timezone.now()
+    if filt_type in REPORT_FILTER_DAYS:
+        start_dt = now - timezone.timedelta(days=REPORT_FILTER_DAYS[filt_type])
+        start_dt = datetime.combine(start_dt.date(), time.min).replace(tzinfo=tz)
+        end_dt   = datetime.combine(now.date(), time.max).replace(tzinfo=tz)
+        return start_dt, end_dt
+    if filt_type == "custom":
+        return (timezone.make_aware(datetime.combine(start_date, time.min), tz),
+                timezone.make_aware(datetime.combine(end_date, time.max), tz))
+    return None, None
+
+def _aware(dt):
+    if dt is not None and timezone.is_naive(dt):
+        return timezone.make_aware(dt, timezone.get_current_timezone())
+    return dt
+
+def compute_user_report_windows(user, target_user_id: int, windows: Dict[str, Tuple[Optional[datetime], Optional[datetime]]],
+                                series: Optional[str] = None) -> dict:
+    """
+    تقرير لعدة نوافذ زمنية دفعة واحدة: {name: (start_dt, end_dt)} — (None, None) = كل المناقلات.
+    كل النوافذ تُحسب في استعلام تجميعي واحد (Sum شرطي لكل نافذة)، ويُضاف اختياريًا
+    series = "month" | "week": سلسلة زمنية (added/withdrawn/zakat_out لكل فترة) على مدى اتحاد النوافذ.
     """
     from .models import Transfer, Asset, User
 
@@ -785,7 +1615,7 @@ def compute_user_report(user, target_user_id: int, start_dt=None, end_dt=None) -
     display_asset = getattr(target_user, "display_currency", None)  # قد تكون FK إلى Asset
     if not display_asset:
         # افتراض USD
-        display_asset = Asset.objects.filter(asset_code="USD", is_active=True).first()
+        display_asset = get_asset_registry().by_asset_code("USD")
 
     # عامل التحويل: كم (وحدة عرض) لكل 1 USD
     # note: unit_price_usd = USD per 1 unit => display_per_usd = 1 / unit_price_usd
@@ -799,107 +1629,93 @@ def compute_user_report(user, target_user_id: int, start_dt=None, end_dt=None) -
     def usd_to_display(amount_usd: Decimal) -> Decimal:
         return _q((amount_usd or Decimal("0")) * display_per_usd)
 
-    # جميع تحويلات المستخدم
-    qs = Transfer.objects.select_related("asset").filter(user_id=target_user_id)
-    if start_dt and end_dt:
-        if timezone.is_naive(start_dt):
-            start_dt = timezone.make_aware(start_dt, timezone.get_current_timezone())
-        if timezone.is_naive(end_dt):
-            end_dt = timezone.make_aware(end_dt, timezone.get_current_timezone())
-        date_filters = {
+    # الفلترة الزمنية تُطبَّق فقط عند وجود الحدّين (كما في السابق)
+    bounds = {}
+    for name, (start_dt, end_dt) in windows.items():
+        if start_dt and end_dt:
+            bounds[name] = (_aware(start_dt), _aware(end_dt))
+        else:
+            bounds[name] = (None, None)
+
+    window_q: Dict[str, Optional[Q]] = {}
+    for name, (start_dt, end_dt) in bounds.items():
+        window_q[name] = None if start_dt is None else Q(**{
             f"{TRANSFER_DATE_FIELD}__gte": start_dt,
             f"{TRANSFER_DATE_FIELD}__lte": end_dt,
-        }
-        qs = qs.filter(**date_filters)
-    # ثوابت الأنواع (كما هي في الجدول)
-    TYPE_ADD = "ADD"
-    TYPE_WITHDRAW = "WITHDRAW"
-    TYPE_ZAKAT = "ZAKAT_OUT"
+        })
 
-    # سنجمع بقيم USD: (الكمية × سعر الأصل بالدولار)
-    # ملاحظة: الأموال (Money) لها unit_name="amount" ولا نعرض quantity لها.
+    # جميع تحويلات المستخدم (على أصول فعّالة فقط) مقيّدة باتحاد النوافذ
+    qs = Transfer.objects.filter(user_id=target_user_id, asset__is_active=True)
+    if bounds and all(start_dt is not None for start_dt, _ in bounds.values()):
+        qs = qs.filter(**{
+            f"{TRANSFER_DATE_FIELD}__gte": min(start_dt for start_dt, _ in bounds.values()),
+            f"{TRANSFER_DATE_FIELD}__lte": max(end_dt for _, end_dt in bounds.values()),
+        })
 
-    def base_bucket():
-        return {
-            "gold":   {"quantity_gram": Decimal("0"), "value_usd": Decimal("0"), "value_display": Decimal("0")},
-            "silver": {"quantity_gram": Decimal("0"), "value_usd": Decimal("0"), "value_display": Decimal("0")},
-            "money":  {"value_usd": Decimal("0"), "value_display": Decimal("0")},  # لا كمية للأموال
+    # التجميع في قاعدة البيانات: استعلام واحد لكل النوافذ يعيد صفًا لكل سعر أصل
+    totals = report_totals(qs, window_q) if windows else {}
+
+    result_windows = {}
+    for name, (start_dt, end_dt) in bounds.items():
+        added, withdrawn, zakat_out = report_buckets(totals[name], usd_to_display)
+        result_windows[name] = {
+            "filter": {
+                "enabled": start_dt is not None,
+                "start": start_dt.isoformat() if start_dt else None,
+                "end":   end_dt.isoformat() if end_dt else None,
+            },
+            "added": added,
+            "withdrawn": withdrawn,
+            "zakat_out": zakat_out,
         }
 
-    added     = base_bucket()
-    withdrawn = base_bucket()
-    zakat_out = base_bucket()
-
-    # نكرّر على التحويلات ونصنّف حسب Asset.name (Gold/Silver/Money)
-    for t in qs:
-        a = t.asset
-        if not a or not a.is_active:
-            continue
-
-        cls = (a.name or "").strip().lower()  # "gold"/"silver"/"money"
-        qty = t.quantity or Decimal("0")
-        # قيمة USD: الكمية × سعر الأصل بالدولار (لكل غرام للمعادن، لكل وحدة عملة للأموال)
-        value_usd = (qty * (a.unit_price_usd or Decimal("0")))
-
-        if cls == "gold":
-            if t.transfer_type  == TYPE_ADD:
-                added["gold"]["quantity_gram"] += qty
-                added["gold"]["value_usd"] += value_usd
-            elif t.transfer_type  == TYPE_WITHDRAW:
-                withdrawn["gold"]["quantity_gram"] += qty
-                withdrawn["gold"]["value_usd"] += value_usd
-            elif t.transfer_type  == TYPE_ZAKAT:
-                zakat_out["gold"]["quantity_gram"] += qty
-                zakat_out["gold"]["value_usd"] += value_usd
-
-        elif cls == "silver":
-            if t.transfer_type  == TYPE_ADD:
-                added["silver"]["quantity_gram"] += qty
-                added["silver"]["value_usd"] += value_usd
-            elif t.transfer_type  == TYPE_WITHDRAW:
-                withdrawn["silver"]["quantity_gram"] += qty
-                withdrawn["silver"]["value_usd"] += value_usd
-            elif t.transfer_type  == TYPE_ZAKAT:
-                zakat_out["silver"]["quantity_gram"] += qty
-                zakat_out["silver"]["value_usd"] += value_usd
-
-        elif cls == "money":
-            if t.transfer_type  == TYPE_ADD:
-                added["money"]["value_usd"] += value_usd
-            elif t.transfer_type  == TYPE_WITHDRAW:
-                withdrawn["money"]["value_usd"] += value_usd
-            elif t.transfer_type  == TYPE_ZAKAT:
-                zakat_out["money"]["value_usd"] += value_usd
-
-    # تحويل USD إلى عملة العرض وتجهيز التقريب
-    for bucket in (added, withdrawn, zakat_out):
-        # gold
-        bucket["gold"]["quantity_gram"] = _q(bucket["gold"]["quantity_gram"])
-        bucket["gold"]["value_usd"] = _q(bucket["gold"]["value_usd"])
-        bucket["gold"]["value_display"] = usd_to_display(bucket["gold"]["value_usd"])
-        # silver
-        bucket["silver"]["quantity_gram"] = _q(bucket["silver"]["quantity_gram"])
-        bucket["silver"]["value_usd"] = _q(bucket["silver"]["value_usd"])
-        bucket["silver"]["value_display"] = usd_to_display(bucket["silver"]["value_usd"])
-        # money (no quantity)
-        bucket["money"]["value_usd"] = _q(bucket["money"]["value_usd"])
-        bucket["money"]["value_display"] = usd_to_display(bucket["money"]["value_usd"])
-
     # سطر سعر الصرف: "1 USD = X CODE"
     fx_line = f"1 USD = {_q(display_per_usd)} {display_code}"
 
-    return {
+    result = {
         "status": "ok",
         "display_currency": display_code,
         "fx_line": fx_line,
-        "filter": {
-            "enabled": bool(start_dt and end_dt),
-            "start": start_dt.isoformat() if start_dt else None,
-            "end":   end_dt.isoformat() if end_dt else None,
-        },
-        "added": added,
-        "withdrawn": withdrawn,
-        "zakat_out": zakat_out,
+        "windows": result_windows,
+    }
+
+    if series:
+        points = []
+        for period_start, period_totals in report_series(qs, series):
+            added, withdrawn, zakat_out = report_buckets(period_totals, usd_to_display)
+            points.append({
+                "start": timezone.localtime(period_start).date().isoformat(),
+                "added": added,
+                "withdrawn": withdrawn,
+                "zakat_out": zakat_out,
+            })
+        result["series"] = {"period": series, "points": points}
+
+    return result
+
+def compute_user_report(user, target_user_id: int, start_dt=None, end_dt=None) -> dict:
+    """
+    يحسب تقرير التحويلات (Transfers) لمستخدم معيّن.
+    - الأصول المُضافة: نوع ADD
+    - الأصول المسحوبة: نوع WITHDRAW
+    - الزكاة المدفوعة: نوع ZAKAT_OUT
+    * الذهب/الفضة: كمية بالغرام وقيمتها USD و بعملة العرض
+    * الأموال: لا تُعاد الكمية، فقط القيم USD و بعملة العرض
+    * عملة العرض: display_currency على المستخدم؛ وإن لم توجد → USD
+    """
+    result = compute_user_report_windows(user, target_user_id, {"report": (start_dt, end_dt)})
+    if result.get("status") != "ok":
+        return result
+
+    window = result["windows"]["report"]
+    return {
+        "status": "ok",
+        "display_currency": result["display_currency"],
+        "fx_line": result["fx_line"],
+        "filter": window["filter"],
+        "added": window["added"],
+        "withdrawn": window["withdrawn"],
+        "zakat_out": window["zakat_out"],
     }
 
 
@@ -0,0 +1,62 @@
+# app/summaries.py
+"""
+ملخصات الزكاة المحفوظة (UserSummary) وإعادة حسابها جماعيًا خارج الطلبات.
+
+الملخص "حديث" إذا طابقت نسخة دفتر المستخدم ونسخة الأسعار وتاريخ اليوم المحلي؛
+لذلك إعادة تشغيل أمر متقطّع تكمل فقط من لم يُحسب بعد.
+"""
+from datetime import datetime
+from typing import List, Optional
+
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Holding, PriceChange, Transfer, User, UserSummary
+from .registry import get_asset_registry
+from .services import compute_user_snapshot
+
+
+def users_to_recompute(since: Optional[datetime] = None, force: bool = False) -> List[int]:
+    """
+    معرّفات المستخدمين الذين يحتاجون إعادة حساب (تصاعديًا):
+      - بدون force: يُستثنى من ملخصه حديث
+      - since: فقط من له مناقلات جديدة/معدّلة منذ since، أو أرصدة (أو عملة عرض)
+        في أصول تغيّر سعرها منذ since
+    """
+    users = User.objects.order_by("id")
+    if not force:
+        fresh = UserSummary.objects.filter(
+            ledger_version=F("user__ledger_version"),
+            price_version=get_asset_registry().version,
+            computed_on=timezone.localdate(),
+        ).values("user_id")
+        users = users.exclude(id__in=fresh)
+    if since is not None:
+        repriced = PriceChange.objects.filter(changed_at__gte=since).values("asset_id")
+        touched = Transfer.objects.filter(Q(created_at__gte=since) | Q(updated_at__gte=since)).values("user_id")
+        # الأرصدة الحالية (جدول Holding): من صفّى رصيده في الأصل لا تتغيّر لقطته بسعره
+        holding = Holding.objects.filter(asset_id__in=repriced).exclude(net_quantity=0).values("user_id")
+        users = users.filter(Q(id__in=touched) | Q(id__in=holding) | Q(display_currency_id__in=repriced))
+    return list(users.values_list("id", flat=True))
+
+
+def recompute_user_summaries(user_ids: List[int]) -> int:
+    """
+    يحسب اللقطة الكاملة لكل مستخدم ويحفظها. النسخ تُقرأ قبل الحساب: إن تغيّر شيء
+    أثناءه يبقى الملخص بنسخة أقدم فيُعاد في التشغيل التالي.
+    """
+    done = 0
+    for user in User.objects.filter(id__in=user_ids).order_by("id"):
+        price_version = get_asset_registry().version
+        data = compute_user_snapshot(user)
+        UserSummary.objects.update_or_create(
+            user=user,
+            defaults={
+                "data": data,
+                "ledger_version": user.ledger_version,
+                "price_version": price_version,
+                "computed_on": timezone.localdate(),
+            },
+        )
+        done += 1
+    return done
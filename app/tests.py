@@ -1,3 +1,1823 @@
+import asyncio
+import base64
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from decimal import Decimal
+from unittest import mock
+
+import requests
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import F, Q
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .batch import batch_haul, batch_overdue_cycles, batch_window, load_ledger_columns, recompute_haul_states
+from .caching import bump_ledger_version, bump_price_version, get_price_version, snapshot_cache_key
+from .conf import TRANSFER_BULK_MAX_ITEMS, ZAKAT_HAUL_DAYS, ZAKAT_RATE, ZAKAT_REFERENCE_JSON
+from .exports import EXPORT_COLUMNS
+from .fixed import to_micro
+from .holdings import flush_margin_refresh
+from .models import (
+    Asset, AssetPrice, HaulCheckpoint, HaulEvent, HaulState, Holding, NisabMargin, NotificationOutbox, PriceChange, RateRefreshJob,
+    Transfer, User, UserSummary,
+)
+from .registry import get_asset_registry
+from .nisab_index import process_price_tick, rebuild_nisab_index
+from . import rate_fetch
+from .rate_refresh import release_interrupted_jobs, request_refresh, run_refresh
+from .reminders import deliver_notifications, schedule_zakat_reminders
+from .serializers import TransferSerializer
+from .summaries import users_to_recompute
+from .services import (
+    DEC6, HAUL_KINDS, Timeline, apply_price_changes, HaulReplay, allocate_paid_over_cycles, asset_kind, class_holdings, compute_overdue_zakat_cycles,
+    haul_nisab_usd, haul_prices_key, haul_window_from_timeline,
+    compute_user_report, compute_user_report_windows, compute_user_snapshot, report_totals, report_window_bounds,
+    bulk_create_transfers, load_price_history, load_user_ledger, metal_rate_assets, note_transfer_created,
+    note_transfers_changed, reconcile_holdings, reminder_message,
+)
+
+
+def make_assets():
+    return {
+        "GOLD_24": Asset.objects.create(name="Gold", asset_type="24", unit_name="gram",
+                                        asset_code="GOLD_24", unit_price_usd=Decimal("75")),
+        "SILVER": Asset.objects.create(name="Silver", asset_type="فضة", unit_name="gram",
+                                       asset_code="SILVER", unit_price_usd=Decimal("0.95")),
+        "USD": Asset.objects.create(name="Money", asset_type="دولار", unit_name="amount",
+                                    asset_code="USD", unit_price_usd=Decimal("1")),
+        "MYR": Asset.objects.create(name="Money", asset_type="رينغيت", unit_name="amount",
+                                    asset_code="MYR", unit_price_usd=Decimal("0.21")),
+    }
+
+
+def make_user(email="a@example.com"):
+    return User.objects.create_user(username=email.split("@")[0], email=email,
+                                    password="x", full_name="Test User")
+
+
+def add_transfers(user, assets, count, start=None):
+    start = start or timezone.now() - timedelta(days=800)
+    codes = list(assets)
+    for i in range(count):
+        Transfer.objects.create(
+            user=user, asset=assets[codes[i % len(codes)]],
+            transfer_type="ZAKAT_OUT" if i % 7 == 6 else "ADD",
+            quantity=Decimal("10.5") + i, transfer_date=start + timedelta(days=i),
+        )
+
+
+class SnapshotQueryCountTests(TestCase):
+    # المناقلات + حالات الحول + 3 قوائم مناقلات + صلاحية الكاش
+    # (الأصول ونسخة الأسعار من سجل الأصول داخل العملية)
+    SNAPSHOT_QUERIES = 6
+
+    def setUp(self):
+        cache.clear()
+        self.assets = make_assets()
+
+    def snapshot_queries(self, user):
+        client = APIClient()
+        client.force_authenticate(User.objects.get(id=user.id))
+        client.get("/app/snapshot/", secure=True)  # يبني حالات الحول أول مرة
+        cache.clear()
+        client.force_authenticate(User.objects.get(id=user.id))
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.get("/app/snapshot/", secure=True)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.json()["data"]
+
+    def test_query_count_is_constant(self):
+        small, big = make_user("small@example.com"), make_user("big@example.com")
+        add_transfers(small, self.assets, 3)
+        add_transfers(big, self.assets, 40)
+
+        small_queries, _ = self.snapshot_queries(small)
+        big_queries, _ = self.snapshot_queries(big)
+        self.assertEqual(small_queries, self.SNAPSHOT_QUERIES)
+        self.assertEqual(big_queries, self.SNAPSHOT_QUERIES)
+
+    def test_transfer_payload_unchanged(self):
+        user = make_user()
+        add_transfers(user, self.assets, 12)
+        _, data = self.snapshot_queries(user)
+
+        expected = TransferSerializer(
+            Transfer.objects.filter(user=user, asset__name="Money").order_by("-transfer_date", "-id"),
+            many=True,
+        ).data
+        self.assertEqual(data["transfers"]["money"], [dict(row) for row in expected])
+        self.assertIn("bill_url", data["transfers"]["gold"][0])
+
+
+class SnapshotCacheKeyTests(TestCase):
+    """مفتاح كاش اللقطة يتبع نسخة الدفتر ونسخة الأسعار واليوم المحلي."""
+
+    def setUp(self):
+        cache.clear()
+        self.assets = make_assets()
+        self.user = make_user()
+        add_transfers(self.user, self.assets, 5)
+        self.client = APIClient()
+
+    def snapshot(self):
+        self.client.force_authenticate(User.objects.get(id=self.user.id))
+        response = self.client.get("/app/snapshot/", secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["data"]
+
+    def key(self):
+        return snapshot_cache_key(User.objects.get(id=self.user.id), get_price_version())
+
+    def test_key_follows_versions_and_day(self):
+        first = self.key()
+        bump_ledger_version(self.user.id)
+        second = self.key()
+        self.assertNotEqual(second, first)
+
+        bump_price_version()
+        third = self.key()
+        self.assertNotEqual(third, second)
+
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        with mock.patch("app.caching.timezone.localdate", return_value=tomorrow):
+            self.assertNotEqual(self.key(), third)
+        self.assertEqual(self.key(), third)
+
+    def test_price_change_recomputes_snapshot(self):
+        before = self.snapshot()
+        gold = self.assets["GOLD_24"]
+        gold.unit_price_usd = Decimal("90")
+        gold.save()
+        bump_price_version()
+        after = self.snapshot()
+        self.assertNotEqual(after["totals"], before["totals"])
+
+    def test_note_only_edit_refreshes_snapshot(self):
+        self.snapshot()
+        transfer = Transfer.objects.filter(user=self.user, asset=self.assets["USD"]).first()
+        response = self.client.post("/app/transfers/update/", {
+            "transfer_id": transfer.id, "note": "ملاحظة معدّلة",
+        }, format="json", secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["updated_fields"], ["note"])
+
+        notes = {row["id"]: row["note"] for row in self.snapshot()["transfers"]["money"]}
+        self.assertEqual(notes[transfer.id], "ملاحظة معدّلة")
+
+
+class UserLedgerParityTests(TestCase):
+    """الدفتر المحمّل باستعلام واحد يطابق الاستعلام المنفصل لكل فئة (المسار القديم)."""
+
+    def setUp(self):
+        cache.clear()
+        self.assets = make_assets()
+        self.user = make_user()
+        add_transfers(self.user, self.assets, 30)
+        # نفس التاريخ لمناقلتين: الترتيب الثانوي بالمعرّف
+        same_day = timezone.now() - timedelta(days=10)
+        for qty in ("3.000001", "2.5"):
+            Transfer.objects.create(user=self.user, asset=self.assets["MYR"], transfer_type="ADD",
+                                    quantity=Decimal(qty), transfer_date=same_day)
+
+    def per_class_reference(self, kind, since_dt):
+        assets = [a for a in get_asset_registry().assets if asset_kind(a) == kind]
+        qs = (Transfer.objects.filter(user=self.user, asset__in=assets)
+              .order_by("transfer_date", "id").select_related("asset"))
+        running, points, paid = Decimal("0"), [], Decimal("0")
+        for t in qs:
+            delta = DEC6(t.quantity * t.asset.unit_price_usd)
+            running = DEC6(running + delta if t.transfer_type == "ADD" else running - delta)
+            points.append((t.transfer_date, running))
+            if t.transfer_type == "ZAKAT_OUT" and t.transfer_date >= since_dt:
+                paid += delta
+        return running, points, DEC6(paid)
+
+    def test_single_query_matches_per_class_queries(self):
+        get_asset_registry()
+        with CaptureQueriesContext(connection) as ctx:
+            ledger = load_user_ledger(self.user)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        since = timezone.now() - timedelta(days=400)
+        for kind in ("gold", "silver", "money"):
+            with self.subTest(kind=kind):
+                ref_running, ref_points, ref_paid = self.per_class_reference(kind, since)
+                running, timeline = ledger.timeline([kind])
+                self.assertEqual(running, ref_running)
+                self.assertEqual(list(timeline), ref_points)
+                self.assertEqual(ledger.zakat_out_since([kind], since), ref_paid)
+
+    def test_kind_filter_loads_only_requested_classes(self):
+        ledger = load_user_ledger(self.user, kinds=("money",))
+        full = load_user_ledger(self.user)
+        self.assertEqual(ledger.rows, full.rows_for(["money"]))
+
+
+class MultiWindowReportTests(TestCase):
+    FILTERS = ["none", "last_1m", "last_3m", "last_6m"]
+
+    def setUp(self):
+        self.assets = make_assets()
+        self.user = make_user()
+        add_transfers(self.user, self.assets, 30)
+        # مناقلة كل أسبوع تقريبًا على مدى ~7 أشهر، وبعضها سحب
+        now = timezone.now()
+        for i, t in enumerate(Transfer.objects.filter(user=self.user).order_by("id")):
+            t.transfer_date = now - timedelta(days=7 * i, hours=1)
+            if i % 6 == 1:
+                t.transfer_type = "WITHDRAW"
+            t.save(update_fields=["transfer_date", "transfer_type"])
+
+    def test_windows_match_single_reports(self):
+        windows = {f: report_window_bounds(f) for f in self.FILTERS}
+        get_asset_registry()
+        with CaptureQueriesContext(connection) as ctx:
+            multi = compute_user_report_windows(self.user, self.user.id, windows)
+        # المستخدم + استعلام تجميعي واحد لكل النوافذ (عملة العرض من سجل الأصول)
+        self.assertEqual(len(ctx.captured_queries), 2)
+
+        for f, (start_dt, end_dt) in windows.items():
+            single = compute_user_report(self.user, self.user.id, start_dt=start_dt, end_dt=end_dt)
+            for key in ("filter", "added", "withdrawn", "zakat_out"):
+                self.assertEqual(multi["windows"][f][key], single[key])
+
+    def test_series_sums_to_total(self):
+        result = compute_user_report_windows(self.user, self.user.id, {"none": (None, None)}, series="month")
+        points = result["series"]["points"]
+        self.assertGreater(len(points), 1)
+        self.assertEqual([p["start"] for p in points], sorted(p["start"] for p in points))
+        for bucket in ("added", "withdrawn", "zakat_out"):
+            for cls in ("gold", "silver", "money"):
+                total = sum(p[bucket][cls]["value_usd"] for p in points)
+                self.assertEqual(total, result["windows"]["none"][bucket][cls]["value_usd"])
+
+    def test_endpoint_multi_window(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post("/app/reports/summary/", {"user_id": self.user.id, "filters": self.FILTERS, "series": "week"},
+                               format="json", secure=True)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()["data"]
+        self.assertEqual(list(data["windows"]), self.FILTERS)
+        self.assertEqual(data["series"]["period"], "week")
+
+
+class ReportTotalsParityTests(TestCase):
+    """التجميع في قاعدة البيانات يطابق حلقة Decimal القديمة على كل مناقلة."""
+
+    def setUp(self):
+        self.assets = make_assets()
+        self.user = make_user()
+
+    def reference_totals(self, qs):
+        totals = {b: {cls: {"qty": Decimal("0"), "usd": Decimal("0")} for cls in ("gold", "silver", "money")}
+                  for b in ("added", "withdrawn", "zakat_out")}
+        bucket_of = {"ADD": "added", "WITHDRAW": "withdrawn", "ZAKAT_OUT": "zakat_out"}
+        for t in qs.select_related("asset"):
+            cls = t.asset.name.strip().lower()
+            row = totals[bucket_of[t.transfer_type]][cls]
+            row["qty"] += t.quantity
+            row["usd"] += t.quantity * t.asset.unit_price_usd
+        return totals
+
+    def test_random_six_decimal_quantities(self):
+        rnd = random.Random(9)
+        for asset in self.assets.values():
+            asset.unit_price_usd = rand6(rnd, 5_000)
+            asset.save(update_fields=["unit_price_usd"])
+        codes = list(self.assets)
+        # 0.000249 × 10^6 بفاصلة عائمة = 248.99999999999997 (يحتاج Round قبل Cast)
+        fixed = [Decimal("0.000249"), Decimal("0.000001"), Decimal("999999.999999")]
+        Transfer.objects.bulk_create([
+            Transfer(user=self.user, asset=self.assets[codes[i % len(codes)]],
+                     transfer_type=("ADD", "WITHDRAW", "ZAKAT_OUT")[i % 3],
+                     quantity=fixed[i] if i < len(fixed) else rand6(rnd, 100_000),
+                     transfer_date=timezone.now() - timedelta(days=i))
+            for i in range(300)
+        ])
+        qs = Transfer.objects.filter(user=self.user)
+        self.assertEqual(report_totals(qs)["all"], self.reference_totals(qs))
+
+        recent = Q(transfer_date__gte=timezone.now() - timedelta(days=90))
+        windows = report_totals(qs, {"all": None, "recent": recent})
+        self.assertEqual(windows["recent"], self.reference_totals(qs.filter(recent)))
+
+
+def linear_value_at(points, dt):
+    # البحث الخطي المرجعي: آخر قيمة توقيتها <= dt
+    last = Decimal("0")
+    for ts, val in points:
+        if ts > dt:
+            break
+        last = val
+    return DEC6(last)
+
+
+class TimelineLookupTests(TestCase):
+    def setUp(self):
+        rnd = random.Random(3)
+        self.t0 = timezone.now() - timedelta(days=3 * ZAKAT_HAUL_DAYS + 20)
+        ts, self.points = self.t0, []
+        for _ in range(400):
+            ts += timedelta(hours=rnd.choice((0, 0, 5, 30, 200)))  # 0: توقيت مكرر
+            self.points.append((ts, Decimal(rnd.randint(0, 20_000_000)) / 1000))
+        self.timeline = Timeline(self.points)
+
+    def probe_dates(self):
+        times = [ts for ts, _ in self.points]
+        dates = [times[0] - timedelta(days=1), times[0], times[-1], times[-1] + timedelta(days=1)]
+        dates += times[::7]  # على توقيتات النقاط تمامًا (ومنها المكررة)
+        dates += [t + timedelta(minutes=1) for t in times[3::11]]
+        return sorted(dates)
+
+    def test_value_at_and_values_at_match_linear_scan(self):
+        dates = self.probe_dates()
+        expected = [linear_value_at(self.points, dt) for dt in dates]
+        self.assertEqual([self.timeline.value_at(dt) for dt in dates], expected)
+        self.assertEqual(self.timeline.values_at(dates), expected)
+        self.assertEqual(expected[0], Decimal("0"))  # قبل أول نقطة
+
+        # توقيت مكرر: القيمة الأخيرة عنده
+        i = next(i for i in range(1, len(self.points)) if self.points[i][0] == self.points[i - 1][0])
+        j = max(k for k, (ts, _) in enumerate(self.points) if ts == self.points[i][0])
+        self.assertEqual(self.timeline.value_at(self.points[i][0]), DEC6(self.points[j][1]))
+        self.assertEqual(Timeline().values_at(dates[:2]), [Decimal("0"), Decimal("0")])
+
+    def test_overdue_cycles_match_linear_scan(self):
+        nisab = Decimal("1000")
+        # نقطة تقع على موعد الاستحقاق الثاني تمامًا
+        due2 = self.t0 + timedelta(days=2 * ZAKAT_HAUL_DAYS)
+        points = sorted(self.points + [(due2, Decimal("15000"))], key=lambda p: p[0])
+        for floor in (Decimal("0"), Decimal("5000")):
+            # floor يرفع كل القيم فوق النصاب (لا انقطاع) أو يتركها (قد ينقطع الحول)
+            pts = [(ts, val + floor) for ts, val in points]
+            expected = []
+            for k in range(1, 4):
+                due_at = self.t0 + timedelta(days=ZAKAT_HAUL_DAYS * k)
+                val = linear_value_at(pts, due_at)
+                if val < nisab:
+                    break
+                expected.append({"due_at": due_at, "required_usd": DEC6(val * Decimal(str(ZAKAT_RATE)))})
+            got = compute_overdue_zakat_cycles(Timeline(pts), self.t0, nisab)
+            self.assertEqual(got, expected)
+            self.assertEqual(compute_overdue_zakat_cycles(pts, self.t0, nisab), expected)
+            if floor:
+                self.assertEqual(len(got), 3)
+
+
+class AsOfTimelineTests(TestCase):
+    def setUp(self):
+        self.assets = make_assets()
+        self.user = make_user()
+        self.start = timezone.now() - timedelta(days=400)
+        add_transfers(self.user, self.assets, 40, start=self.start)
+
+    def test_without_history_matches_current_prices(self):
+        ledger = load_user_ledger(self.user)
+        for kinds in (("gold",), ("money",), ("gold", "silver", "money")):
+            self.assertEqual(ledger.asof_timeline(kinds), ledger.timeline(kinds))
+
+    def test_values_holdings_at_prices_in_effect(self):
+        gold, usd, myr = self.assets["GOLD_24"], self.assets["USD"], self.assets["MYR"]
+        points = [
+            (gold, self.start - timedelta(days=1), "60"),
+            (gold, self.start + timedelta(days=10, hours=12), "70.5"),
+            (myr, self.start + timedelta(days=15), "0.25"),
+            (gold, self.start + timedelta(days=30), "80"),
+        ]
+        for asset, ts, price in points:
+            AssetPrice.objects.create(asset=asset, price_usd=Decimal(price), effective_at=ts, source="test")
+
+        ledger = load_user_ledger(self.user)
+        kinds = ("gold", "silver", "money")
+        with CaptureQueriesContext(connection) as ctx:
+            history = load_price_history(ledger.assets_for(kinds))
+        self.assertEqual(len(ctx.captured_queries), 1)
+        _, timeline = ledger.asof_timeline(kinds, history)
+
+        transfers = list(Transfer.objects.filter(user=self.user).select_related("asset"))
+        for days in (0, 5, 11, 12, 20, 35, 39):
+            at = self.start + timedelta(days=days, hours=18)
+            expected = Decimal("0")
+            for t in transfers:
+                if t.transfer_date <= at:
+                    sign = 1 if t.transfer_type == "ADD" else -1
+                    expected += sign * t.quantity * history.price_at(t.asset_id, at)
+            self.assertEqual(timeline.value_at(at), expected)
+
+        # قبل أول نقطة لأصل: أقدم سعر معروف؛ أصل بلا نقاط: السعر الحالي
+        self.assertEqual(history.price_at(myr.id, self.start), Decimal("0.25"))
+        self.assertEqual(history.price_at(usd.id, self.start), Decimal("1"))
+
+    def test_valuation_history_command(self):
+        gold = self.assets["GOLD_24"]
+        AssetPrice.objects.create(asset=gold, price_usd=Decimal("60"), effective_at=self.start - timedelta(days=1),
+                                  source="test")
+        AssetPrice.objects.create(asset=gold, price_usd=Decimal("80"), effective_at=self.start + timedelta(days=30),
+                                  source="test")
+        ledger = load_user_ledger(self.user, ("gold",))
+        _, asof = ledger.asof_timeline(("gold",))
+        _, current = ledger.timeline(("gold",))
+
+        out = io.StringIO()
+        call_command("valuation_history", self.user.email, "--class", "gold", stdout=out)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(rows[0], ["at", "value_usd", "value_current_prices_usd"])
+        self.assertEqual(len(rows) - 1, len(asof))
+        self.assertEqual([Decimal(r[1]) for r in rows[1:]], asof.values_at(asof.times))
+        self.assertEqual(Decimal(rows[-1][2]), current.value_at(asof.times[-1]))
+
+        # قبل نقطة 80 تُقيَّم الحيازة بسعر 60 لا بالسعر الحالي 75
+        at = self.start + timedelta(days=20)
+        out = io.StringIO()
+        call_command("valuation_history", str(self.user.id), "--class", "gold", "--at", at.isoformat(), stdout=out)
+        (_, value, value_now), = list(csv.reader(io.StringIO(out.getvalue())))[1:]
+        self.assertEqual(Decimal(value), asof.value_at(at))
+        self.assertEqual(Decimal(value_now), current.value_at(at))
+        self.assertEqual(Decimal(value) / Decimal(value_now), Decimal("0.8"))
+
+
+class AssetRegistryTests(TestCase):
+    def setUp(self):
+        self.assets = make_assets()
+
+    def test_lookups_served_from_memory(self):
+        registry = get_asset_registry()
+        with CaptureQueriesContext(connection) as ctx:
+            again = get_asset_registry()
+            self.assertIs(again, registry)
+            self.assertEqual(again.by_asset_code("MYR"), self.assets["MYR"])
+            self.assertEqual([a.asset_code for a in again.by_kind["money"]], ["USD", "MYR"])
+            self.assertEqual(again.nisab["gold"], Decimal("6375.000000"))
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+    def test_refreshed_on_asset_save_and_version_change(self):
+        registry = get_asset_registry()
+        gold = self.assets["GOLD_24"]
+        gold.unit_price_usd = Decimal("80")
+        gold.save()
+        refreshed = get_asset_registry()
+        self.assertIsNot(refreshed, registry)
+        self.assertEqual(refreshed.nisab["gold"], Decimal("6800.000000"))
+
+        # نسخة أسعار أحدث من عملية أخرى
+        self.assertIsNot(get_asset_registry(version=refreshed.version + 1), refreshed)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.assets = make_assets()
+        self.client = APIClient()
+
+    def get(self, url, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, secure=True, **headers)
+        return response, len(ctx.captured_queries)
+
+    def test_reference_not_modified_without_queries(self):
+        first, _ = self.get("/app/reference/zakat/")
+        self.assertEqual(first.status_code, 200)
+        self.assertIn("max-age=86400", first["Cache-Control"])
+
+        second, queries = self.get("/app/reference/zakat/", first["ETag"])
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second["ETag"], first["ETag"])
+        self.assertEqual(queries, 0)
+
+    def test_catalog_etag_follows_prices(self):
+        first, _ = self.get("/app/assets/")
+        self.assertEqual(first.status_code, 200)
+
+        second, queries = self.get("/app/assets/", first["ETag"])
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(queries, 0)
+
+        gold = self.assets["GOLD_24"]
+        gold.unit_price_usd = Decimal("81")
+        gold.save()
+        third, _ = self.get("/app/assets/", first["ETag"])
+        self.assertEqual(third.status_code, 200)
+        self.assertNotEqual(third["ETag"], first["ETag"])
+
+    def test_snapshot_not_modified_without_queries(self):
+        user = make_user()
+        add_transfers(user, self.assets, 5)
+        self.client.force_authenticate(User.objects.get(id=user.id))
+        first, _ = self.get("/app/snapshot/")
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue(first["Cache-Control"].startswith("private"))
+
+        second, queries = self.get("/app/snapshot/", first["ETag"])
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(queries, 0)
+
+        # مناقلة جديدة ترفع نسخة الدفتر فتتغيّر البصمة
+        created = self.client.post("/app/transfers/create/", {
+            "user_id": user.id, "asset_id": self.assets["USD"].id, "transfer_type": "ADD", "quantity": "5",
+        }, format="json", secure=True)
+        self.assertEqual(created.status_code, 200)
+        self.client.force_authenticate(User.objects.get(id=user.id))
+        third, _ = self.get("/app/snapshot/", first["ETag"])
+        self.assertEqual(third.status_code, 200)
+        self.assertNotEqual(third["ETag"], first["ETag"])
+
+    def test_snapshot_etag_changes_after_metadata_only_edit(self):
+        user = make_user()
+        add_transfers(user, self.assets, 5)
+        transfer = Transfer.objects.filter(user=user).first()
+        self.client.force_authenticate(User.objects.get(id=user.id))
+        first, _ = self.get("/app/snapshot/")
+        self.assertEqual(first.status_code, 200)
+
+        # ملاحظة فقط: لا تغيّر في القيمة لكن قوائم المناقلات في اللقطة تتغيّر
+        updated = self.client.post("/app/transfers/update/", {
+            "transfer_id": transfer.id, "note": "بدون أثر على القيمة",
+        }, format="json", secure=True)
+        self.assertEqual(updated.status_code, 200)
+        self.client.force_authenticate(User.objects.get(id=user.id))
+        second, _ = self.get("/app/snapshot/", first["ETag"])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second["ETag"], first["ETag"])
+
+        third, _ = self.get("/app/snapshot/", second["ETag"])
+        self.assertEqual(third.status_code, 304)
+
+
+class PrerenderedReferenceTests(TestCase):
+    URL = "/app/reference/zakat/"
+
+    def test_identity_body_matches_envelope(self):
+        response = APIClient().get(self.URL, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Content-Encoding", response)
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(json.loads(response.content),
+                         {"message": ["reference generated"], "data": ZAKAT_REFERENCE_JSON})
+
+    def test_gzip_variant(self):
+        client = APIClient()
+        plain = client.get(self.URL, secure=True)
+        packed = client.get(self.URL, secure=True, HTTP_ACCEPT_ENCODING="gzip;q=1, br;q=0, identity;q=0.5")
+        self.assertEqual(packed["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(packed.content), plain.content)
+        self.assertNotEqual(packed["ETag"], plain["ETag"])
+
+        # بصمة أي تمثيل صالحة للتحقق
+        again = client.get(self.URL, secure=True, HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=plain["ETag"])
+        self.assertEqual(again.status_code, 304)
+
+
+class SnapshotSelectionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.assets = make_assets()
+        self.user = make_user()
+        add_transfers(self.user, self.assets, 30)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, query=""):
+        response = self.client.get(f"/app/snapshot/{query}", secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["data"]
+
+    def full(self):
+        data = self.get()
+        HaulState.objects.all().delete()
+        cache.clear()
+        return data
+
+    def test_totals_only_skips_haul(self):
+        full = self.full()
+        data = self.get("?fields=totals")
+        self.assertEqual(list(data), ["totals"])
+        self.assertEqual(data["totals"], full["totals"])
+        self.assertFalse(HaulState.objects.exists())
+
+    def test_single_class(self):
+        full = self.full()
+        data = self.get("?classes=gold&fields=classes,transfers")
+        self.assertEqual(list(data), ["classes", "transfers"])
+        self.assertEqual(data["classes"], {"gold": full["classes"]["gold"]})
+        self.assertEqual(data["transfers"], {"gold": full["transfers"]["gold"]})
+        self.assertEqual(list(HaulState.objects.values_list("kind", flat=True)), ["gold"])
+
+    def test_unknown_field_rejected(self):
+        response = self.client.get("/app/snapshot/?fields=totals,bogus", secure=True)
+        self.assertEqual(response.status_code, 400)
+
+
+def rand6(rnd, top):
+    """Decimal عشوائي بست خانات عشرية في [0, top)."""
+    return Decimal(rnd.randrange(top * 10 ** 6)).scaleb(-6)
+
+
+class FixedPointParityTests(TestCase):
+    """
+    محرك الوحدات الصغرى (fixed.py) يطابق مسار Decimal القديم حتى آخر خانة
+    على بيانات عشوائية بست خانات (ضمن دقة Decimal الافتراضية 28 رقمًا).
+    """
+
+    def setUp(self):
+        self.assets = make_assets()
+        self.user = make_user()
+
+    def reference_timeline(self, rows, assets_by_id):
+        running, points = Decimal("0"), []
+        for _id, asset_id, ttype, qty, ts, _delta in rows:
+            delta = DEC6(qty * assets_by_id[asset_id].unit_price_usd)
+            running = DEC6(running + delta if ttype == "ADD" else running - delta)
+            points.append((ts, running))
+        return running, points
+
+    def reference_allocate(self, paid, required):
+        paid, remaining = DEC6(paid), []
+        for req in required:
+            used = min(req, paid) if paid > 0 else Decimal("0")
+            remaining.append(DEC6(req - used))
+            paid = DEC6(paid - used)
+        return remaining
+
+    def test_random_ledgers(self):
+        rnd = random.Random(17)
+        start = timezone.now() - timedelta(days=354 * 4)
+        for round_no in range(4):
+            for asset in self.assets.values():
+                asset.unit_price_usd = rand6(rnd, 10_000)
+                asset.save(update_fields=["unit_price_usd"])
+            Transfer.objects.filter(user=self.user).delete()
+            codes = list(self.assets)
+            Transfer.objects.bulk_create([
+                Transfer(user=self.user, asset=self.assets[rnd.choice(codes)],
+                         transfer_type=rnd.choices(["ADD", "WITHDRAW", "ZAKAT_OUT"], [6, 2, 1])[0],
+                         quantity=rand6(rnd, 100_000),
+                         transfer_date=start + timedelta(days=i * 5, seconds=rnd.randrange(86400)))
+                for i in range(250)
+            ])
+            cache.clear()
+            ledger = load_user_ledger(self.user)
+            by_id = ledger.assets_by_id
+
+            for kind in ("gold", "silver", "money"):
+                with self.subTest(round=round_no, kind=kind):
+                    rows = ledger.rows_for([kind])
+                    ref_running, ref_points = self.reference_timeline(rows, by_id)
+                    running, timeline = ledger.timeline([kind])
+                    self.assertEqual(running, ref_running)
+                    self.assertEqual(list(timeline), ref_points)
+
+                    _items, total = class_holdings(ledger, kind, None)
+                    ref_total = DEC6(sum(
+                        (DEC6(ledger.net_quantity(a.id) * a.unit_price_usd) for a in ledger.assets_by_kind[kind]),
+                        Decimal("0"),
+                    ))
+                    self.assertEqual(total, ref_total)
+
+                    # الحول: نفس البداية ونفس مقادير الحوالات كمسار خط الزمن بـ Decimal
+                    nisab = DEC6(ref_running * Decimal("0.3"))
+                    replay = HaulReplay(nisab)
+                    for tid, _asset_id, ttype, _qty, ts, delta in rows:
+                        replay.apply(tid, ts, ttype, delta)
+                    ref_start = None
+                    for ts, value in ref_points:
+                        if value < nisab:
+                            ref_start = None
+                        elif ref_start is None:
+                            ref_start = ts
+                    self.assertEqual(replay.start, ref_start)
+                    self.assertEqual(replay.running, ref_running)
+                    if ref_start is not None:
+                        cycles = replay.overdue_cycles()
+                        ref_cycles = compute_overdue_zakat_cycles(ref_points, ref_start, nisab)
+                        self.assertEqual([(c["due_at"], c["required_usd"]) for c in cycles],
+                                         [(c["due_at"], c["required_usd"]) for c in ref_cycles])
+
+    def test_random_allocation(self):
+        rnd = random.Random(170)
+        for _ in range(200):
+            required = [rand6(rnd, 50_000) for _ in range(rnd.randrange(1, 8))]
+            paid = rand6(rnd, 120_000) + Decimal(rnd.randrange(10)).scaleb(-9)
+            cycles = [{"due_at": timezone.now() + timedelta(days=i), "required_usd": r}
+                      for i, r in enumerate(required)]
+            total, earliest = allocate_paid_over_cycles(paid, cycles)
+            remaining = self.reference_allocate(paid, required)
+            self.assertEqual([c["remaining_usd"] for c in cycles], remaining)
+            self.assertEqual(total, DEC6(sum(remaining, Decimal("0"))))
+            unpaid = [c["due_at"] for c, r in zip(cycles, remaining) if r > 0]
+            self.assertEqual(earliest, unpaid[0] if unpaid else None)
+
+
+class BatchHaulEngineTests(TestCase):
+    """المحرك الدفعي (batch.py) يطابق مسار كل مستخدم على حدة."""
+
+    def setUp(self):
+        self.assets = make_assets()
+        rnd = random.Random(18)
+        start = timezone.now() - timedelta(days=354 * 3)
+        codes = list(self.assets)
+        self.users = [make_user(f"u{i}@example.com") for i in range(5)]
+        transfers = []
+        for n, user in zip((0, 1, 40, 120, 300), self.users):
+            for i in range(n):
+                transfers.append(Transfer(
+                    user=user, asset=self.assets[rnd.choice(codes)],
+                    transfer_type=rnd.choices(["ADD", "WITHDRAW", "ZAKAT_OUT"], [6, 2, 1])[0],
+                    quantity=rand6(rnd, 20_000),
+                    # آخرها بعد الآن: مواعيد مستقرة لم تحن بعد
+                    transfer_date=start + timedelta(days=i * 1200 / max(n, 1), seconds=rnd.randrange(86400)),
+                ))
+        Transfer.objects.bulk_create(transfers)
+        self.ids = [u.id for u in self.users]
+
+    def test_matches_per_user_timeline(self):
+        registry = get_asset_registry()
+        cols = load_ledger_columns(self.ids, registry)
+        for kind, kinds in HAUL_KINDS.items():
+            nisab = haul_nisab_usd(kind, registry.assets)
+            results = batch_haul(cols.select(kinds), to_micro(nisab))
+            for user in self.users:
+                with self.subTest(kind=kind, user=user.id):
+                    _running, timeline = load_user_ledger(user, kinds).timeline(kinds)
+                    window = haul_window_from_timeline(timeline, nisab)
+                    res = results.get(user.id)
+                    self.assertEqual(batch_window(res), window)
+                    expected = (compute_overdue_zakat_cycles(timeline, window["haul_started_at"], nisab)
+                                if window["haul_started_at"] else [])
+                    self.assertEqual(
+                        [(c["due_at"], c["required_usd"]) for c in batch_overdue_cycles(res, to_micro(nisab))],
+                        [(c["due_at"], c["required_usd"]) for c in expected],
+                    )
+
+    def test_recompute_writes_same_states_as_replay(self):
+        fields = ("kind", "prices_key", "running_usd", "haul_started_at",
+                  "last_transfer_id", "last_transfer_date", "settled_cycles")
+        recompute_haul_states(self.ids)
+        batch = sorted(HaulState.objects.values_list("user_id", *fields))
+        self.assertEqual(len(batch), len(self.ids) * len(HAUL_KINDS))
+
+        HaulState.objects.all().delete()
+        for user in self.users:
+            ledger = load_user_ledger(user)
+            for kind in HAUL_KINDS:
+                ledger.haul_state(kind)
+        self.assertEqual(batch, sorted(HaulState.objects.values_list("user_id", *fields)))
+
+
+class RecomputeSnapshotsTests(TestCase):
+    def setUp(self):
+        self.assets = make_assets()
+        self.users = [make_user(f"u{i}@example.com") for i in range(3)]
+        for user in self.users[:2]:
+            add_transfers(user, self.assets, 20)
+
+    def run_command(self, *args):
+        out = io.StringIO()
+        call_command("recompute_snapshots", "--workers", "0", "--chunk-size", "2", *args, stdout=out)
+        return out.getvalue()
+
+    def test_writes_summaries_and_resumes(self):
+        self.run_command()
+        self.assertEqual(UserSummary.objects.count(), 3)
+        for user in self.users:
+            user.refresh_from_db()
+            summary = user.summary
+            self.assertEqual(summary.ledger_version, user.ledger_version)
+            self.assertEqual(summary.data, json.loads(json.dumps(compute_user_snapshot(user), cls=DjangoJSONEncoder)))
+
+        # تشغيل ثانٍ لا يعيد شيئًا؛ تعديل دفتر مستخدم يعيده وحده
+        self.assertEqual(users_to_recompute(), [])
+        self.assertIn("All summaries are current", self.run_command())
+        note_transfer_created(Transfer.objects.create(
+            user=self.users[2], asset=self.assets["USD"], transfer_type="ADD",
+            quantity=Decimal("5"), transfer_date=timezone.now(),
+        ))
+        self.assertEqual(users_to_recompute(), [self.users[2].id])
+
+    def test_since_selects_new_transfers_and_repriced_holdings(self):
+        since = timezone.now()
+        self.assertEqual(users_to_recompute(since=since, force=True), [])
+
+        Transfer.objects.create(user=self.users[2], asset=self.assets["USD"], transfer_type="ADD",
+                                quantity=Decimal("1"), transfer_date=timezone.now())
+        self.assertEqual(users_to_recompute(since=since, force=True), [self.users[2].id])
+
+        PriceChange.objects.create(asset=self.assets["SILVER"], old_price_usd=Decimal("0.95"),
+                                   new_price_usd=Decimal("1.05"), price_version=1, source="test")
+        self.assertEqual(users_to_recompute(since=since, force=True), [u.id for u in self.users])
+
+        # من صفّى رصيده في الأصل لا يُعاد حسابه بتغيّر سعره
+        cleared = self.users[0]
+        for asset_id, qty in Holding.objects.filter(user=cleared, asset=self.assets["GOLD_24"]).values_list(
+                "asset_id", "net_quantity"):
+            Transfer.objects.create(user=cleared, asset_id=asset_id, transfer_type="WITHDRAW", quantity=qty,
+                                    transfer_date=timezone.now())
+        later = timezone.now()
+        PriceChange.objects.create(asset=self.assets["GOLD_24"], old_price_usd=Decimal("75"),
+                                   new_price_usd=Decimal("76"), price_version=2, source="test")
+        self.assertEqual(users_to_recompute(since=later, force=True), [self.users[1].id])
+
+
+class TransferKeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.assets = make_assets()
+        self.user = make_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # سبع مناقلات بنفس التاريخ تمامًا: الترتيب بينها بالمعرّف وحده
+        self.same_date = timezone.now() - timedelta(days=3)
+        for i in range(7):
+            Transfer.objects.create(user=self.user, asset=self.assets["USD"], transfer_type="ADD",
+                                    quantity=Decimal(i + 1), transfer_date=self.same_date)
+        add_transfers(self.user, self.assets, 4)
+        add_transfers(make_user("other@example.com"), self.assets, 3)
+
+    def page(self, cursor=None, size=3):
+        params = {"page_size": size}
+        if cursor:
+            params["cursor"] = cursor
+        return self.client.get("/app/transfers/", params, secure=True)
+
+    def expected_ids(self):
+        return list(Transfer.objects.filter(user=self.user).order_by("-transfer_date", "-id")
+                    .values_list("id", flat=True))
+
+    def test_walk_is_stable_across_equal_dates(self):
+        expected = self.expected_ids()
+        seen, cursor, pages = [], None, 0
+        while True:
+            data = self.page(cursor).json()["data"]
+            seen += [row["id"] for row in data["results"]]
+            pages += 1
+            if pages == 1:
+                # إدراج أحدث بين الصفحات لا يزيح ما بعد المؤشر
+                Transfer.objects.create(user=self.user, asset=self.assets["USD"], transfer_type="ADD",
+                                        quantity=Decimal("1"), transfer_date=timezone.now())
+            cursor = data["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(seen, expected)
+        self.assertEqual(pages, 4)
+
+    def test_last_page(self):
+        total = len(self.expected_ids())
+        first = self.page(size=total - 1).json()["data"]
+        self.assertIsNotNone(first["next"])
+        last = self.page(first["next_cursor"], size=total - 1).json()["data"]
+        self.assertEqual(len(last["results"]), 1)
+        self.assertIsNone(last["next_cursor"])
+        self.assertIsNone(last["next"])
+
+        exact = self.page(size=total).json()["data"]
+        self.assertEqual(len(exact["results"]), total)
+        self.assertIsNone(exact["next_cursor"])
+
+    def test_malformed_cursor_rejected(self):
+        bad = [
+            "not-base64!!",
+            base64.urlsafe_b64encode(b"no separator").decode(),
+            base64.urlsafe_b64encode(b"2024-13-45T00:00:00|7").decode(),
+            base64.urlsafe_b64encode(b"2024-01-01T00:00:00+00:00|abc").decode(),
+            base64.urlsafe_b64encode(b"\xff\xfe|1").decode(),
+        ]
+        for cursor in bad:
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.page(cursor).status_code, 400)
+
+
+class TransferExportTests(TestCase):
+    def setUp(self):
+        self.assets = make_assets()
+        self.user = make_user()
+        self.other = make_user("other@example.com")
+        add_transfers(self.user, self.assets, 20)
+        add_transfers(self.other, self.assets, 5)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def export(self, **params):
+        response = self.client.get("/app/transfers/export/", params, secure=True)
+        if response.status_code != 200:
+            return response, None
+        self.assertTrue(response.streaming)
+        body = b"".join(response.streaming_content).decode("utf-8")
+        return response, body
+
+    def test_csv_header_rows_and_scope(self):
+        response, body = self.export()
+        self.assertTrue(response["Content-Type"].startswith("text/csv"))
+        self.assertIn(f"ledger_{self.user.id}.csv", response["Content-Disposition"])
+
+        rows = list(csv.DictReader(io.StringIO(body)))
+        self.assertEqual(body.splitlines()[0].split(","), EXPORT_COLUMNS)
+        transfers = [r for r in rows if r["record"] == "transfer"]
+        own = list(Transfer.objects.filter(user=self.user).order_by("transfer_date", "id").values_list("id", flat=True))
+        self.assertEqual([int(r["id"]) for r in transfers], own)
+        self.assertTrue(all(r["record"] in ("transfer", "haul_cycle") for r in rows))
+
+    def test_jsonl_matches_csv(self):
+        _, csv_body = self.export()
+        response, body = self.export(output="jsonl")
+        self.assertTrue(response["Content-Type"].startswith("application/x-ndjson"))
+        records = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(len(records), len(csv_body.splitlines()) - 1)
+        self.assertEqual(sum(1 for r in records if r["record"] == "transfer"), 20)
+
+    def test_other_user_requires_superuser(self):
+        response, _ = self.export(user_id=self.other.id)
+        self.assertEqual(response.status_code, 400)
+
+        admin = make_user("admin@example.com")
+        admin.is_superuser = True
+        admin.save()
+        self.client.force_authenticate(admin)
+        _, body = self.export(user_id=self.other.id)
+        ids = {int(r["id"]) for r in csv.DictReader(io.StringIO(body)) if r["record"] == "transfer"}
+        self.assertEqual(ids, set(Transfer.objects.filter(user=self.other).values_list("id", flat=True)))
+
+    def test_unknown_output_rejected(self):
+        response, _ = self.export(output="xlsx")
+        self.assertEqual(response.status_code, 400)
+
+
+class TransferBulkCreateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.assets = make_assets()
+        self.user = make_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def item(self, key=None, code="USD", **extra):
+        row = {"asset_id": self.assets[code].id, "transfer_type": "ADD", "quantity": "12.5", **extra}
+        if key:
+            row["client_key"] = key
+        return row
+
+    def post(self, items, user_id=None):
+        return self.client.post("/app/transfers/bulk/", {
+            "user_id": user_id or self.user.id, "items": items,
+        }, format="json", secure=True)
+
+    def test_resubmitted_batch_creates_nothing(self):
+        batch = [self.item("k1"), self.item("k2", "GOLD_24"), self.item("k3", "SILVER")]
+        first = self.post(batch).json()["data"]
+        self.assertEqual(first["created"], 3)
+        version = User.objects.get(id=self.user.id).ledger_version
+
+        second = self.post(batch).json()["data"]
+        self.assertEqual((second["created"], second["duplicates"]), (0, 3))
+        self.assertEqual([r["transfer_id"] for r in second["results"]],
+                         [r["transfer_id"] for r in first["results"]])
+        self.assertEqual(Transfer.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(User.objects.get(id=self.user.id).ledger_version, version)
+        self.assertEqual(reconcile_holdings(), [])
+
+    def test_batch_advances_haul_states_incrementally(self):
+        add_transfers(self.user, self.assets, 12)
+        ledger = load_user_ledger(User.objects.get(id=self.user.id))
+        for kind in ("money", "combined"):
+            ledger.haul_state(kind)  # حالات محفوظة
+        with mock.patch("app.services.rebuild_haul_states") as rebuild, \
+                mock.patch("app.services.rebuild_haul_state_from_rows") as rebuild_all:
+            bulk_create_transfers(self.user.id, [self.item(quantity="7000"), self.item(quantity="5")])
+        rebuild.assert_not_called()
+        rebuild_all.assert_not_called()
+        ledger = load_user_ledger(User.objects.get(id=self.user.id))
+        rec = HaulState.objects.get(user=self.user, kind="money")
+        running, timeline = ledger.timeline(HAUL_KINDS["money"])
+        self.assertEqual((rec.running_usd, rec.last_transfer_id), (running, ledger.last_id_by_kind["money"]))
+        self.assertEqual(rec.haul_started_at,
+                         haul_window_from_timeline(timeline, ledger.nisab_usd("money"))["haul_started_at"])
+
+        # عنصر بتاريخ سابق لآخر مناقلة معالجة: إعادة بناء من أقرب checkpoint
+        old = (timezone.now() - timedelta(days=400)).isoformat()
+        with mock.patch("app.services.rebuild_haul_states") as rebuild:
+            bulk_create_transfers(self.user.id, [self.item(), self.item(transfer_date=old)])
+        rebuild.assert_called_once()
+        self.assertEqual(rebuild.call_args.args[2], ["combined", "money"])
+
+    def test_duplicate_keys_inside_one_batch(self):
+        result = bulk_create_transfers(self.user.id, [self.item("k1"), self.item("k1", quantity="99"), self.item()])
+        self.assertEqual((result["created"], result["duplicates"]), (2, 1))
+        self.assertEqual(result["results"][1], {"index": 1, "client_key": "k1", "status": "duplicate",
+                                                "duplicate_of_index": 0})
+        self.assertEqual(Transfer.objects.get(user=self.user, client_key="k1").quantity, Decimal("12.5"))
+
+    def test_unknown_or_inactive_asset_fails_only_that_item(self):
+        inactive = Asset.objects.create(name="Money", asset_type="قديم", unit_name="amount", asset_code="OLD",
+                                        unit_price_usd=Decimal("1"), is_active=False)
+        items = [self.item("ok"), {**self.item("gone"), "asset_id": 999999},
+                 {**self.item("off"), "asset_id": inactive.id}, self.item("bad", quantity="0")]
+        result = bulk_create_transfers(self.user.id, items)
+        self.assertEqual([r["status"] for r in result["results"]], ["created", "error", "error", "error"])
+        self.assertEqual((result["created"], result["failed"]), (1, 3))
+        self.assertEqual(list(Transfer.objects.filter(user=self.user).values_list("client_key", flat=True)), ["ok"])
+
+    def test_non_staff_cannot_post_for_another_user(self):
+        other = make_user("other@example.com")
+        response = self.post([self.item()], user_id=other.id)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transfer.objects.exists())
+
+        staff = make_user("staff@example.com")
+        staff.is_staff = True
+        staff.save()
+        self.client.force_authenticate(staff)
+        response = self.post([self.item()], user_id=other.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Transfer.objects.get().user_id, other.id)
+
+    def test_batch_size_limit(self):
+        response = self.post([self.item() for _ in range(TRANSFER_BULK_MAX_ITEMS + 1)])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transfer.objects.exists())
+
+        response = self.post([self.item() for _ in range(TRANSFER_BULK_MAX_ITEMS)])
+        self.assertEqual(response.json()["data"]["created"], TRANSFER_BULK_MAX_ITEMS)
+
+
+class HaulStateTests(TestCase):
+    """الحالة المحفوظة تطابق إعادة التشغيل الكاملة بعد كل مسار تحديث."""
+
+    def setUp(self):
+        self.enterContext(mock.patch("app.services.HAUL_CHECKPOINT_EVERY", 4))
+        cache.clear()
+        self.assets = make_assets()
+        self.user = make_user()
+        add_transfers(self.user, self.assets, 24)
+        self.ledger().haul_state("money")  # أول قراءة تبني الحالة و checkpoints
+
+    def ledger(self):
+        return load_user_ledger(User.objects.get(id=self.user.id))
+
+    def assert_matches_full_replay(self, kind="money"):
+        ledger = self.ledger()
+        rec = HaulState.objects.get(user=self.user, kind=kind)
+        running, timeline = ledger.timeline(HAUL_KINDS[kind])
+        window = haul_window_from_timeline(timeline, ledger.nisab_usd(kind))
+        self.assertEqual(rec.running_usd, running)
+        self.assertEqual(rec.haul_started_at, window["haul_started_at"])
+        self.assertEqual(rec.last_transfer_id, ledger.last_id_by_kind[kind])
+        self.assertEqual(rec.prices_key, haul_prices_key(kind, ledger.assets))
+
+    def test_new_transfer_advances_without_replay(self):
+        t = Transfer.objects.create(user=self.user, asset=self.assets["USD"], transfer_type="ADD",
+                                    quantity=Decimal("7000"), transfer_date=timezone.now())
+        with mock.patch("app.services.rebuild_haul_state_from_rows") as rebuild, \
+                mock.patch("app.services.rebuild_haul_states") as rebuild_since:
+            note_transfer_created(t)
+        rebuild.assert_not_called()
+        rebuild_since.assert_not_called()
+        self.assert_matches_full_replay()
+
+        # القراءة التالية تستعمل الحالة المحفوظة كما هي
+        with mock.patch("app.services.rebuild_haul_state_from_rows") as rebuild:
+            self.ledger().haul_state("money")
+        rebuild.assert_not_called()
+
+    def test_read_path_catch_up_rechecks_under_the_user_lock(self):
+        # دفتر حُمّل قبل أن يبني قارئ آخر الحالة: لا بناء ثانٍ
+        HaulState.objects.filter(user=self.user).update(prices_key="stale")
+        ledger = self.ledger()
+        self.ledger().haul_state("money")
+        with mock.patch("app.services.rebuild_haul_state_from_rows") as rebuild:
+            ledger.haul_state("money")
+        rebuild.assert_not_called()
+
+        # مناقلة أُضيفت بعد تحميل الدفتر: البناء يقرأ المناقلات داخل القفل فلا يكتب حالة أقدم
+        HaulState.objects.filter(user=self.user).update(prices_key="stale")
+        ledger = self.ledger()
+        t = Transfer.objects.create(user=self.user, asset=self.assets["USD"], transfer_type="ADD",
+                                    quantity=Decimal("7000"), transfer_date=timezone.now())
+        with CaptureQueriesContext(connection) as ctx:
+            ledger.haul_state("money")
+        self.assertTrue(any('FROM "app_user"' in q["sql"] for q in ctx.captured_queries))  # قفل صف المستخدم
+        self.assertEqual(HaulState.objects.get(user=self.user, kind="money").last_transfer_id, t.id)
+        self.assert_matches_full_replay()
+
+    def test_backdated_edit_rebuilds_from_nearest_checkpoint(self):
+        money = Transfer.objects.filter(user=self.user, asset__name="Money").order_by("transfer_date", "id")
+        edited = list(money)[8]
+        kept = set(HaulCheckpoint.objects.filter(user=self.user, kind="money", transfer_date__lt=edited.transfer_date)
+                   .values_list("id", flat=True))
+        self.assertTrue(kept)
+
+        edited.quantity += Decimal("5000")
+        edited.save()
+        with CaptureQueriesContext(connection) as ctx:
+            note_transfers_changed(self.user.id, edited.transfer_date)
+        self.assert_matches_full_replay()
+
+        after = set(HaulCheckpoint.objects.filter(user=self.user, kind="money", transfer_date__lt=edited.transfer_date)
+                    .values_list("id", flat=True))
+        self.assertEqual(after, kept)
+        # إعادة التشغيل تقرأ المناقلات بعد أقرب checkpoint فقط
+        replayed = [q["sql"] for q in ctx.captured_queries if 'FROM "app_transfer"' in q["sql"]]
+        self.assertTrue(replayed)
+        self.assertTrue(all('"app_transfer"."transfer_date" >' in sql for sql in replayed))
+
+    def test_price_change_invalidates_state(self):
+        old_key = HaulState.objects.get(user=self.user, kind="money").prices_key
+        myr = self.assets["MYR"]
+        myr.unit_price_usd = Decimal("0.5")
+        myr.save()
+        bump_price_version()
+
+        # مناقلة جديدة بعد تغيّر الأسعار: الحالة القديمة تُحذف ولا تُقدَّم
+        t = Transfer.objects.create(user=self.user, asset=self.assets["USD"], transfer_type="ADD",
+                                    quantity=Decimal("1"), transfer_date=timezone.now())
+        note_transfer_created(t)
+        self.assertFalse(HaulState.objects.filter(user=self.user, kind="money").exists())
+        self.assertFalse(HaulCheckpoint.objects.filter(user=self.user, kind="money").exists())
+
+        self.ledger().haul_state("money")
+        self.assertNotEqual(HaulState.objects.get(user=self.user, kind="money").prices_key, old_key)
+        self.assert_matches_full_replay()
+
+    def test_stale_state_rebuilt_on_read(self):
+        HaulState.objects.filter(user=self.user, kind="money").update(prices_key="stale")
+        replay = self.ledger().haul_state("money")
+        running, _ = self.ledger().timeline(HAUL_KINDS["money"])
+        self.assertEqual(replay.running, running)
+        self.assert_matches_full_replay()
+
+
+class HoldingTests(TestCase):
+    def setUp(self):
+        self.assets = make_assets()
+        self.user = make_user()
+        add_transfers(self.user, self.assets, 30)
+
+    def net(self, code):
+        return Holding.objects.get(user=self.user, asset=self.assets[code]).net_quantity
+
+    def test_kept_in_sync_by_every_write_path(self):
+        self.assertEqual(reconcile_holdings(), [])
+
+        t = Transfer.objects.filter(user=self.user, asset=self.assets["USD"]).first()
+        t.quantity += Decimal("2.5")
+        t.asset = self.assets["MYR"]
+        t.save()
+        self.assertEqual(reconcile_holdings(), [])
+
+        t.delete()
+        Transfer.objects.filter(user=self.user, asset=self.assets["SILVER"])[:1].get().delete()
+        self.assertEqual(reconcile_holdings(), [])
+
+        bulk_create_transfers(self.user.id, [
+            {"asset_id": self.assets["GOLD_24"].id, "transfer_type": "ADD", "quantity": "3.25"},
+            {"asset_id": self.assets["GOLD_24"].id, "transfer_type": "WITHDRAW", "quantity": "1"},
+        ])
+        self.assertEqual(reconcile_holdings(), [])
+
+        Transfer.objects.filter(user=self.user, asset=self.assets["GOLD_24"]).delete()
+        self.assertEqual(reconcile_holdings(), [])
+        self.assertEqual(self.net("GOLD_24"), 0)
+
+    def test_reconcile_detects_and_repairs_drift(self):
+        expected = self.net("USD")
+        Holding.objects.filter(user=self.user, asset=self.assets["USD"]).update(net_quantity=expected + 1)
+        Holding.objects.filter(user=self.user, asset=self.assets["MYR"]).delete()
+
+        drift = reconcile_holdings()
+        self.assertEqual({(d["asset_id"], d["actual"]) for d in drift},
+                         {(self.assets["USD"].id, expected + 1), (self.assets["MYR"].id, None)})
+        out = io.StringIO()
+        call_command("reconcile_holdings", "--repair", stdout=out)
+        self.assertIn("Repaired 2", out.getvalue())
+        self.assertEqual(reconcile_holdings(), [])
+        self.assertEqual(self.net("USD"), expected)
+
+    def test_totals_only_snapshot_reads_holdings(self):
+        full = compute_user_snapshot(self.user)["totals"]
+        with CaptureQueriesContext(connection) as ctx:
+            totals = compute_user_snapshot(self.user, fields=["totals"])["totals"]
+        self.assertEqual(totals, full)
+        self.assertFalse([q for q in ctx.captured_queries if "app_transfer" in q["sql"]])
+
+
+class ReminderSchedulerTests(TestCase):
+    def setUp(self):
+        self.assets = make_assets()
+        now = timezone.now()
+        # بداية حول تجعل days_left = 7 ثم 8 (ذهب فوق النصاب 85 غرامًا)
+        self.due_user, self.other_user = make_user("a@example.com"), make_user("b@example.com")
+        for user, days in ((self.due_user, 7), (self.other_user, 8)):
+            Transfer.objects.create(user=user, asset=self.assets["GOLD_24"], transfer_type="ADD",
+                                    quantity=Decimal("100"),
+                                    transfer_date=now - timedelta(days=354 - days, hours=-1))
+
+    def test_schedules_only_offset_day_users_once(self):
+        out = io.StringIO()
+        call_command("schedule_reminders", stdout=out)  # يبني الحالات المفقودة أولًا
+        self.assertIn("refreshed haul states for 2 users", out.getvalue())
+
+        reminders = list(NotificationOutbox.objects.values_list("user_id", "kind", "offset_days", "message"))
+        notifications = compute_user_snapshot(self.due_user)["notifications"]
+        self.assertEqual(reminders, [(self.due_user.id, "gold", 7, notifications[0])])
+        state = HaulState.objects.get(user=self.due_user, kind="gold")
+        self.assertEqual(state.next_due_at, state.haul_started_at + timedelta(days=354))
+
+        schedule_zakat_reminders()
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+    def test_passed_due_dates_roll_to_next_haul(self):
+        call_command("schedule_reminders", stdout=io.StringIO())
+        # الحول الثاني: الموعد الأول مضى فيُرحَّل إلى start + 2 × حول
+        # (كان الباقي 8 أيام؛ بعد الإزاحة يصبح الموعد التالي بعد 15 يومًا)
+        state = HaulState.objects.get(user=self.other_user, kind="gold")
+        shift = timedelta(days=354 - 7)
+        HaulState.objects.filter(pk=state.pk).update(
+            haul_started_at=state.haul_started_at - shift, next_due_at=state.next_due_at - shift,
+        )
+        # الدفتر نفسه يُزاح، وزكاة الحول الأول مسدَّدة: اللقطة تعرض الموعد القادم أيضًا
+        Transfer.objects.filter(user=self.other_user).update(transfer_date=F("transfer_date") - shift)
+        Transfer.objects.create(user=self.other_user, asset=self.assets["GOLD_24"], transfer_type="ZAKAT_OUT",
+                                quantity=Decimal("3"), transfer_date=state.next_due_at - shift)
+        schedule_zakat_reminders()
+        state.refresh_from_db()
+        self.assertEqual(state.next_due_at, state.haul_started_at + timedelta(days=2 * 354))
+        self.assertTrue(NotificationOutbox.objects.filter(user=self.other_user, offset_days=15).exists())
+
+    def test_deliver_marks_sent_and_retries_failures(self):
+        call_command("schedule_reminders", stdout=io.StringIO())
+        out, err = io.StringIO(), io.StringIO()
+        call_command("deliver_notifications", stdout=out, stderr=err)
+        line = json.loads(out.getvalue())
+        self.assertEqual((line["user_id"], line["offset_days"]), (self.due_user.id, 7))
+        self.assertEqual(NotificationOutbox.objects.get().status, "sent")
+
+        NotificationOutbox.objects.update(status="pending", attempts=0)
+
+        calls = []
+
+        def broken(n):
+            calls.append(n.id)
+            raise RuntimeError("smtp down")
+        for attempt in range(1, 5):
+            self.assertEqual(deliver_notifications(broken), (0, 0))
+            n = NotificationOutbox.objects.get()
+            self.assertEqual(n.attempts, attempt)
+            # لا إعادة فورية: الرسالة تنتظر next_attempt_at (60، 120، 240... ثانية)
+            self.assertAlmostEqual((n.next_attempt_at - timezone.now()).total_seconds(),
+                                   60 * 2 ** (attempt - 1), delta=5)
+            self.assertEqual(deliver_notifications(broken), (0, 0))
+            self.assertEqual(len(calls), attempt)
+            NotificationOutbox.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_notifications(broken), (0, 1))
+        n = NotificationOutbox.objects.get()
+        self.assertEqual((n.status, n.attempts, n.last_error, n.next_attempt_at), ("failed", 5, "smtp down", None))
+
+    def test_consumer_crash_does_not_resend_delivered_messages(self):
+        due = timezone.now() + timedelta(days=7)
+        for user in (self.due_user, self.other_user):
+            NotificationOutbox.objects.create(user=user, kind="gold", due_at=due, offset_days=7, message="m")
+        delivered = []
+
+        def crash_on_second(n):
+            if delivered:
+                raise KeyboardInterrupt  # تعطّل العملية أثناء الإرسال
+            delivered.append(n.user_id)
+        with self.assertRaises(KeyboardInterrupt):
+            deliver_notifications(crash_on_second)
+
+        # الأولى سُجّلت فور إرسالها؛ الثانية محجوزة حتى انتهاء المهلة
+        rows = {n.user_id: n for n in NotificationOutbox.objects.all()}
+        self.assertEqual(rows[self.due_user.id].status, "sent")
+        self.assertEqual((rows[self.other_user.id].status, rows[self.other_user.id].attempts), ("pending", 1))
+        self.assertEqual(deliver_notifications(delivered.append), (0, 0))
+
+        NotificationOutbox.objects.filter(status="pending").update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_notifications(lambda n: delivered.append(n.user_id)), (1, 0))
+        self.assertEqual(delivered, [self.due_user.id, self.other_user.id])
+
+    def test_completed_haul_reminders_follow_snapshot_allocation(self):
+        # حول أول مكتمل قبل 347 يومًا والموعد القادم بعد 7 أيام: من سدّد زكاة الحول الأول
+        # يُذكَّر به، ومن لم يسدّد تعرض له اللقطة الحول المتأخر فلا تذكير بالموعد القادم
+        now = timezone.now()
+        paid, unpaid = make_user("paid@example.com"), make_user("unpaid@example.com")
+        start = now - timedelta(days=2 * 354 - 7, hours=-1)
+        for user in (paid, unpaid):
+            Transfer.objects.create(user=user, asset=self.assets["GOLD_24"], transfer_type="ADD",
+                                    quantity=Decimal("100"), transfer_date=start)
+        Transfer.objects.create(user=paid, asset=self.assets["GOLD_24"], transfer_type="ZAKAT_OUT",
+                                quantity=Decimal("3"), transfer_date=start + timedelta(days=360))
+
+        call_command("schedule_reminders", stdout=io.StringIO())
+        reminded = set(NotificationOutbox.objects.values_list("user_id", "offset_days"))
+        self.assertIn((paid.id, 7), reminded)
+        self.assertNotIn(unpaid.id, {user_id for user_id, _ in reminded})
+        for user in (paid, unpaid):
+            self.assertEqual(HaulState.objects.get(user=user, kind="gold").next_due_at.date(),
+                             (start + timedelta(days=2 * 354)).date())
+        self.assertEqual(compute_user_snapshot(paid)["notifications"], [reminder_message(7)])
+        self.assertEqual(compute_user_snapshot(unpaid)["notifications"], [])
+
+
+class PriceChangeJournalTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.assets = make_assets()
+        self.user = make_user()
+        add_transfers(self.user, self.assets, 12)
+        self.client = APIClient()
+
+    def snapshot_total(self):
+        self.client.force_authenticate(User.objects.get(id=self.user.id))
+        return self.client.get("/app/snapshot/", secure=True).json()["data"]["totals"]["total_value_usd"]
+
+    def test_single_update_writes_journal(self):
+        before_total = self.snapshot_total()
+        ledger_version = User.objects.get(id=self.user.id).ledger_version
+        holdings = set(Holding.objects.values_list("user_id", "asset_id", "net_quantity"))
+        gold, myr = Asset.objects.get(asset_code="GOLD_24"), Asset.objects.get(asset_code="MYR")
+
+        with CaptureQueriesContext(connection) as ctx:
+            version = apply_price_changes([(gold, Decimal("80.123456")), (myr, Decimal("0.220001"))], source="test")
+        updates = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith('UPDATE "app_asset"')]
+        self.assertEqual(len(updates), 1)
+
+        self.assertEqual(version, get_price_version())
+        self.assertEqual(
+            set(PriceChange.objects.values_list("asset__asset_code", "old_price_usd", "new_price_usd",
+                                                "price_version", "source")),
+            {("GOLD_24", Decimal("75"), Decimal("80.123456"), version, "test"),
+             ("MYR", Decimal("0.21"), Decimal("0.220001"), version, "test")},
+        )
+        self.assertEqual(Asset.objects.get(id=gold.id).unit_price_usd, Decimal("80.123456"))
+
+        # الأسعار لا تمس الدفتر: نسخة الدفتر والأرصدة كما هي، واللقطة تُحسب من جديد بنسخة الأسعار
+        self.assertEqual(User.objects.get(id=self.user.id).ledger_version, ledger_version)
+        self.assertEqual(set(Holding.objects.values_list("user_id", "asset_id", "net_quantity")), holdings)
+        self.assertEqual(reconcile_holdings(), [])
+        self.assertNotEqual(self.snapshot_total(), before_total)
+
+    def test_no_changes_is_a_no_op(self):
+        version = get_price_version()
+        self.assertEqual(apply_price_changes([], source="test"), 0)
+        self.assertEqual(get_price_version(), version)
+        self.assertFalse(PriceChange.objects.exists())
+
+
+class NisabIndexTests(TestCase):
+    def setUp(self):
+        self.assets = make_assets()
+        # مفاتيح هامش معلّقة من كتابات اختبارات سابقة (معاملاتها لا تُثبَّت): بلا فهرس بعد لا تكتب شيئًا
+        flush_margin_refresh()
+        # نصاب الذهب 85 × 75 = 6375
+        self.users = {}
+        with self.captureOnCommitCallbacks(execute=True):
+            for name, code, qty in (("near", "USD", "6300"), ("rich", "USD", "100000"),
+                                    ("poor", "USD", "100"), ("gold", "GOLD_24", "100")):
+                user = self.users[name] = make_user(f"{name}@example.com")
+                Transfer.objects.create(user=user, asset=self.assets[code], transfer_type="ADD",
+                                        quantity=Decimal(qty), transfer_date=timezone.now() - timedelta(days=3))
+        out = io.StringIO()
+        call_command("rebuild_nisab_index", stdout=out)
+        self.assertIn("Re-indexed 4 users, 0 nisab crossings", out.getvalue())
+
+    def set_gold(self, price):
+        gold = Asset.objects.get(asset_code="GOLD_24")
+        # التقييم يُؤجَّل إلى ما بعد تثبيت معاملة الأسعار
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_price_changes([(gold, Decimal(price))], source="test")
+
+    def events(self):
+        return set(HaulEvent.objects.values_list("user_id", "kind", "event"))
+
+    def test_price_tick_reevaluates_only_users_near_nisab(self):
+        near = self.users["near"]
+        self.set_gold("73")  # النصاب 6205: near يصعد فوقه
+        self.assertEqual(self.events(), {(near.id, "money", "start"), (near.id, "combined", "start")})
+        self.assertTrue(NisabMargin.objects.get(user=near, kind="money").above)
+        state = HaulState.objects.get(user=near, kind="money")
+        self.assertIsNotNone(state.haul_started_at)
+
+        # يكفي استعلام النطاق: البعيدون عن النصاب لا يُقيَّمون
+        self.set_gold("73.5")
+        self.assertEqual(process_price_tick()["evaluated"], 1)
+
+        self.set_gold("76")  # النصاب 6460: near يهبط تحته
+        self.assertIn((near.id, "money", "reset"), self.events())
+        self.assertEqual(HaulEvent.objects.exclude(user=near).count(), 0)
+
+    def test_transfers_keep_index_current_without_events(self):
+        near = self.users["near"]
+        # صفوف الهامش تُحدَّث بعد تثبيت معاملة الكتابة
+        with self.captureOnCommitCallbacks(execute=True):
+            Transfer.objects.create(user=near, asset=self.assets["USD"], transfer_type="ADD",
+                                    quantity=Decimal("200"), transfer_date=timezone.now())
+        margin = NisabMargin.objects.get(user=near, kind="money")
+        self.assertTrue(margin.above)
+        self.assertAlmostEqual(margin.ratio, 6500 / 6375)
+        self.assertFalse(HaulEvent.objects.exists())
+
+        self.set_gold("77")  # 6545 > 6500
+        self.assertIn((near.id, "money", "reset"), self.events())
+
+    def test_price_tick_waits_for_commit(self):
+        gold = Asset.objects.get(asset_code="GOLD_24")
+        with self.captureOnCommitCallbacks() as callbacks:
+            apply_price_changes([(gold, Decimal("73"))], source="test")
+            self.assertFalse(HaulEvent.objects.exists())
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertIn((self.users["near"].id, "money", "start"), self.events())
+
+    def test_transfer_refreshes_only_affected_kinds(self):
+        near = self.users["near"]
+        untouched = NisabMargin.objects.get(user=near, kind="money").pk
+        with self.captureOnCommitCallbacks(execute=True):
+            Transfer.objects.create(user=near, asset=self.assets["GOLD_24"], transfer_type="ADD",
+                                    quantity=Decimal("1"), transfer_date=timezone.now())
+        self.assertEqual(NisabMargin.objects.get(user=near, kind="money").pk, untouched)
+        self.assertEqual(set(NisabMargin.objects.filter(user=near).values_list("kind", flat=True)),
+                         {"money", "gold", "combined"})
+
+    def test_margins_refresh_once_per_transaction(self):
+        near, poor = self.users["near"], self.users["poor"]
+        with mock.patch("app.nisab_index.refresh_nisab_margins") as refresh:
+            with self.captureOnCommitCallbacks(execute=True):
+                for user in (near, near, poor):
+                    Transfer.objects.create(user=user, asset=self.assets["USD"], transfer_type="ADD",
+                                            quantity=Decimal("1"), transfer_date=timezone.now())
+                refresh.assert_not_called()  # لا شيء قبل التثبيت
+        refresh.assert_called_once_with({(near.id, self.assets["USD"].id), (poor.id, self.assets["USD"].id)})
+
+
+class RateRefreshCoordinatorTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.pending = []
+        self.result = {"status": "ok", "updated": []}
+
+        def fake_refresh():
+            self.calls.append(timezone.now())
+            return self.result
+        patches = [
+            mock.patch.dict("app.rate_refresh.RATE_REFRESHERS", {"currencies": fake_refresh}),
+            # المهام الخلفية لا تُشغَّل حتى نطلب ذلك: تحاكي تحديثًا ما زال جاريًا
+            mock.patch("app.rate_refresh.start_in_background", self.pending.append),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_concurrent_callers_share_one_upstream_call(self):
+        client = APIClient()
+        first = client.post("/app/rates/update/currencies/", secure=True).json()
+        second = client.post("/app/rates/update/currencies/", secure=True).json()
+        self.assertEqual((first["data"]["status"], first["data"]["started"]), ("running", True))
+        self.assertEqual((second["data"]["status"], second["data"]["started"]), ("running", False))
+        self.assertIn("already in progress", second["message"][0])
+        self.assertEqual(len(self.pending), 1)
+
+        self.pending.pop()()
+        self.assertEqual(len(self.calls), 1)
+        third = client.post("/app/rates/update/currencies/", secure=True).json()
+        self.assertEqual((third["data"]["status"], third["data"]["started"]), ("ok", False))
+        self.assertEqual(self.pending, [])
+        self.assertEqual(RateRefreshJob.objects.get().runs, 1)
+
+    def test_interrupted_refresh_releases_the_lock(self):
+        # إيقاف الخيط أثناء الجلب: النتيجة تُكتب في finally فلا يبقى running
+        def killed():
+            raise SystemExit
+        with mock.patch.dict("app.rate_refresh.RATE_REFRESHERS", {"currencies": killed}):
+            with self.assertRaises(SystemExit):
+                request_refresh("currencies", background=False)
+        job = RateRefreshJob.objects.get()
+        self.assertEqual((job.status, job.result["message"]), ("error", ["interrupted"]))
+
+        # إيقاف العامل قبل أن يكمل الخيط: atexit يعلّم المهمة error فيُستولى عليها فورًا
+        self.assertTrue(request_refresh("currencies", force=True)["started"])
+        release_interrupted_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result["message"]), ("error", ["interrupted by worker shutdown"]))
+        self.assertTrue(request_refresh("currencies")["started"])
+        for run in self.pending:
+            run()
+
+    def test_staleness_window_and_announced_next_update(self):
+        job = request_refresh("currencies", background=False)
+        self.assertEqual(job["status"], "ok")
+        self.assertEqual(job["fresh_until"], job["finished_at"] + timedelta(seconds=600))
+
+        # المزوّد يعلن موعد تحديثه التالي (ER-API): لا فائدة من السؤال قبله
+        announced = (timezone.now() + timedelta(hours=6)).replace(microsecond=0)
+        self.result = dict(self.result, time_next_update_utc=format_datetime(announced, usegmt=True))
+        job = request_refresh("currencies", force=True, background=False)
+        self.assertEqual(job["fresh_until"], announced)
+
+        after = job["fresh_until"] + timedelta(seconds=1)
+        self.assertFalse(request_refresh("currencies", background=False, now=after - timedelta(seconds=2))["started"])
+        self.assertTrue(request_refresh("currencies", background=False, now=after)["started"])
+        self.assertTrue(request_refresh("currencies", force=True, background=False, now=after)["started"])
+        self.assertEqual(len(self.calls), 4)
+
+    def test_errors_are_not_cached_and_stuck_jobs_are_reclaimed(self):
+        self.result = {"status": "error", "message": ["HTTP/JSON error: timeout"]}
+        job = request_refresh("currencies", background=False)
+        self.assertEqual((job["status"], job["fresh_until"]), ("error", None))
+
+        self.result = {"status": "ok"}
+        now = timezone.now()
+        stuck = request_refresh("currencies", now=now)
+        self.assertTrue(stuck["started"])
+        later = now + timedelta(seconds=121)
+        job = request_refresh("currencies", background=False, now=later)
+        self.assertTrue(job["started"])
+        self.assertEqual(job["status"], "ok")
+        # العامل العالق إن أكمل لاحقًا لا يكتب فوق المهمة الأحدث
+        RateRefreshJob.objects.update(status="running")
+        run_refresh("currencies", now)
+        self.assertEqual(RateRefreshJob.objects.get().started_at, later)
+        self.assertEqual(RateRefreshJob.objects.get().status, "running")
+
+    def test_partial_or_cached_result_is_success_with_warning(self):
+        self.result = {
+            "status": "partial",
+            "time_next_update_utc": format_datetime(timezone.now() + timedelta(hours=6), usegmt=True),
+            "message": ["currencies: cached (erapi)"],
+            "providers": {"currencies": {"status": "cached", "source": "erapi",
+                                         "message": ["erapi: HTTP/JSON error: timeout"]}},
+        }
+        client = APIClient()
+        client.post("/app/rates/update/currencies/", secure=True)
+        self.pending.pop()()
+
+        response = client.post("/app/rates/update/currencies/", secure=True)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body["data"]["status"], body["data"]["started"]), ("ok", False))
+        self.assertEqual(body["data"]["warning"], ["currencies: cached — erapi: HTTP/JSON error: timeout"])
+        self.assertIn("with warnings", body["message"][0])
+        # لا يُعتمد موعد المزوّد المعلن لحمولة قديمة
+        job = RateRefreshJob.objects.get()
+        self.assertEqual(job.fresh_until, job.finished_at + timedelta(seconds=600))
+
+        self.result = {"status": "error", "message": ["erapi: HTTP/JSON error: timeout"]}
+        job = request_refresh("currencies", force=True, background=False)
+        self.assertEqual((job["status"], job["warning"]), ("error", []))
+
+
+# حمولات مسجّلة من المزوّدين (عيّنة metalpriceapi كما في app/views.py)
+ERAPI_PAYLOAD = {
+    "result": "success", "base_code": "USD",
+    "time_last_update_utc": "Sat, 17 Oct 2026 00:02:31 +0000",
+    "time_next_update_utc": "Sun, 18 Oct 2026 00:02:31 +0000",
+    "rates": {"USD": 1, "MYR": 4.2},
+}
+METAL_PAYLOAD = {
+    "success": True, "base": "USD", "timestamp": 1762300799,
+    "rates": {"USDXAG": 47.9822996751, "USDXAU": 3996.5901093187, "XAG": 0.0208410186, "XAU": 0.0002502133},
+}
+
+
+def use_temp_rate_cache(test):
+    path = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, path, ignore_errors=True)
+    override = test.settings(RATE_CACHE_DIR=path)
+    override.enable()
+    test.addCleanup(override.disable)
+    return path
+
+
+class StubRatesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    payloads = {"/v6/latest/USD": ERAPI_PAYLOAD, "/v1/latest": METAL_PAYLOAD}
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        self.server.hits.append((path, self.client_address))
+        if self.server.failures.get(path, 0) > 0:
+            self.server.failures[path] -= 1
+            body, code = b"{}", 503
+        else:
+            body, code = json.dumps(self.payloads[path]).encode(), 200
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ConcurrentRateFetchTests(TestCase):
+    def setUp(self):
+        self.assets = make_assets()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubRatesHandler)
+        self.server.hits, self.server.failures = [], {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        base = f"http://127.0.0.1:{self.server.server_port}"
+        patches = [
+            mock.patch("app.services.ERAPI_URL", f"{base}/v6/latest/USD"),
+            mock.patch("app.services.METAL_API_URL", f"{base}/v1/latest"),
+            mock.patch("app.rate_fetch.RATE_FETCH_BACKOFF_SECONDS", 0),
+            mock.patch.dict("app.rate_fetch.BREAKERS", {}, clear=True),
+            mock.patch("app.rate_fetch._session", None),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        use_temp_rate_cache(self)
+        key = self.settings(METALPRICE_API_KEY="test-key")
+        key.enable()
+        self.addCleanup(key.disable)
+
+    def test_metal_source_needs_api_key(self):
+        with self.settings(METALPRICE_API_KEY=""):
+            result = rate_fetch.refresh_all_rates()
+        self.assertEqual(result["status"], "partial")
+        self.assertEqual(result["providers"]["metals"]["status"], "error")
+        self.assertIn("METALPRICE_API_KEY is not set", " ".join(result["providers"]["metals"]["message"]))
+        self.assertFalse(any(path.startswith("/v1/") for path, _ in self.server.hits))
+
+    def test_both_providers_applied_in_one_price_version(self):
+        out = io.StringIO()
+        call_command("refresh_rates", stdout=out)
+        self.assertIn("Rates updated", out.getvalue())
+
+        gold = Asset.objects.get(asset_code="GOLD_24")
+        self.assertEqual(gold.unit_price_usd, DEC6(Decimal("3996.5901093187") / Decimal("31.1034768")))
+        self.assertEqual(Asset.objects.get(asset_code="MYR").unit_price_usd, DEC6(Decimal(1) / Decimal("4.2")))
+        changes = PriceChange.objects.all()
+        self.assertEqual({c.price_version for c in changes}, {get_asset_registry().version})
+        self.assertEqual({c.source for c in changes}, {"erapi+metalpriceapi"})
+
+        # الجولة الثانية تعيد استخدام اتصالات keep-alive نفسها (لا اتصال جديد لكل طلب)
+        rate_fetch.refresh_all_rates()
+        self.assertEqual(len(self.server.hits), 4)
+        self.assertLessEqual(len({addr for _, addr in self.server.hits}), 2)
+
+    def test_retries_then_circuit_opens_for_failing_provider(self):
+        self.server.failures["/v1/latest"] = 2
+        self.assertEqual(rate_fetch.refresh_all_rates()["status"], "ok")
+
+        self.server.failures["/v1/latest"] = 1000
+        for _ in range(3):
+            result = rate_fetch.refresh_all_rates()
+            self.assertEqual(result["status"], "partial")
+            self.assertEqual(result["providers"]["currencies"]["status"], "ok")
+        self.assertEqual(result["breakers"]["metalpriceapi"], "open")
+
+        metal_hits = sum(1 for path, _ in self.server.hits if path == "/v1/latest")
+        result = rate_fetch.refresh_all_rates()
+        self.assertIn("circuit open", result["providers"]["metals"]["message"][0])
+        self.assertEqual(sum(1 for path, _ in self.server.hits if path == "/v1/latest"), metal_hits)
+
+
+class FakeRateSource(rate_fetch.RateSource):
+    def __init__(self, name, kind, payload=None, error=None, wait=None, delay=0):
+        self.name, self.kind = name, kind
+        self.payload, self.error, self.wait, self.delay = payload, error, wait, delay
+        self.calls = 0
+
+    def fetch(self, http):
+        self.calls += 1
+        if self.wait is not None:
+            self.wait.wait(timeout=5)
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return self.payload
+
+
+def metal_payload(usd_per_oz_gold, usd_per_oz_silver=30):
+    return {"success": True, "rates": {"USDXAU": usd_per_oz_gold, "USDXAG": usd_per_oz_silver}}
+
+
+class MultiSourceRateTests(TestCase):
+    OZ = Decimal("31.1034768")
+
+    def setUp(self):
+        self.assets = make_assets()
+        self.cache_dir = use_temp_rate_cache(self)
+        breakers = mock.patch.dict("app.rate_fetch.BREAKERS", {}, clear=True)
+        breakers.start()
+        self.addCleanup(breakers.stop)
+        # الذهب سبق جلبه من مزوّد بسعر 75: عليه فحص القيم الشاذة
+        AssetPrice.objects.create(asset=self.assets["GOLD_24"], price_usd=Decimal("75"),
+                                  effective_at=timezone.now(), source="metalpriceapi")
+
+    def refresh(self, *sources):
+        return rate_fetch.refresh_all_rates(["metals"], {"metals": list(sources)})
+
+    def gold(self):
+        return Asset.objects.get(asset_code="GOLD_24").unit_price_usd
+
+    def test_fastest_valid_payload_wins(self):
+        slow = threading.Event()
+        self.addCleanup(slow.set)
+        sources = [
+            FakeRateSource("slow", "metals", metal_payload(2400), wait=slow),
+            FakeRateSource("negative", "metals", metal_payload(-1)),
+            FakeRateSource("outlier", "metals", metal_payload(4000)),  # +71%
+            FakeRateSource("down", "metals", error=requests.ConnectionError("refused")),
+            # يصل بعد المرفوضين فيُثبت أنهم فُحصوا ورُفضوا قبله
+            FakeRateSource("good", "metals", metal_payload(2450), delay=0.3),
+        ]
+        t0 = time.monotonic()
+        with mock.patch("app.rate_fetch.RATE_FETCH_BACKOFF_SECONDS", 0):
+            result = self.refresh(*sources)
+        self.assertLess(time.monotonic() - t0, 4)  # لا ننتظر المصدر البطيء
+
+        report = result["providers"]["metals"]
+        self.assertEqual((result["status"], report["source"]), ("ok", "good"))
+        self.assertEqual(self.gold(), DEC6(Decimal(2450) / self.OZ))
+        self.assertIn("Non-positive", report["rejected"]["negative"])
+        self.assertIn("outlier", report["rejected"]["outlier"])
+        self.assertIn("refused", report["rejected"]["down"])
+        self.assertEqual(PriceChange.objects.get(asset=self.assets["GOLD_24"]).source, "good")
+
+    def test_outage_serves_last_good_payload_from_disk(self):
+        self.refresh(FakeRateSource("good", "metals", metal_payload(2450)))
+        cached = json.load(open(os.path.join(self.cache_dir, "metals.json")))
+        self.assertEqual(cached["source"], "good")
+
+        # "إعادة تشغيل" بأسعار البذر ثم انقطاع كل المصادر
+        Asset.objects.filter(asset_code="GOLD_24").update(unit_price_usd=Decimal("76"))
+        down = FakeRateSource("good", "metals", error=ValueError("no network"))
+        result = self.refresh(down)
+        self.assertEqual((result["status"], result["providers"]["metals"]["status"]), ("partial", "cached"))
+        self.assertEqual(self.gold(), DEC6(Decimal(2450) / self.OZ))
+
+        # حمولة أقدم من RATE_CACHE_MAX_AGE_SECONDS لا تُستخدم
+        cached["fetched_at"] = (timezone.now() - timedelta(days=2)).isoformat()
+        with open(os.path.join(self.cache_dir, "metals.json"), "w") as f:
+            json.dump(cached, f)
+        self.assertEqual(self.refresh(down)["status"], "error")
+
+    def test_disk_fallback_keeps_prices_newer_than_the_payload(self):
+        self.refresh(FakeRateSource("good", "metals", metal_payload(2450)))
+
+        # الإدارة ضبطت سعر الذهب بعد حفظ الحمولة: الانقطاع لا يعيده إلى قيمة الحمولة
+        Asset.objects.filter(asset_code="GOLD_24").update(unit_price_usd=Decimal("80"))
+        AssetPrice.objects.create(asset=self.assets["GOLD_24"], price_usd=Decimal("80"),
+                                  effective_at=timezone.now() + timedelta(seconds=1), source="admin")
+        Asset.objects.filter(asset_code="SILVER").update(unit_price_usd=Decimal("1"))
+        result = self.refresh(FakeRateSource("good", "metals", error=ValueError("no network")))
+
+        report = result["providers"]["metals"]
+        self.assertEqual(report["status"], "cached")
+        self.assertEqual(report["kept_newer"], ["GOLD_24"])
+        self.assertEqual(self.gold(), Decimal("80"))
+        # بقية الأصول تُستعاد من الحمولة
+        self.assertNotEqual(Asset.objects.get(asset_code="SILVER").unit_price_usd, Decimal("1"))
+
+    def test_outlier_limit_is_configurable(self):
+        jump = FakeRateSource("jump", "metals", metal_payload(4000))  # +71%
+        with self.settings(RATE_OUTLIER_MAX_CHANGE=0.8):
+            self.assertEqual(self.refresh(jump)["providers"]["metals"]["source"], "jump")
+        self.assertEqual(self.gold(), DEC6(Decimal(4000) / self.OZ))
+
+        # حدّ خاص بالأصل يسبق العام
+        self.assertEqual(rate_fetch.outlier_limit("GOLD_24"), Decimal("0.25"))
+        with self.settings(RATE_OUTLIER_MAX_CHANGE_BY_CODE={"GOLD_24": 0.05}):
+            self.assertEqual(rate_fetch.outlier_limit("GOLD_24"), Decimal("0.05"))
+            self.assertEqual(rate_fetch.outlier_limit("SILVER"), Decimal("0.25"))
+
+    def test_fetch_runs_inside_a_running_event_loop(self):
+        # بلا asyncio.run: يصلح النداء من سياق async (الأصول مقروءة مسبقًا فلا استعلامات)
+        assets = {"metals": metal_rate_assets()}
+        tracked = rate_fetch.tracked_asset_ids(assets["metals"])
+        sources = {"metals": [FakeRateSource("down", "metals", error=ValueError("no network")),
+                              FakeRateSource("good", "metals", metal_payload(2450), delay=0.1)]}
+
+        async def from_async_context():
+            return rate_fetch.fetch_all(["metals"], sources, assets, tracked)
+
+        accepted, rejected = asyncio.run(from_async_context())["metals"]
+        self.assertEqual(accepted.source, "good")
+        self.assertEqual(rejected, {"down": "HTTP/JSON error: no network"})
 
-# Create your tests here.
+    def test_rejecting_source_trips_its_breaker(self):
+        bad = FakeRateSource("outlier", "metals", metal_payload(4000))
+        for _ in range(3):
+            self.refresh(bad)
+        result = self.refresh(bad)
+        self.assertEqual(bad.calls, 3)
+        self.assertEqual(result["providers"]["metals"]["rejected"], {"outlier": "circuit open"})
+        self.assertEqual(self.gold(), Decimal("75"))
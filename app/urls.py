@@ -8,7 +8,10 @@ urlpatterns = [
     path("profile/update/", ProfileUpdateView.as_view(), name="profile_update"),
     path("assets/", AssetListView.as_view(), name="assets_list"),
     path("profile/display-currency/", SetDisplayCurrencyView.as_view(), name="set_display_currency"),  # 👈 الجديد
+    path("transfers/", TransferListView.as_view(), name="transfer_list"),
     path("transfers/create/", TransferCreateView.as_view(), name="transfer_create"),
+    path("transfers/bulk/", TransferBulkCreateView.as_view(), name="transfer_bulk_create"),
+    path("transfers/export/", TransferExportView.as_view(), name="transfer_export"),
     path("snapshot/", SnapshotView.as_view(), name="snapshot"),
     path("reference/zakat/", ZakatReferenceView.as_view(), name="zakat_reference"),
     path("reference/privacy/", PrivacyPolicyView.as_view(), name="privacy-policy"),
@@ -11,6 +11,19 @@ from .serializers import *
 from .models import Asset
 from .utils import *
 from .services import *
+from .caching import bump_ledger_version, get_cached_snapshot_etag, get_or_compute_snapshot
+from .conditional import (
+    CATALOG_CACHE_CONTROL, REFERENCE_CACHE_CONTROL, SNAPSHOT_CACHE_CONTROL,
+    conditional_response, content_etag, etag_matches, make_etag, not_modified, with_validators,
+)
+from .prerendered import PrerenderedDocument
+from .rate_refresh import request_refresh
+from .registry import get_asset_registry
+from .filters import TransferFilter
+from .pagination import TransferKeysetPagination
+from django_filters.rest_framework import DjangoFilterBackend
+from django.http import StreamingHttpResponse
+from .exports import EXPORT_FORMATS, iter_export_lines
 from datetime import datetime, timedelta, time
 from django.utils import timezone
 from drf_spectacular.utils import extend_schema, OpenApiResponse, OpenApiTypes
@@ -92,9 +105,12 @@ class AssetListView(generics.ListAPIView):
     permission_classes = [permissions.AllowAny]
 
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
-        return success_response(data=serializer.data)
+        # القائمة وبصمتها من سجل الأصول داخل العملية (بدون استعلام عند التطابق)
+        registry = get_asset_registry()
+        return conditional_response(
+            request, registry.catalog_etag, CATALOG_CACHE_CONTROL,
+            lambda: success_response(data=registry.catalog),
+        )
 
 
 
@@ -111,6 +127,7 @@ class SetDisplayCurrencyView(generics.GenericAPIView):
         if not serializer.is_valid():
             return error_response(serializer.errors)
         user, asset = serializer.save()
+        bump_ledger_version(user.id)
         data = {
             "user_id": user.id,
             "display_currency": {
@@ -135,7 +152,9 @@ class TransferCreateView(generics.GenericAPIView):
         serializer = self.get_serializer(data=request.data, context={"request": request})
         if not serializer.is_valid():
             return error_response(serializer.errors)
-        transfer = serializer.save()
+        with transaction.atomic():
+            transfer = serializer.save()
+        note_transfer_created(transfer)
         data = TransferSerializer(transfer).data
         return success_response(data=data, message=["تم إنشاء المناقلة بنجاح."])
 
@@ -143,6 +162,72 @@ class TransferCreateView(generics.GenericAPIView):
 
 
 
+# --------------------------
+# إدخال جماعي للمناقلات (مزامنة العملاء offline)
+# POST /app/transfers/bulk/
+# {"user_id": 1, "items": [{"client_key": "k-1", "asset_id": 4, "transfer_type": "ADD",
+#                          "quantity": "12.5", "transfer_date": "2025-01-01T10:00:00Z", "note": ""}]}
+# --------------------------
+class TransferBulkCreateView(generics.GenericAPIView):
+    serializer_class = TransferBulkCreateSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        serializer = self.get_serializer(data=request.data, context={"request": request})
+        if not serializer.is_valid():
+            return error_response(serializer.errors)
+        result = bulk_create_transfers(
+            serializer.validated_data["user_id"], serializer.validated_data["items"],
+        )
+        return success_response(data=result, message=[f"تم إنشاء {result['created']} مناقلة."])
+
+
+# --------------------------
+# سجل المناقلات (ترقيم بالمؤشر + فلاتر)
+# GET /app/transfers/?kind=gold&type=ADD&date_from=2024-01-01&page_size=50&cursor=...
+# --------------------------
+class TransferListView(generics.ListAPIView):
+    serializer_class = TransferSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    filter_backends = [DjangoFilterBackend]  # الترتيب ثابت لأجل المؤشر
+    filterset_class = TransferFilter
+    pagination_class = TransferKeysetPagination
+
+    def get_queryset(self):
+        return (Transfer.objects
+                .filter(user=self.request.user)
+                .select_related("user", "asset")
+                .only(*SNAPSHOT_TRANSFER_FIELDS))
+
+
+# --------------------------
+# تصدير السجل كاملًا (تدفق)
+# GET /app/transfers/export/?output=csv|jsonl&user_id=<للمشرف فقط>
+# --------------------------
+@extend_schema(exclude=True)
+class TransferExportView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        output = (request.query_params.get("output") or "csv").lower()
+        if output not in EXPORT_FORMATS:
+            return error_response(errors=["output must be csv or jsonl"])
+
+        target = request.user
+        user_id = request.query_params.get("user_id")
+        if user_id and str(user_id) != str(request.user.id):
+            if not request.user.is_superuser:
+                return error_response(errors=["Not allowed for this user_id."])
+            target = User.objects.filter(id=user_id).first()
+            if target is None:
+                return error_response(errors=["User not found."])
+
+        content_type = "text/csv; charset=utf-8" if output == "csv" else "application/x-ndjson; charset=utf-8"
+        response = StreamingHttpResponse(iter_export_lines(target, output), content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="ledger_{target.id}.{output}"'
+        return response
+
+
 ##############################################################
 # GET /api/snapshot/?limit=20
 # Authorization: Bearer <access_token>
@@ -152,24 +237,37 @@ class TransferCreateView(generics.GenericAPIView):
 
 # app/views.py (مقتطف SnapshotView)
 
+SNAPSHOT_VIEW_FIELDS = ("profile",) + SNAPSHOT_SECTIONS + ("transfers",)
+
 @extend_schema(exclude=True)
 class SnapshotView(generics.GenericAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
         user = request.user
-        snap = compute_user_snapshot(user)
 
         # limit اختياري
         limit_param = request.query_params.get("limit")
         limit = int(limit_param) if (limit_param and limit_param.isdigit() and int(limit_param) > 0) else None
 
-        groups = grouped_transfers(user, limit=limit)
-        transfers_payload = {
-            "gold":   TransferSerializer(groups["gold"], many=True).data,
-            "silver": TransferSerializer(groups["silver"], many=True).data,
-            "money":  TransferSerializer(groups["money"], many=True).data,
-        }
+        # fields / classes اختياريان: نحسب فقط الأقسام والفئات المطلوبة
+        try:
+            fields, classes = parse_snapshot_selection(
+                request.query_params.get("fields"), request.query_params.get("classes"),
+                allowed_fields=SNAPSHOT_VIEW_FIELDS,
+            )
+        except ValueError as e:
+            return error_response(errors=[str(e)])
+        sections = tuple(f for f in fields if f in SNAPSHOT_SECTIONS)
+
+        def build():
+            out = {}
+            if sections:
+                out["snap"] = compute_user_snapshot(user, sections, classes)
+            if "transfers" in fields:
+                groups = grouped_transfers(user, limit=limit, kinds=classes)
+                out["transfers"] = {kind: TransferSerializer(groups[kind], many=True).data for kind in classes}
+            return out
 
         profile = {
             "id": user.id,
@@ -181,19 +279,45 @@ class SnapshotView(generics.GenericAPIView):
             "avatar_url": (user.avatar.url if user.avatar else None),
         }
 
-        data = {
-            "profile": profile,
-            "display_currency": snap["display_currency"],
-            "totals": snap["totals"],
-            "classes": snap["classes"],
-            "notifications": snap["notifications"],   # تذكيرات قبل الموعد فقط
-            "transfers": transfers_payload,          # كل المناقلات بروابط الصور
-        }
-        return success_response(data=data, message=["snapshot generated"])
+        # If-None-Match: نقارن ببصمة اللقطة المخزّنة + الملف الشخصي قبل أي حساب
+        price_version = get_asset_registry().version
+        variant = f"limit={limit or ''};fields={','.join(fields)};classes={','.join(classes)}"
+        stored_etag = get_cached_snapshot_etag(user, price_version, variant)
+        if stored_etag:
+            etag = make_etag(stored_etag, content_etag(profile))
+            if etag_matches(request, etag):
+                return not_modified(etag, SNAPSHOT_CACHE_CONTROL)
+
+        # الكاش مرتبط بنسخة دفتر المستخدم + نسخة الأسعار + اليوم
+        cached = get_or_compute_snapshot(user, build, variant=variant, price_version=price_version)
+
+        # بنفس الترتيب القياسي: profile, display_currency, totals, classes, notifications (تذكيرات
+        # قبل الموعد فقط), transfers (المناقلات بروابط الصور)
+        data = {}
+        for f in fields:
+            if f == "profile":
+                data[f] = profile
+            elif f == "transfers":
+                data[f] = cached["transfers"]
+            else:
+                data[f] = cached["snap"][f]
+        etag = make_etag(cached["etag"], content_etag(profile))
+        return with_validators(success_response(data=data, message=["snapshot generated"]),
+                               etag, SNAPSHOT_CACHE_CONTROL)
 
 
 # app/views.py (مرجعية الزكاة بصيغة JSON)
 
+# المستندات الثابتة (conf.py) تُسلسل وتُضغط مرة واحدة لكل عملية عند أول طلب
+_REFERENCE_DOCUMENTS = {}
+
+def reference_response(request, data, message):
+    key = message[0]
+    doc = _REFERENCE_DOCUMENTS.get(key)
+    if doc is None:
+        doc = _REFERENCE_DOCUMENTS[key] = PrerenderedDocument(data, message, REFERENCE_CACHE_CONTROL)
+    return doc.response(request)
+
 
 
 @extend_schema(exclude=True)
@@ -201,7 +325,7 @@ class ZakatReferenceView(generics.GenericAPIView):
     permission_classes = [permissions.AllowAny]
 
     def get(self, request):
-        return success_response(data=ZAKAT_REFERENCE_JSON, message=["reference generated"])
+        return reference_response(request, ZAKAT_REFERENCE_JSON, ["reference generated"])
 
 
 
@@ -223,10 +347,7 @@ class PrivacyPolicyView(APIView):
         },
     )
     def get(self, request):
-        return success_response(
-            data=PRIVACY_POLICY_JSON,
-            message=["privacy policy"]
-        )
+        return reference_response(request, PRIVACY_POLICY_JSON, ["privacy policy"])
 
 
 
@@ -235,10 +356,7 @@ class TermsOfUseView(APIView):
     serializer_class = None  
 
     def get(self, request):
-        return success_response(
-            data=TERMS_OF_USE_JSON,
-            message=["terms of use"]
-        )
+        return reference_response(request, TERMS_OF_USE_JSON, ["terms of use"])
 
 
 
@@ -247,10 +365,7 @@ class AboutView(APIView):
     serializer_class = None
 
     def get(self, request):
-        return success_response(
-            data=ABOUT_JSON,
-            message=["about"]
-        )
+        return reference_response(request, ABOUT_JSON, ["about"])
 
 
 class ContactInfoView(APIView):
@@ -258,10 +373,7 @@ class ContactInfoView(APIView):
     serializer_class = None
 
     def get(self, request):
-        return success_response(
-            data=CONTACT_INFO_JSON,
-            message=["contact_info"]
-        )
+        return reference_response(request, CONTACT_INFO_JSON, ["contact_info"])
 
 # https://open.er-api.com/v6/latest/USD
 
@@ -278,14 +390,10 @@ class UpdateCurrencyRatesView(APIView):
 
     def post(self, request):
         """
-        يستدعي خدمة تحديث أسعار صرف العملات من ER-API ويعيد تقريراً بالنتيجة.
-        استدعِه بعمل POST فقط.
+        يطلب تحديث أسعار صرف العملات من ER-API عبر منسّق التحديث ويعيد حالة المهمة فورًا
+        (بدأت / جارية مسبقًا / النتيجة الأخيرة ما زالت حديثة). استدعِه بعمل POST فقط.
         """
-        result = update_currency_assets_from_erapi()
-        if result.get("status") == "ok":
-            return success_response(data=result, message=["Currency assets updated from ER-API."])
-        else:
-            return error_response(errors=result.get("message") or ["Update failed"])
+        return refresh_response(request_refresh("currencies"), "Currency rates")
 
 
 @extend_schema(exclude=True)
@@ -294,14 +402,24 @@ class UpdateMetalRatesView(APIView):
 
     def post(self, request):
         """
-        يحدّث أسعار الذهب (24/21/19) والفضة بالدولار/غرام من metalpriceapi.
-        يتوقع إرسال api_key في البودي (JSON) أو في الإعدادات لاحقًا.
+        يطلب تحديث أسعار الذهب (24/21/19) والفضة بالدولار/غرام من metalpriceapi
+        عبر منسّق التحديث ويعيد حالة المهمة فورًا.
         """
-        result = update_metals_assets_from_metalpriceapi(api_key='d9aac6787678279fbb25f9098ab579cc')
-        if result.get("status") == "ok":
-            return success_response(data=result, message=["Metal assets updated from metalpriceapi."])
-        else:
-            return error_response(errors=result.get("message") or ["Update failed"])
+        return refresh_response(request_refresh("metals"), "Metal rates")
+
+
+def refresh_response(job, label):
+    if job["status"] == "error":
+        return error_response(errors=job["result"].get("message") or ["Update failed"])
+    if job["started"]:
+        message = f"{label} refresh started."
+    elif job["status"] == "running":
+        message = f"{label} refresh already in progress."
+    elif job["warning"]:
+        message = f"{label} updated with warnings (partial or cached rates)."
+    else:
+        message = f"{label} are fresh; no upstream call."
+    return success_response(data=job, message=[message])
 
 
 
@@ -315,43 +433,27 @@ class ReportsView(APIView):
         ser.is_valid(raise_exception=True)
         user_id   = ser.validated_data["user_id"]
         filt_type = ser.validated_data.get("filter", "none")
+        filters    = ser.validated_data.get("filters")
+        series     = ser.validated_data.get("series", "none")
         start_date = ser.validated_data.get("start_date")
         end_date   = ser.validated_data.get("end_date")
 
-        # احسب حدود التاريخ (شاملة) بحسب الفلتر
-        start_dt = end_dt = None
-        tz = timezone.get_current_timezone()
-        now = timezone.now()
-
-        def day_start(d):  # 00:00:00
-            return timezone.make_aware(datetime.combine(d, time.min), tz)
-
-        def day_end(d):    # 23:59:59.999999
-            return timezone.make_aware(datetime.combine(d, time.max), tz)
-
-        if filt_type == "last_1m":
-            start_dt = now - timedelta(days=30)
-            start_dt = datetime.combine(start_dt.date(), time.min).replace(tzinfo=tz)
-            end_dt   = datetime.combine(now.date(), time.max).replace(tzinfo=tz)
-
-        elif filt_type == "last_3m":
-            start_dt = now - timedelta(days=90)
-            start_dt = datetime.combine(start_dt.date(), time.min).replace(tzinfo=tz)
-            end_dt   = datetime.combine(now.date(), time.max).replace(tzinfo=tz)
-
-        elif filt_type == "last_6m":
-            start_dt = now - timedelta(days=180)
-            start_dt = datetime.combine(start_dt.date(), time.min).replace(tzinfo=tz)
-            end_dt   = datetime.combine(now.date(), time.max).replace(tzinfo=tz)
-
-        elif filt_type == "custom":
-            # start_date / end_date تأتي من الـ serializer بشكل Date
-            start_dt = day_start(start_date)
-            end_dt   = day_end(end_date)
-
-        # none => بدون فلترة زمنية
+        # احسب حدود التاريخ (شاملة) بحسب الفلتر؛ none => بدون فلترة زمنية
+        if filters:
+            # وضع النوافذ المتعددة: كل النوافذ (والسلسلة) من استعلام تجميعي واحد
+            windows = {f: report_window_bounds(f, start_date, end_date) for f in filters}
+            result = compute_user_report_windows(
+                request.user, user_id, windows, series=None if series == "none" else series,
+            )
+        else:
+            start_dt, end_dt = report_window_bounds(filt_type, start_date, end_date)
+            if series == "none":
+                result = compute_user_report(request.user, user_id, start_dt=start_dt, end_dt=end_dt)
+            else:
+                result = compute_user_report_windows(
+                    request.user, user_id, {filt_type: (start_dt, end_dt)}, series=series,
+                )
 
-        result = compute_user_report(request.user, user_id, start_dt=start_dt, end_dt=end_dt)
         if result.get("status") == "forbidden":
             return error_response(errors=["Not allowed."], status_code=403)
         if result.get("status") != "ok":
@@ -446,6 +548,13 @@ class TransferUpdateView(APIView):
 
         transfer.save()  # بدون update_fields كي نضمن إشارات الحفظ
 
+        # تعديل يمس القيمة → إعادة بناء حالة الحول من أقرب checkpoint قبل تاريخ المناقلة؛
+        # الملاحظة/الفاتورة جزء من قوائم المناقلات في اللقطة فتكفيها زيادة نسخة الدفتر
+        if {"asset", "transfer_type", "quantity"} & set(updated_fields):
+            note_transfers_changed(transfer.user_id, transfer.transfer_date)
+        else:
+            bump_ledger_version(transfer.user_id)
+
         return success_response(
             message=["Transfer updated successfully"],
             data={
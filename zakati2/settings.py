@@ -98,6 +98,23 @@ if os.getenv("DATABASE_URL"):
         os.environ["DATABASE_URL"], conn_max_age=600, ssl_require=True
     )
 
+# =========================
+# الكاش (لقطة المستخدم)
+# =========================
+# افتراضيًا ذاكرة محلية لكل عملية؛ CACHE_BACKEND=db لمشاركته بين العمليات
+# (يتطلب: python manage.py createcachetable)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "zakati",
+    }
+}
+if os.getenv("CACHE_BACKEND", "").lower() == "db":
+    CACHES["default"] = {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "zakati_cache",
+    }
+
 # =========================
 # كلمات المرور
 # =========================
@@ -125,6 +142,12 @@ STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.getenv("MEDIA_ROOT", os.path.join(BASE_DIR, "media"))
 
+# آخر أسعار سليمة من المزوّدين (app/rate_fetch.py) — تُستخدم عند انقطاعهم
+RATE_CACHE_DIR = os.getenv("RATE_CACHE_DIR", os.path.join(BASE_DIR, "var", "rates"))
+# عتبة رفض القيم الشاذة في أسعار المزوّدين (الافتراضي في app/conf.py)
+if os.getenv("RATE_OUTLIER_MAX_CHANGE"):
+    RATE_OUTLIER_MAX_CHANGE = float(os.environ["RATE_OUTLIER_MAX_CHANGE"])
+
 STORAGES = {
     "default": {
         "BACKEND": "django.core.files.storage.FileSystemStorage",
@@ -227,4 +250,5 @@ if not DEBUG:
 
 
 
-METALPRICE_API_KEY ='d9aac6787678279fbb25f9098ab579cc'
\ No newline at end of file
+# مفتاح metalpriceapi (أسعار الذهب/الفضة) سرّ: من البيئة فقط، بلا قيمة افتراضية
+METALPRICE_API_KEY = os.getenv("METALPRICE_API_KEY", "")
\ No newline at end of file